@@ -0,0 +1,218 @@
+"""
+Замер массовых команд /sendsms, /masssendcoin и /masssendach
+
+Поднимает заглушку Bot API с лимитами Telegram (сообщений в секунду в один
+чат и всего, ответ 429 с retry_after) и пользователями, заблокировавшими
+бота (ответ 403), заполняет базу бота синтетическими пользователями и по
+очереди отправляет боту массовые команды от имени создателя. По каждой
+команде выводит время выполнения, достигнутую скорость доставки и число
+впустую потраченных запросов.
+
+Бот запускается после стенда в режиме polling с конфигурацией, где
+"API_SERVER": "http://127.0.0.1:8081", CREATOR_ID совпадает с --creator-id,
+а DB_FILE - с --db (см. benchmarks/fake_telegram.py). Синтетические пользователи
+и достижение остаются в этой базе, поэтому рабочая база для замера не подходит:
+    python benchmarks/broadcast_bench.py --users 2000 --blocked-rate 0.05 --db bench_bot.db
+    BOT_CONFIG_FILE=bench_config.json python bot.py
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from collections import Counter
+from typing import Dict, Optional, Set
+
+from fake_telegram import FakeBotAPI, make_message_update
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+# Отчет, которым массовые команды завершаются
+REPORT_MARKER = "📊 Отчет"
+
+# Достижение для /masssendach
+BENCH_ACHIEVEMENT = "bench_broadcast"
+
+DEFAULT_COMMANDS = "/sendsms Тестовая рассылка,/masssendcoin 1,/masssendach " + BENCH_ACHIEVEMENT
+
+
+class BroadcastAPI(FakeBotAPI):
+    """
+    Заглушка Bot API, которая учитывает доставку массовых сообщений
+
+    Впустую потраченными считаются повторные отправки в чат раньше
+    retry_after из предыдущего 429 и повторные отправки пользователю,
+    уже ответившему 403 (в том числе в предыдущих командах).
+    """
+
+    def __init__(self, creator_id: int, **kwargs):
+        super().__init__(**kwargs)
+        self.creator_id = creator_id
+        self.report: Optional[asyncio.Event] = None
+        self.known_blocked: Set[int] = set()
+        self.reset()
+
+    def reset(self):
+        self.delivered_chats: Set[int] = set()
+        self.delivered_count = 0
+        self.rejected = Counter()
+        self.wasted_retries = Counter()
+        # {чат: время, раньше которого повторять отправку бессмысленно}
+        self.retry_not_before: Dict[int, float] = {}
+        self.last_attempt = time.perf_counter()
+        self.flood_errors.clear()
+        self.forbidden_errors.clear()
+        self.report = asyncio.Event()
+
+    def check_limits(self, method: str, chat_id: int):
+        self.last_attempt = time.perf_counter()
+        if time.perf_counter() < self.retry_not_before.get(chat_id, 0.0):
+            self.wasted_retries["retry_after"] += 1
+        if chat_id in self.known_blocked:
+            self.wasted_retries["blocked"] += 1
+        return super().check_limits(method, chat_id)
+
+    def sent(self, method: str, chat_id: int, params: dict):
+        super().sent(method, chat_id, params)
+        if chat_id == self.creator_id:
+            if str(params.get("text", "")).startswith(REPORT_MARKER):
+                self.report.set()
+            return
+        self.delivered_count += 1
+        self.delivered_chats.add(chat_id)
+
+    def flooded(self, chat_id: int, retry_after: int):
+        self.rejected[429] += 1
+        self.retry_not_before[chat_id] = time.perf_counter() + retry_after
+
+    def forbidden(self, chat_id: int):
+        super().forbidden(chat_id)
+        self.known_blocked.add(chat_id)
+        self.rejected[403] += 1
+
+
+def seed_database(db_path: str, user_ids, creator_id: int):
+    """Регистрирует синтетических пользователей и создает достижение для /masssendach"""
+    database.DB_FILE = db_path
+    database.init_database()
+    now = int(time.time())
+    for user_id in [creator_id, *user_ids]:
+        database.register_user(user_id, f"User{user_id}", f"user{user_id}", now)
+    database.create_achievement(BENCH_ACHIEVEMENT, "Участник замера рассылки", now)
+
+
+async def run_command(api: BroadcastAPI, command: str, update_id: int, targets: int, blocked: int,
+                      idle_timeout: float) -> dict:
+    """
+    Отправляет команду от создателя и ждет отчета бота
+
+    Если бот дольше idle_timeout секунд ничего не отправляет (например, сам
+    отчет получил 429), команда считается незавершенной на последней отправке.
+    """
+    api.reset()
+    api.updates.put_nowait(make_message_update(update_id, api.creator_id, command))
+    # Отсчет начинается, когда бот забирает апдейт
+    while not api.updates.empty():
+        await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    while not api.report.is_set() and time.perf_counter() - api.last_attempt < idle_timeout:
+        await asyncio.sleep(0.05)
+    finished = api.report.is_set()
+    elapsed = max(0.0, (time.perf_counter() if finished else api.last_attempt) - started)
+
+    return {
+        "command": command.split()[0],
+        "finished": finished,
+        "seconds": elapsed,
+        "delivered": api.delivered_count,
+        "msg_per_second": api.delivered_count / elapsed if elapsed else 0.0,
+        # Пользователи, не заблокировавшие бота, до которых сообщение так и не дошло
+        "lost": targets - blocked - len(api.delivered_chats),
+        "rejected_429": api.rejected[429],
+        "rejected_403": api.rejected[403],
+        "wasted_retries": sum(api.wasted_retries.values())
+    }
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    user_ids = list(range(args.first_user_id, args.first_user_id + args.users))
+    blocked = set(rng.sample(user_ids, int(args.users * args.blocked_rate)))
+
+    api = BroadcastAPI(
+        creator_id=args.creator_id,
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        seed=args.seed,
+        chat_rate=args.chat_rate,
+        global_rate=args.global_rate,
+        blocked=blocked
+    )
+    runner = await api.start(args.api_host, args.api_port)
+    print(f"Заглушка Bot API: http://{args.api_host}:{args.api_port}")
+
+    seed_database(args.db, user_ids, args.creator_id)
+    print(f"В {args.db} зарегистрировано пользователей: {len(user_ids)}, заблокировали бота: {len(blocked)}")
+
+    print("Ожидание запуска бота (getUpdates)...")
+    while not api.calls["getUpdates"]:
+        await asyncio.sleep(0.1)
+
+    results = []
+    for index, command in enumerate(args.commands.split(",")):
+        if index:
+            # Пауза, чтобы лимиты чата создателя после отчета не сорвали начало следующей команды
+            await asyncio.sleep(args.pause)
+        print(f"\n{command}...")
+        result = await run_command(api, command, index + 1, len(user_ids), len(blocked), args.idle_timeout)
+        results.append(result)
+        status = "" if result["finished"] else " (отчет не получен)"
+        print(
+            f"{result['command']}: {result['seconds']:.1f} с{status}, доставлено {result['delivered']} "
+            f"({result['msg_per_second']:.1f} сообщений/с), не доставлено {result['lost']}"
+        )
+        print(
+            f"  Ответов 429: {result['rejected_429']}, 403: {result['rejected_403']}, "
+            f"впустую потраченных повторов: {result['wasted_retries']}"
+        )
+
+    print(f"\n{'Команда':<15} {'время, с':>9} {'сообщ./с':>9} {'доставлено':>11} {'потеряно':>9} "
+          f"{'429':>6} {'403':>6} {'повторы':>8}")
+    for result in results:
+        print(
+            f"{result['command']:<15} {result['seconds']:>9.1f} {result['msg_per_second']:>9.1f} "
+            f"{result['delivered']:>11} {result['lost']:>9} {result['rejected_429']:>6} "
+            f"{result['rejected_403']:>6} {result['wasted_retries']:>8}"
+        )
+
+    await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер массовых команд бота с лимитами Telegram")
+    parser.add_argument("--api-host", default="127.0.0.1")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--db", default="bench_bot.db",
+                        help="отдельная база бота (DB_FILE в его конфигурации), в которую добавляются пользователи")
+    parser.add_argument("--creator-id", type=int, default=1, help="CREATOR_ID из конфигурации бота")
+    parser.add_argument("--users", type=int, default=1000, help="количество получателей")
+    parser.add_argument("--first-user-id", type=int, default=10_000_000)
+    parser.add_argument("--blocked-rate", type=float, default=0.05, help="доля пользователей, заблокировавших бота")
+    parser.add_argument("--chat-rate", type=float, default=1, help="лимит сообщений в секунду в один чат")
+    parser.add_argument("--global-rate", type=float, default=30, help="лимит сообщений в секунду всего")
+    parser.add_argument("--latency", type=float, default=0, help="задержка ответа Bot API, мс")
+    parser.add_argument("--jitter", type=float, default=0, help="случайная добавка к задержке, мс")
+    parser.add_argument("--commands", default=DEFAULT_COMMANDS, help="команды через запятую")
+    parser.add_argument("--pause", type=float, default=3.0, help="пауза между командами, с")
+    parser.add_argument("--idle-timeout", type=float, default=10.0,
+                        help="сколько ждать отправок бота, прежде чем считать команду прерванной, с")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+"""
+Микробенчмарки функций database.py на заполненной базе
+
+Создает отдельную базу с заданным объемом данных (пользователи, балансы,
+достижения, баны, тикеты, миллионы строк логов), замеряет время вызова
+публичных функций database.py и сохраняет результаты в JSON. Результаты
+разных коммитов сравниваются параметром --compare, поэтому эффект изменений
+подключений, индексов и кэшей можно измерить, а не угадывать.
+
+Заполненная база переиспользуется, пока параметры заполнения не меняются.
+Замеры идут на ее копии, так что функции, меняющие данные, не влияют на
+следующие запуски, и сравниваемые коммиты работают с одинаковыми данными:
+    python benchmarks/db_bench.py --users 100000 --log-rows 3000000 --output before.json
+    git checkout feature
+    python benchmarks/db_bench.py --users 100000 --log-rows 3000000 --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import database  # noqa: E402
+
+
+# Таблицы логов и их доля в общем числе строк логов
+LOG_TABLE_SHARES = {
+    "user_logs": 0.55,
+    "transfer_logs": 0.15,
+    "ai_requests": 0.1,
+    "admin_logs": 0.05,
+    "admin_command_logs": 0.05,
+    "system_logs": 0.05,
+    "error_logs": 0.05
+}
+
+# Строк в одной пачке executemany при заполнении
+SEED_BATCH_SIZE = 50000
+
+# Начальный id синтетических пользователей
+FIRST_USER_ID = 10_000_000
+
+USER_ACTIONS = ("Команда /start", "Команда /profile", "Команда /top", "Команда /transfer", "Команда /ai")
+ERROR_TYPES = ("SEND_MESSAGE", "AI_REQUEST", "WEBHOOK_UPDATE", "BROADCAST")
+
+
+# ========== ЗАПОЛНЕНИЕ БАЗЫ ==========
+
+def seed_params(args) -> dict:
+    return {
+        "users": args.users,
+        "achievements": args.achievements,
+        "achievements_per_user": args.achievements_per_user,
+        "banned": args.banned,
+        "temp_bans": args.temp_bans,
+        "admins": args.admins,
+        "tickets": args.tickets,
+        "log_rows": args.log_rows,
+        "days": args.days,
+        "seed": args.seed
+    }
+
+
+def batched(rows, size: int = SEED_BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert_rows(conn, table: str, columns: str, rows):
+    placeholders = ", ".join("?" for _ in columns.split(","))
+    count = 0
+    for batch in batched(rows):
+        conn.executemany(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", batch)
+        count += len(batch)
+    return count
+
+
+def seed_database(path: str, params: dict):
+    """
+    Создает базу по текущей схеме и заполняет ее синтетическими данными
+
+    Таблицы заполняются до создания индексов и FTS: init_database() строит их
+    уже по готовым данным, так заполнение миллионов строк идет в разы быстрее.
+    """
+    remove_database(path)
+
+    rng = random.Random(params["seed"])
+    now = int(time.time())
+    start = now - params["days"] * 86400
+    user_ids = range(FIRST_USER_ID, FIRST_USER_ID + params["users"])
+
+    def timestamp():
+        return rng.randint(start, now)
+
+    def user_id():
+        return FIRST_USER_ID + rng.randrange(params["users"])
+
+    # Режим журнала не задается: его, как и у бота, выставляет init_database()
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous = OFF")
+    for table, schema in database.TABLE_SCHEMAS.items():
+        conn.execute(schema.format(table=table))
+    # База создана сразу по актуальной схеме, миграции init_database не нужны
+    conn.execute(f"PRAGMA user_version = {database.SCHEMA_VERSION}")
+
+    insert_rows(conn, "users", "user_id, full_name, username, first_start", (
+        (uid, f"User {uid}", f"user{uid}", timestamp()) for uid in user_ids
+    ))
+    insert_rows(conn, "user_names", "user_id, full_name, username, first_seen", (
+        (uid, f"User {uid}", f"user{uid}", start) for uid in user_ids
+    ))
+    insert_rows(conn, "balances", "user_id, balance", (
+        (uid, int(rng.paretovariate(1.2) * 10)) for uid in user_ids
+    ))
+    insert_rows(conn, "achievements", "ach_id, ach_name, created", (
+        (f"ach{i}", f"Достижение {i}", start) for i in range(params["achievements"])
+    ))
+    if params["achievements"]:
+        insert_rows(conn, "user_achievements", "user_id, ach_id, given_date, given_by", (
+            (user_id(), f"ach{rng.randrange(params['achievements'])}", timestamp(), "bench")
+            for _ in range(params["users"] * params["achievements_per_user"])
+        ))
+    insert_rows(conn, "admins", "admin_id, full_name, username, added_date", (
+        (uid, f"User {uid}", f"user{uid}", start) for uid in user_ids[:params["admins"]]
+    ))
+    banned = rng.sample(user_ids, min(params["banned"] + params["temp_bans"], params["users"]))
+    insert_rows(conn, "blacklist", "user_id, full_name, username, banned_date, banned_by", (
+        (uid, f"User {uid}", f"user{uid}", timestamp(), "bench") for uid in banned[:params["banned"]]
+    ))
+    insert_rows(conn, "temp_bans", "user_id, unban_time, reason, banned_by, banned_at", (
+        (uid, now + rng.randint(3600, 30 * 86400), "bench", FIRST_USER_ID, timestamp())
+        for uid in banned[params["banned"]:]
+    ))
+    # Закрытые тикеты и по одному открытому на пользователя из начала диапазона
+    insert_rows(conn, "support_tickets", "user_id, status, admin_id, created_at, closed_at, updated_at", (
+        (uid, status, FIRST_USER_ID if status == "closed" else None, ts, ts if status == "closed" else None, ts)
+        for i, uid in enumerate(user_ids[:params["tickets"]])
+        for status, ts in (("closed", timestamp()), ("open" if i % 2 else "closed", now))
+    ))
+
+    for table, share in LOG_TABLE_SHARES.items():
+        count = int(params["log_rows"] * share)
+        # Время растет вместе с id, как у настоящих логов
+        stamps = sorted(timestamp() for _ in range(count))
+        if table in ("user_logs", "admin_logs"):
+            rows = ((user_id(), ts, rng.choice(USER_ACTIONS)) for ts in stamps)
+            insert_rows(conn, table, "user_id, timestamp, action", rows)
+        elif table == "admin_command_logs":
+            rows = ((user_id(), ts, "/stats") for ts in stamps)
+            insert_rows(conn, table, "user_id, timestamp, command", rows)
+        elif table == "system_logs":
+            rows = (("system", ts, "Проверка временных банов") for ts in stamps)
+            insert_rows(conn, table, "initiator, timestamp, action", rows)
+        elif table == "error_logs":
+            rows = ((rng.choice(ERROR_TYPES), ts, "Ошибка отправки", "bench") for ts in stamps)
+            insert_rows(conn, table, "error_type, timestamp, error_message, context", rows)
+        elif table == "transfer_logs":
+            rows = ((ts, uid, user_id(), rng.randint(1, 100), f"User {uid}", "User")
+                    for ts, uid in ((ts, user_id()) for ts in stamps))
+            insert_rows(conn, table, "timestamp, from_user_id, to_user_id, amount, from_name, to_name", rows)
+        elif table == "ai_requests":
+            rows = ((user_id(), ts, "Вопрос", "Ответ", 10, 20, 30, "deepseek-chat", 1) for ts in stamps)
+            insert_rows(conn, table, "user_id, timestamp, request_text, response_text, prompt_tokens, "
+                                     "completion_tokens, total_tokens, model, success", rows)
+
+    conn.commit()
+    conn.close()
+
+    # Индексы и FTS создаются по уже заполненным таблицам
+    database.init_database()
+
+
+def prepare_database(path: str, params: dict, reseed: bool):
+    """Заполняет базу, если ее нет или она заполнена с другими параметрами"""
+    meta_path = path + ".seed.json"
+    if not reseed and os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            if json.load(f) == params:
+                database.init_database()
+                print(f"Используется заполненная база {path}")
+                return
+
+    print(f"Заполнение базы {path}...")
+    started = time.perf_counter()
+    seed_database(path, params)
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(params, f)
+    print(f"База заполнена за {time.perf_counter() - started:.1f} с")
+
+
+def remove_database(path: str):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def make_scratch_copy(path: str) -> str:
+    """Копирует заполненную базу во временный файл, на котором идут замеры"""
+    scratch_path = path + ".scratch"
+    remove_database(scratch_path)
+    source = sqlite3.connect(path)
+    target = sqlite3.connect(scratch_path)
+    source.backup(target)
+    target.close()
+    source.close()
+    return scratch_path
+
+
+# ========== ЗАМЕРЫ ==========
+
+class Case:
+    """
+    Замер одной функции
+
+    args() возвращает аргументы очередного вызова, setup() выполняется перед
+    каждым вызовом и в замер не входит (например, создает истекшие баны).
+    """
+
+    def __init__(self, name: str, func: Callable, args: Callable = tuple, setup: Optional[Callable] = None,
+                 repeat: Optional[int] = None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.setup = setup
+        self.repeat = repeat
+
+
+def build_cases(params: dict, rng: random.Random) -> List[Case]:
+    users = params["users"]
+    now = int(time.time())
+
+    def user_id():
+        return FIRST_USER_ID + rng.randrange(users)
+
+    def insert_expired_temp_bans(count: int = 100):
+        conn = database.get_db_connection()
+        conn.executemany(
+            "INSERT OR REPLACE INTO temp_bans (user_id, unban_time, reason, banned_by, banned_at) "
+            "VALUES (?, ?, 'bench', 0, ?)",
+            [(user_id(), now - 60, now - 3600) for _ in range(count)]
+        )
+        conn.commit()
+        conn.close()
+
+    def uncached_user():
+        uid = user_id()
+        database.invalidate_user_card(uid)
+        return (uid,)
+
+    cases = [
+        # Пользователи
+        Case("is_banned", database.is_banned, lambda: (user_id(),)),
+        Case("is_admin", database.is_admin, lambda: (user_id(),)),
+        Case("is_temp_banned", database.is_temp_banned, lambda: (user_id(),)),
+        Case("get_user_profile", database.get_user_profile, lambda: (user_id(),)),
+        Case("get_user_balance", database.get_user_balance, lambda: (user_id(),)),
+        Case("get_user_achievements", database.get_user_achievements, lambda: (user_id(),)),
+        Case("get_user_name_history", database.get_user_name_history, lambda: (user_id(),)),
+        Case("get_user_by_id_or_username[id]", database.get_user_by_id_or_username, lambda: (str(user_id()),)),
+        Case("get_user_by_id_or_username[username]", database.get_user_by_id_or_username,
+             lambda: (f"@USER{user_id()}",)),
+        Case("load_user_card", database.load_user_card, lambda: (user_id(),)),
+        Case("get_user_card[cold]", database.get_user_card, uncached_user),
+        Case("get_user_card[warm]", database.get_user_card, lambda: (FIRST_USER_ID,)),
+        Case("register_user[unchanged]", database.register_user,
+             lambda: (lambda uid: (uid, f"User {uid}", f"user{uid}", now))(user_id())),
+        Case("get_all_users", database.get_all_users, repeat=5),
+        Case("get_total_users_count", database.get_total_users_count),
+        Case("get_new_users_last_24h", database.get_new_users_last_24h),
+        # Балансы
+        Case("get_top_users_by_balance", database.get_top_users_by_balance, lambda: (10,)),
+        Case("get_top_users_with_names", database.get_top_users_with_names, lambda: (20,)),
+        Case("get_top_users_cached", database.get_top_users_cached, lambda: (20,)),
+        Case("add_user_balance", database.add_user_balance, lambda: (user_id(), 1)),
+        # Администраторы, баны и достижения
+        Case("get_all_admins", database.get_all_admins),
+        Case("get_all_banned_users", database.get_all_banned_users, repeat=20),
+        Case("get_temp_bans", database.get_temp_bans, repeat=20),
+        Case("remove_expired_temp_bans", database.remove_expired_temp_bans, setup=insert_expired_temp_bans),
+        Case("get_all_achievements", database.get_all_achievements),
+        Case("get_admins_count", database.get_admins_count),
+        Case("get_achievements_count", database.get_achievements_count),
+        # Тикеты
+        Case("get_ticket_counts", database.get_ticket_counts),
+        Case("get_tickets_page[open]", database.get_tickets_page, lambda: ("open",)),
+        Case("get_tickets_page[all]", database.get_tickets_page),
+        # Запись логов
+        Case("log_user_action", database.log_user_action,
+             lambda: (lambda uid: (uid, f"User {uid}", f"user{uid}", now, "Команда /bench"))(user_id())),
+        Case("log_transfer", database.log_transfer,
+             lambda: (now, user_id(), user_id(), 1, "User", "User")),
+        # Чтение логов
+        Case("get_last_logs[user_logs]", database.get_last_logs, lambda: ("user_logs", 20)),
+        Case("get_last_logs[ai_requests]", database.get_last_logs, lambda: ("ai_requests", 20)),
+        Case("get_last_logs[error_logs]", database.get_last_logs, lambda: ("error_logs", 20)),
+        Case("get_logs_page[user_logs]", database.get_logs_page, lambda: ("user_logs",)),
+        Case("get_logs_page[user_logs,user]", database.get_logs_page,
+             lambda: ("user_logs", None, None, 20, user_id())),
+        Case("get_logs_page[user_logs,since]", database.get_logs_page,
+             lambda: ("user_logs", None, None, 20, None, None, now - 7 * 86400)),
+        Case("get_logs_page[error_logs,type]", database.get_logs_page,
+             lambda: ("error_logs", None, None, 20, None, rng.choice(ERROR_TYPES))),
+        Case("get_user_ai_stats", database.get_user_ai_stats, lambda: (user_id(),)),
+        Case("get_all_ai_stats", database.get_all_ai_stats, repeat=5),
+        Case("get_logs_statistics", database.get_logs_statistics, repeat=5)
+    ]
+    if database.is_fts_available():
+        cases.append(Case("search_logs", database.search_logs, lambda: (rng.choice(USER_ACTIONS).split()[-1],)))
+    return cases
+
+
+def percentile(values: List[float], percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def run_case(case: Case, repeat: int, max_seconds: float) -> dict:
+    """Вызывает функцию repeat раз (но не дольше max_seconds) после одного прогревочного вызова"""
+    if case.setup:
+        case.setup()
+    case.func(*case.args())
+
+    timings = []
+    budget_end = time.perf_counter() + max_seconds
+    for _ in range(case.repeat or repeat):
+        if case.setup:
+            case.setup()
+        args = case.args()
+        started = time.perf_counter()
+        case.func(*args)
+        timings.append(time.perf_counter() - started)
+        if time.perf_counter() > budget_end:
+            break
+
+    return {
+        "calls": len(timings),
+        "mean_ms": sum(timings) / len(timings) * 1000,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p95_ms": percentile(timings, 95) * 1000,
+        "min_ms": min(timings) * 1000,
+        "max_ms": max(timings) * 1000
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: Dict[str, dict], baseline: Optional[Dict[str, dict]]):
+    header = f"{'Функция':<40} {'вызовов':>8} {'p50, мс':>10} {'p95, мс':>10}"
+    print("\n" + header + ("   p50 к базе" if baseline else ""))
+    for name, result in results.items():
+        line = f"{name:<40} {result['calls']:>8} {result['p50_ms']:>10.3f} {result['p95_ms']:>10.3f}"
+        old = baseline.get(name) if baseline else None
+        if old and old["p50_ms"]:
+            line += f"   x{result['p50_ms'] / old['p50_ms']:.2f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки функций database.py")
+    parser.add_argument("--db", default=os.path.join(REPO_DIR, "bench_database.db"),
+                        help="файл базы для замеров (рабочая bot_database.db не затрагивается)")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--achievements", type=int, default=50, help="количество достижений")
+    parser.add_argument("--achievements-per-user", type=int, default=2, help="выданных достижений на пользователя")
+    parser.add_argument("--banned", type=int, default=1000, help="пользователей в черном списке")
+    parser.add_argument("--temp-bans", type=int, default=1000, help="действующих временных банов")
+    parser.add_argument("--admins", type=int, default=20)
+    parser.add_argument("--tickets", type=int, default=10_000, help="пользователей с тикетами")
+    parser.add_argument("--log-rows", type=int, default=3_000_000, help="строк логов во всех таблицах")
+    parser.add_argument("--days", type=int, default=365, help="за сколько дней распределены данные")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reseed", action="store_true", help="заполнить базу заново")
+    parser.add_argument("--repeat", type=int, default=200, help="вызовов каждой функции")
+    parser.add_argument("--max-seconds", type=float, default=3.0, help="предел времени замера одной функции, с")
+    parser.add_argument("--only", default=None, help="замерять только функции, имя которых содержит подстроку")
+    parser.add_argument("--output", default=None, help="файл JSON с результатами")
+    parser.add_argument("--compare", default=None, help="JSON с результатами предыдущего запуска для сравнения")
+    args = parser.parse_args()
+
+    database.DB_FILE = args.db
+    params = seed_params(args)
+    prepare_database(args.db, params, args.reseed)
+    database.DB_FILE = make_scratch_copy(args.db)
+
+    rng = random.Random(args.seed)
+    results = {}
+    try:
+        for case in build_cases(params, rng):
+            if args.only and args.only not in case.name:
+                continue
+            results[case.name] = run_case(case, args.repeat, args.max_seconds)
+            print(f"{case.name}: p50 {results[case.name]['p50_ms']:.3f} мс")
+    finally:
+        remove_database(database.DB_FILE)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+
+    if args.output:
+        report = {
+            "commit": git_commit(),
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "db_size": os.path.getsize(args.db),
+            "params": params,
+            "results": results
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nРезультаты сохранены в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
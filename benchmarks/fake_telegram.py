@@ -0,0 +1,548 @@
+"""
+Локальный стенд Telegram для нагрузочного тестирования бота без сети
+
+Поднимает заглушку Bot API (getUpdates, sendMessage, editMessageText, getChat,
+answerCallbackQuery и остальные методы) с настраиваемой задержкой и долей
+ответов 429, а также заглушку DeepSeek API для /ai. Генератор нагрузки
+отправляет боту смесь /start, /profile, /transfer, /ai и нажатий inline-кнопок
+от N синтетических пользователей и считает время до первого ответа бота.
+
+Бот запускается отдельно (после стенда) с конфигурацией, указывающей на него:
+    bench_config.json:
+    {
+      "BOT_TOKEN": "123456:TEST",
+      "CREATOR_ID": 1,
+      "API_SERVER": "http://127.0.0.1:8081",
+      "DB_FILE": "bench_bot.db",
+      "METRICS_PORT": 9100
+    }
+    bench_configai.json:
+    {"API_KEY": "test", "API_URL": "http://127.0.0.1:8081/v1/chat/completions"}
+
+    BOT_CONFIG_FILE=bench_config.json BOT_AI_CONFIG_FILE=bench_configai.json python bot.py
+
+Режим polling (по умолчанию) отдает апдейты через getUpdates. Для режима webhook
+в конфигурацию бота добавляется WEBHOOK, а стенд запускается с --mode webhook:
+    python benchmarks/fake_telegram.py --updates 5000 --users 200 --db bench_bot.db \\
+        --metrics-url http://127.0.0.1:9100/metrics
+"""
+import argparse
+import asyncio
+import itertools
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+from collections import Counter, defaultdict, deque
+from typing import Dict, List, Optional, Set
+
+import aiohttp
+from aiohttp import web
+
+
+# Методы, которые возвращают отправленное сообщение
+MESSAGE_METHODS = {
+    "sendMessage",
+    "editMessageText",
+    "sendDocument",
+    "sendPhoto",
+    "forwardMessage",
+    "copyMessage"
+}
+
+# Методы, которыми бот отвечает пользователю (по первому из них считается задержка ответа)
+REPLY_METHODS = MESSAGE_METHODS | {"answerCallbackQuery"}
+
+# Смесь апдейтов по умолчанию: вид=вес
+DEFAULT_MIX = "/start=3,/profile=3,/transfer=2,/ai=1,callback=2"
+
+# Данные inline-кнопок, которые нажимают синтетические пользователи
+DEFAULT_CALLBACKS = "ticket_add_1,logs_u_o_1000_0"
+
+# Таблицы, изменения в которых показываются в отчете при указании --db
+DB_TABLES = ("users", "balances", "user_names", "user_logs", "transfer_logs", "ai_requests", "error_logs")
+
+
+class FakeBotAPI:
+    """
+    Заглушка Bot API
+
+    Принимает запросы вида /bot{token}/{method} и отвечает как Telegram:
+    сообщением для методов отправки, пользователем для getMe/getChat,
+    апдейтами из очереди для getUpdates и True для остальных. Как Telegram,
+    ограничивает частоту отправки в чат и общую (ответ 429 с retry_after)
+    и отвечает 403 на отправку заблокировавшим бота. Считает вызовы
+    по методам и время от выдачи апдейта до первого ответа бота этому пользователю.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, flood_rate: float = 0.0,
+                 retry_after: int = 1, ai_latency: float = 0.5, seed: int = 0,
+                 chat_rate: float = 0.0, global_rate: float = 0.0, blocked: Optional[Set[int]] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.ai_latency = ai_latency
+        # Лимиты Telegram: сообщений в секунду в один чат и всего (0 - без лимита)
+        self.chat_rate = chat_rate
+        self.global_rate = global_rate
+        # Пользователи, заблокировавшие бота (на отправку им отвечает 403)
+        self.blocked = blocked or set()
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.flood_errors = Counter()
+        self.forbidden_errors = Counter()
+        # Время последней отправки в чат и отправки за последнюю секунду для лимитов
+        self.chat_last_sent: Dict[int, float] = {}
+        self.recent_sends: deque = deque()
+        self.message_ids = itertools.count(1)
+        # Апдейты для getUpdates
+        self.updates: asyncio.Queue = asyncio.Queue()
+        # Время выдачи апдейтов, ожидающих ответа: {chat_id: deque}
+        self.waiting: Dict[int, deque] = defaultdict(deque)
+        self.latencies: List[float] = []
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/bot{token}/{method}", self.handle)
+        app.router.add_post("/v1/chat/completions", self.handle_ai)
+        return app
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        runner = web.AppRunner(self.make_app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    def delivered(self, chat_id: int):
+        """Отмечает, что апдейт пользователя передан боту"""
+        self.waiting[chat_id].append(time.perf_counter())
+
+    def replied(self, chat_id: int):
+        """Отмечает ответ бота пользователю: первый ответ на апдейт дает задержку"""
+        waiting = self.waiting.get(chat_id)
+        if waiting:
+            self.latencies.append(time.perf_counter() - waiting.popleft())
+
+    def responded_count(self) -> int:
+        return len(self.latencies)
+
+    async def read_params(self, request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        return dict(await request.post())
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self.read_params(request)
+        self.calls[method] += 1
+
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self.get_updates(params)})
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.rng.random() * self.jitter)
+
+        if method in REPLY_METHODS:
+            chat_id = self.reply_chat_id(method, params)
+            error = self.check_limits(method, chat_id)
+            if error is not None:
+                return error
+            self.sent(method, chat_id, params)
+        return web.json_response({"ok": True, "result": self.result(method, params)})
+
+    def check_limits(self, method: str, chat_id: int) -> Optional[web.Response]:
+        """Ответ с ошибкой, если отправка в чат запрещена или превышает лимиты, иначе None"""
+        if chat_id in self.blocked and method in MESSAGE_METHODS:
+            self.forbidden(chat_id)
+            return web.json_response({
+                "ok": False,
+                "error_code": 403,
+                "description": "Forbidden: bot was blocked by the user"
+            }, status=403)
+
+        if self.flood_rate and self.rng.random() < self.flood_rate:
+            return self.too_many_requests(method, chat_id, self.retry_after)
+
+        if method not in MESSAGE_METHODS:
+            return None
+        now = time.perf_counter()
+        if self.chat_rate:
+            wait = self.chat_last_sent.get(chat_id, 0.0) + 1 / self.chat_rate - now
+            if wait > 0:
+                return self.too_many_requests(method, chat_id, wait)
+        if self.global_rate:
+            while self.recent_sends and self.recent_sends[0] <= now - 1:
+                self.recent_sends.popleft()
+            if len(self.recent_sends) >= self.global_rate:
+                return self.too_many_requests(method, chat_id, self.recent_sends[0] + 1 - now)
+            self.recent_sends.append(now)
+        self.chat_last_sent[chat_id] = now
+        return None
+
+    def too_many_requests(self, method: str, chat_id: int, wait: float) -> web.Response:
+        # Telegram отдает retry_after целым числом секунд
+        retry_after = max(1, math.ceil(wait))
+        self.flood_errors[method] += 1
+        self.flooded(chat_id, retry_after)
+        return web.json_response({
+            "ok": False,
+            "error_code": 429,
+            "description": f"Too Many Requests: retry after {retry_after}",
+            "parameters": {"retry_after": retry_after}
+        }, status=429)
+
+    def sent(self, method: str, chat_id: int, params: dict):
+        """Успешная отправка пользователю"""
+        self.replied(chat_id)
+
+    def flooded(self, chat_id: int, retry_after: int):
+        """Отправка отклонена с 429"""
+
+    def forbidden(self, chat_id: int):
+        """Отправка пользователю, заблокировавшему бота"""
+        self.forbidden_errors[chat_id] += 1
+
+    def reply_chat_id(self, method: str, params: dict) -> int:
+        if method == "answerCallbackQuery":
+            # ID нажатия имеет вид "{user_id}:{номер}"
+            return int(str(params.get("callback_query_id", "0")).split(":", 1)[0])
+        return int(params.get("chat_id", 0))
+
+    async def get_updates(self, params: dict) -> list:
+        """Long polling: ждет апдейты до timeout секунд и отдает до limit штук"""
+        limit = int(params.get("limit", 100))
+        timeout = float(params.get("timeout", 0))
+        result = []
+        try:
+            result.append(await asyncio.wait_for(self.updates.get(), timeout=max(timeout, 0.01)))
+        except asyncio.TimeoutError:
+            return []
+        while len(result) < limit and not self.updates.empty():
+            result.append(self.updates.get_nowait())
+        # Апдейты выдаются один раз, поэтому offset бота можно не учитывать
+        for update in result:
+            self.delivered(update_user_id(update))
+        return result
+
+    async def handle_ai(self, request: web.Request) -> web.Response:
+        """Заглушка DeepSeek chat/completions с фиксированной задержкой"""
+        await request.json()
+        self.calls["chat/completions"] += 1
+        await asyncio.sleep(self.ai_latency)
+        return web.json_response({
+            "choices": [{"message": {"role": "assistant", "content": "Тестовый ответ"}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+        })
+
+    def result(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        if method == "getChat":
+            chat_id = int(params.get("chat_id", 0))
+            return {"id": chat_id, "type": "private", "first_name": f"User{chat_id}"}
+        if method in MESSAGE_METHODS:
+            chat_id = int(params.get("chat_id", 0))
+            return {
+                "message_id": int(params.get("message_id", 0)) or next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", "")
+            }
+        return True
+
+
+def make_user(user_id: int) -> dict:
+    return {
+        "id": user_id,
+        "is_bot": False,
+        "first_name": f"User{user_id}",
+        "username": f"user{user_id}"
+    }
+
+
+def make_message_update(update_id: int, user_id: int, text: str) -> dict:
+    """Создает апдейт с текстовым сообщением от пользователя"""
+    user = make_user(user_id)
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": text
+        }
+    }
+
+
+def make_callback_update(update_id: int, user_id: int, data: str) -> dict:
+    """Создает апдейт с нажатием inline-кнопки под сообщением бота"""
+    user = make_user(user_id)
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": f"{user_id}:{update_id}",
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+                "from": {"id": 123456, "is_bot": True, "first_name": "FakeBot"},
+                "text": "Сообщение бота"
+            }
+        }
+    }
+
+
+def update_user_id(update: dict) -> int:
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"]["id"]
+    return 0
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """Разбирает смесь вида "/start=3,/profile=1" в {вид: вес}"""
+    weights = {}
+    for item in mix.split(","):
+        kind, _, weight = item.partition("=")
+        weights[kind.strip()] = float(weight or 1)
+    return weights
+
+
+def build_updates(args) -> List[dict]:
+    """Генерирует апдейты по смеси из аргументов"""
+    rng = random.Random(args.seed)
+    weights = parse_mix(args.mix)
+    kinds = list(weights)
+    callbacks = args.callbacks.split(",")
+    updates = []
+    for i in range(args.updates):
+        update_id = args.first_update_id + i
+        user_id = args.first_user_id + rng.randrange(args.users)
+        kind = rng.choices(kinds, weights=[weights[kind] for kind in kinds])[0]
+        if kind == "callback":
+            updates.append(make_callback_update(update_id, user_id, rng.choice(callbacks)))
+        elif kind == "/transfer":
+            recipient = args.first_user_id + rng.randrange(args.users)
+            updates.append(make_message_update(update_id, user_id, f"/transfer 1 {recipient}"))
+        elif kind == "/ai":
+            updates.append(make_message_update(update_id, user_id, "/ai Тестовый вопрос"))
+        else:
+            updates.append(make_message_update(update_id, user_id, kind))
+    return updates
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Перцентиль по отсортированной выборке (0, если выборка пуста)"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def seed_database(db_path: str, user_ids: List[int], balance: int):
+    """Регистрирует синтетических пользователей и выдает им баланс для /transfer"""
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import database
+
+    database.DB_FILE = db_path
+    database.init_database()
+    now = int(time.time())
+    for user_id in user_ids:
+        database.register_user(user_id, f"User{user_id}", f"user{user_id}", now)
+        database.set_user_balance(user_id, balance)
+
+
+def count_rows(db_path: str) -> Dict[str, int]:
+    """Количество строк в таблицах отчета (для подсчета записей бота)"""
+    conn = sqlite3.connect(db_path)
+    counts = {}
+    for table in DB_TABLES:
+        try:
+            counts[table] = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        except sqlite3.Error:
+            counts[table] = 0
+    conn.close()
+    return counts
+
+
+async def scrape_db_writes(url: str) -> Dict[str, float]:
+    """Число выполненных INSERT/UPDATE/DELETE по метрикам бота (bot_db_query_duration_seconds_count)"""
+    writes = Counter()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                text = await response.text()
+    except aiohttp.ClientError:
+        return {}
+    for line in text.splitlines():
+        if not line.startswith("bot_db_query_duration_seconds_count"):
+            continue
+        for operation in ("INSERT", "UPDATE", "DELETE", "REPLACE"):
+            if f'operation="{operation}"' in line:
+                writes[operation] += float(line.rsplit(" ", 1)[1])
+    return dict(writes)
+
+
+async def wait_for_replies(api: FakeBotAPI, expected: int, idle_timeout: float) -> float:
+    """Ждет, пока бот ответит на expected апдейтов или перестанет отвечать; возвращает время последнего ответа"""
+    last_count = -1
+    last_change = time.perf_counter()
+    while True:
+        count = api.responded_count()
+        if count != last_count:
+            last_count = count
+            last_change = time.perf_counter()
+        if count >= expected or time.perf_counter() - last_change > idle_timeout:
+            return last_change
+        await asyncio.sleep(0.05)
+
+
+async def post_updates(api: FakeBotAPI, url: str, updates: List[dict], secret: Optional[str],
+                       concurrency: int, rate: float):
+    """Отправляет апдейты в webhook с ограничением параллельности и темпа; возвращает коды ответа"""
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    statuses = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+
+    async with aiohttp.ClientSession() as session:
+        async def post(index: int, update: dict):
+            if rate:
+                await asyncio.sleep(max(0.0, started + index / rate - time.perf_counter()))
+            async with semaphore:
+                api.delivered(update_user_id(update))
+                try:
+                    async with session.post(url, json=update, headers=headers) as response:
+                        await response.read()
+                        statuses[response.status] += 1
+                except aiohttp.ClientError:
+                    statuses["error"] += 1
+
+        await asyncio.gather(*(post(index, update) for index, update in enumerate(updates)))
+
+    return statuses
+
+
+async def queue_updates(api: FakeBotAPI, updates: List[dict], rate: float):
+    """Кладет апдейты в очередь getUpdates с заданным темпом (0 - все сразу)"""
+    started = time.perf_counter()
+    for index, update in enumerate(updates):
+        if rate:
+            await asyncio.sleep(max(0.0, started + index / rate - time.perf_counter()))
+        api.updates.put_nowait(update)
+
+
+async def run(args):
+    api = FakeBotAPI(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        flood_rate=args.flood_rate,
+        retry_after=args.retry_after,
+        ai_latency=args.ai_latency / 1000,
+        seed=args.seed,
+        chat_rate=args.chat_rate,
+        global_rate=args.global_rate
+    )
+    runner = await api.start(args.api_host, args.api_port)
+    print(f"Заглушка Bot API: http://{args.api_host}:{args.api_port}")
+
+    updates = build_updates(args)
+    user_ids = sorted({update_user_id(update) for update in updates})
+    if args.db:
+        seed_database(args.db, user_ids, args.seed_balance)
+        print(f"В {args.db} зарегистрировано пользователей: {len(user_ids)}")
+
+    # Бот при старте вызывает getUpdates (polling) или setWebhook: ждем этого и сбрасываем счетчики запуска
+    startup_method = "setWebhook" if args.mode == "webhook" else "getUpdates"
+    print(f"Ожидание запуска бота ({startup_method})...")
+    while not api.calls[startup_method]:
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(args.warmup)
+    api.calls.clear()
+
+    rows_before = count_rows(args.db) if args.db else {}
+    writes_before = await scrape_db_writes(args.metrics_url) if args.metrics_url else {}
+
+    started = time.perf_counter()
+    if args.mode == "webhook":
+        statuses = await post_updates(api, args.webhook, updates, args.secret, args.concurrency, args.rate)
+    else:
+        await queue_updates(api, updates, args.rate)
+        statuses = Counter({"queued": len(updates)})
+    delivered = time.perf_counter() - started
+
+    last_reply = await wait_for_replies(api, len(updates), args.idle_timeout)
+    total = max(last_reply - started, delivered)
+    responded = api.responded_count()
+
+    print(f"\nАпдейтов отправлено: {len(updates)} ({dict(statuses)}), режим {args.mode}")
+    print(f"Пользователей: {len(user_ids)}, смесь: {args.mix}")
+    print(f"Апдейтов с ответом: {responded} за {total:.2f} с ({responded / total:.1f} апдейтов/с)")
+    print(f"Время до первого ответа: p50 {percentile(api.latencies, 50) * 1000:.1f} мс, "
+          f"p99 {percentile(api.latencies, 99) * 1000:.1f} мс")
+    if api.flood_errors:
+        print(f"Ответов 429: {dict(api.flood_errors)}")
+    print(f"Вызовы Bot API: {dict(api.calls)}")
+
+    if args.metrics_url:
+        writes_after = await scrape_db_writes(args.metrics_url)
+        writes = {
+            operation: int(writes_after.get(operation, 0) - writes_before.get(operation, 0))
+            for operation in writes_after
+        }
+        print(f"Запросов записи в БД (по метрикам бота): {writes}")
+    if args.db:
+        rows_after = count_rows(args.db)
+        print("Новых строк в БД: " + ", ".join(
+            f"{table} {rows_after[table] - rows_before[table]:+d}" for table in DB_TABLES
+        ))
+
+    await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн нагрузочный стенд бота с заглушкой Bot API")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling",
+                        help="как бот получает апдейты: getUpdates или webhook")
+    parser.add_argument("--webhook", default="http://127.0.0.1:8080/webhook", help="URL webhook бота")
+    parser.add_argument("--secret", default=None, help="WEBHOOK.SECRET_TOKEN из конфигурации бота")
+    parser.add_argument("--api-host", default="127.0.0.1")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--updates", type=int, default=1000, help="количество апдейтов")
+    parser.add_argument("--users", type=int, default=100, help="количество синтетических пользователей")
+    parser.add_argument("--first-user-id", type=int, default=10_000_000)
+    parser.add_argument("--first-update-id", type=int, default=1)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="смесь апдейтов: вид=вес через запятую")
+    parser.add_argument("--callbacks", default=DEFAULT_CALLBACKS, help="callback_data нажатий через запятую")
+    parser.add_argument("--rate", type=float, default=0, help="темп отправки, апдейтов/с (0 - без ограничения)")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных POST запросов (webhook)")
+    parser.add_argument("--latency", type=float, default=0, help="задержка ответа Bot API, мс")
+    parser.add_argument("--jitter", type=float, default=0, help="случайная добавка к задержке, мс")
+    parser.add_argument("--flood-rate", type=float, default=0, help="доля ответов 429 на методы отправки (0..1)")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, с")
+    parser.add_argument("--chat-rate", type=float, default=0, help="лимит сообщений в секунду в один чат (0 - нет)")
+    parser.add_argument("--global-rate", type=float, default=0, help="лимит сообщений в секунду всего (0 - нет)")
+    parser.add_argument("--ai-latency", type=float, default=500, help="задержка заглушки DeepSeek, мс")
+    parser.add_argument("--db", default=None,
+                        help="отдельная база бота (DB_FILE в его конфигурации): пользователи регистрируются "
+                             "с балансом, в отчете - новые строки")
+    parser.add_argument("--seed-balance", type=int, default=1000, help="баланс синтетических пользователей")
+    parser.add_argument("--metrics-url", default=None, help="адрес /metrics бота для подсчета запросов записи")
+    parser.add_argument("--warmup", type=float, default=1.0, help="пауза после запуска бота, с")
+    parser.add_argument("--idle-timeout", type=float, default=5.0,
+                        help="сколько ждать новых ответов бота перед завершением, с")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
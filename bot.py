@@ -7,29 +7,69 @@ import os
 import json
 import asyncio
 import time
+import hashlib
+import multiprocessing
+import threading
+import tempfile
 import aiohttp
+from aiohttp import web
 from datetime import datetime, timedelta
 from typing import Optional, List, Tuple, Dict
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, Update
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 
 # Импорт TON Connect
 from tonutils.tonconnect import TonConnect
 from tonutils.tonconnect.utils.exceptions import TonConnectError, UserRejectsError
-from tonconnect_storage import FileStorage
+from tonconnect_storage import DatabaseStorage, import_file_storage
+from fsm_storage import SQLiteStorage
+from metrics import (
+    REGISTRY,
+    HANDLER_DURATION,
+    HANDLER_ERRORS,
+    HANDLERS_IN_FLIGHT,
+    DB_QUERY_DURATION,
+    AI_REQUEST_DURATION,
+    observe_db_query
+)
+from profiling import LoopMonitor, MemoryProfiler, CPUProfiler, get_rss, stack_location
+import database
 
 # Импорт функций для работы с базой данных
 from database import (
     init_database,
-    add_user,
     get_user_profile,
     get_all_users,
     get_user_by_id_or_username,
+    update_user_identity,
+    LRUCache,
+    CACHE_MISS,
     is_admin,
+    get_admin_ids,
+    add_query_listener,
+    set_query_profiling,
+    get_query_stats,
+    reset_query_stats,
+    flush_slow_queries,
+    get_slow_queries,
+    QUERY_PROFILING,
+    get_cache_sizes,
+    create_ticket,
+    get_ticket,
+    get_active_ticket,
+    assign_ticket,
+    take_next_ticket,
+    add_ticket_message,
+    close_ticket,
+    close_stale_tickets,
+    get_ticket_messages,
+    get_tickets_page,
+    get_ticket_counts,
     add_admin,
     remove_admin,
     get_all_admins,
@@ -38,17 +78,23 @@ from database import (
     unban_user as db_unban_user,
     get_all_banned_users,
     get_user_balance,
-    set_user_balance,
     add_user_balance,
     remove_user_balance,
-    get_top_users_by_balance,
+    transfer_balance,
+    get_top_users_cached,
     create_achievement,
     delete_achievement,
     get_all_achievements,
     add_user_achievement,
     get_user_achievements,
+    get_user_card,
+    register_cache_invalidator,
+    add_invalidation_listener,
+    apply_cache_invalidation,
+    invalidate_cache,
+    register_user,
     remove_achievement_from_user,
-    add_temp_ban,
+    add_temp_ban as db_add_temp_ban,
     get_temp_bans,
     is_temp_banned,
     remove_expired_temp_bans,
@@ -63,16 +109,26 @@ from database import (
     get_user_ai_stats,
     get_all_ai_stats,
     get_last_logs,
+    get_logs_page,
+    LOG_TABLES,
+    format_log_row,
+    search_logs,
+    is_fts_available,
+    export_logs,
     get_total_users_count,
     get_new_users_last_24h,
     get_admins_count,
     get_achievements_count,
-    get_logs_statistics
+    get_logs_statistics,
+    to_epoch,
+    format_timestamp,
+    archive_old_logs,
+    incremental_vacuum
 )
 
 # ========== КОНФИГУРАЦИЯ ==========
-# Загрузка конфигурации из config.json
-CONFIG_FILE = "config.json"
+# Загрузка конфигурации из config.json (путь можно переопределить переменной окружения BOT_CONFIG_FILE)
+CONFIG_FILE = os.environ.get("BOT_CONFIG_FILE", "config.json")
 
 def load_config():
     """Загружает конфигурацию из config.json"""
@@ -95,9 +151,71 @@ def load_config():
 config = load_config()
 BOT_TOKEN = config["BOT_TOKEN"]
 CREATOR_ID = config["CREATOR_ID"]
-
-# Загрузка конфигурации AI из configai.json
-AI_CONFIG_FILE = "configai.json"
+# Файл базы данных (например, отдельная база для нагрузочных стендов из benchmarks/)
+DB_FILE = config.get("DB_FILE", "bot_database.db")
+
+# Политика хранения логов: max_age_days и/или max_rows для каждой таблицы.
+# Старые записи выгружаются в LOG_ARCHIVE_DIR (gzip JSONL) и удаляются из базы.
+# Переопределяется ключом LOG_RETENTION в config.json
+DEFAULT_LOG_RETENTION = {
+    "user_logs": {"max_age_days": 180},
+    "admin_logs": {"max_age_days": 365},
+    "admin_command_logs": {"max_age_days": 365},
+    "system_logs": {"max_age_days": 180},
+    "error_logs": {"max_age_days": 90, "max_rows": 200000},
+    "transfer_logs": {"max_age_days": 730},
+    "ai_requests": {"max_age_days": 180}
+}
+LOG_RETENTION = {**DEFAULT_LOG_RETENTION, **config.get("LOG_RETENTION", {})}
+LOG_ARCHIVE_DIR = config.get("LOG_ARCHIVE_DIR", "log_archive")
+LOG_RETENTION_INTERVAL_HOURS = config.get("LOG_RETENTION_INTERVAL_HOURS", 6)
+
+# Срок хранения FSM состояний и срок бездействия, после которого тикет поддержки закрывается
+FSM_STATE_TTL_HOURS = config.get("FSM_STATE_TTL_HOURS", 24)
+SUPPORT_TICKET_TTL_DAYS = config.get("SUPPORT_TICKET_TTL_DAYS", 7)
+
+# Сколько администраторов получают сообщение поддержки одновременно
+SUPPORT_FANOUT_CONCURRENCY = config.get("SUPPORT_FANOUT_CONCURRENCY", 5)
+
+# Адрес Bot API сервера (локальный telegram-bot-api или benchmarks/fake_telegram.py).
+# По умолчанию используется api.telegram.org
+API_SERVER = config.get("API_SERVER")
+
+# Режим webhook: если задан WEBHOOK.URL, апдейты принимает встроенный aiohttp сервер вместо polling
+WEBHOOK_CONFIG = config.get("WEBHOOK", {})
+WEBHOOK_URL = WEBHOOK_CONFIG.get("URL")
+WEBHOOK_PATH = WEBHOOK_CONFIG.get("PATH", "/webhook")
+WEBHOOK_HOST = WEBHOOK_CONFIG.get("HOST", "0.0.0.0")
+WEBHOOK_PORT = WEBHOOK_CONFIG.get("PORT", 8080)
+WEBHOOK_SECRET_TOKEN = WEBHOOK_CONFIG.get("SECRET_TOKEN")
+# Максимум одновременно обрабатываемых апдейтов
+WEBHOOK_MAX_IN_FLIGHT = WEBHOOK_CONFIG.get("MAX_IN_FLIGHT", 100)
+
+# Многопроцессный режим: при WORKERS > 1 основной процесс только принимает апдейты
+# и распределяет их по процессам-обработчикам по from_user.id
+WORKERS = config.get("WORKERS", 1)
+# Процесс-обработчик (spawn импортирует этот модуль как __mp_main__): разовые
+# действия при запуске выполняет только основной процесс
+IS_WORKER_PROCESS = __name__ == "__mp_main__"
+# Максимум одновременно обрабатываемых апдейтов в одном процессе-обработчике
+WORKER_MAX_IN_FLIGHT = config.get("WORKER_MAX_IN_FLIGHT", 100)
+
+# HTTP адрес метрик в формате Prometheus (/metrics). Без METRICS_PORT не запускается.
+# Процесс-обработчик с номером N слушает METRICS_PORT + N + 1
+METRICS_HOST = config.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = config.get("METRICS_PORT")
+
+# Профилирование SQL запросов и журнал медленных запросов (переключается командой /slowqueries)
+QUERY_PROFILING_ENABLED = config.get("QUERY_PROFILING", False)
+SLOW_QUERY_THRESHOLD_MS = config.get("SLOW_QUERY_THRESHOLD_MS", 100)
+# Как часто медленные запросы из памяти записываются в slow_queries, секунды
+SLOW_QUERY_FLUSH_INTERVAL = 10
+
+# Блокировка цикла событий дольше порога записывается в логи ошибок вместе со стеком
+LOOP_STALL_THRESHOLD_MS = config.get("LOOP_STALL_THRESHOLD_MS", 250)
+
+# Загрузка конфигурации AI из configai.json (путь можно переопределить переменной окружения BOT_AI_CONFIG_FILE)
+AI_CONFIG_FILE = os.environ.get("BOT_AI_CONFIG_FILE", "configai.json")
 
 def load_ai_config():
     """Загружает конфигурацию AI из configai.json"""
@@ -143,23 +261,39 @@ DEEPSEEK_API_KEY = ai_config["API_KEY"]
 DEEPSEEK_MODEL = ai_config["MODEL"]
 DEEPSEEK_TEMPERATURE = ai_config["TEMPERATURE"]
 DEEPSEEK_MAX_TOKENS = ai_config["MAX_TOKENS"]
+# Адрес API можно заменить, например на локальную заглушку нагрузочного стенда
+DEEPSEEK_API_URL = ai_config.get("API_URL", "https://api.deepseek.com/v1/chat/completions")
 
 # ========== ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ ==========
-# Инициализируем базу данных при запуске
-init_database()
+# Инициализируем базу данных при запуске (миграции и VACUUM выполняет только
+# основной процесс: обработчики запускаются, когда база уже готова)
+database.DB_FILE = DB_FILE
+if IS_WORKER_PROCESS:
+    database.detect_fts()
+else:
+    init_database()
 
 # ========== ИНИЦИАЛИЗАЦИЯ БОТА ==========
 if not BOT_TOKEN or BOT_TOKEN == "ваш_токен_бота":
     raise ValueError("BOT_TOKEN не установлен! Укажите токен бота в config.json")
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+if API_SERVER:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(API_SERVER)))
+else:
+    bot = Bot(token=BOT_TOKEN)
+storage = SQLiteStorage()
 dp = Dispatcher(storage=storage)
 
 # ========== ИНИЦИАЛИЗАЦИЯ TON CONNECT ==========
 # URL манифеста для TON Connect (нужно разместить на публичном URL)
 TC_MANIFEST_URL = "https://raw.githubusercontent.com/The-Open-Tech-Company/tg-tools-bot/refs/heads/main/tonconnect-manifest.json"
-TC_STORAGE = FileStorage("tonconnect_connections.json")
+# Подключения хранятся в базе, чтобы процессы-обработчики не затирали записи друг друга
+TC_STORAGE = DatabaseStorage()
+if not IS_WORKER_PROCESS:
+    # Подключения из прежнего файлового хранилища переносятся в базу один раз
+    imported_connections = import_file_storage("tonconnect_connections.json")
+    if imported_connections:
+        print(f"✅ Подключения TON Connect перенесены в базу: {imported_connections}")
 
 async def check_manifest_format(manifest_url: str) -> bool:
     """Проверяет формат манифеста на наличие угловых скобок"""
@@ -185,9 +319,11 @@ async def check_manifest_format(manifest_url: str) -> bool:
         print(f"⚠️ Ошибка при проверке манифеста: {e}")
         return False
 
-# Проверяем формат манифеста перед инициализацией
-print(f"Проверка манифеста по URL: {TC_MANIFEST_URL}")
-manifest_check = asyncio.run(check_manifest_format(TC_MANIFEST_URL))
+# Проверяем формат манифеста перед инициализацией (один раз, в основном процессе)
+manifest_check = True
+if not IS_WORKER_PROCESS:
+    print(f"Проверка манифеста по URL: {TC_MANIFEST_URL}")
+    manifest_check = asyncio.run(check_manifest_format(TC_MANIFEST_URL))
 
 # Флаг доступности TON Connect
 TON_CONNECT_AVAILABLE = False
@@ -240,7 +376,7 @@ def get_user_info(user) -> Tuple[str, str, str]:
 
 def log_error(error_type: str, error_message: str, context: str = ""):
     """Логирует ошибку бота"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = int(time.time())
     try:
         db_log_error(error_type, timestamp, error_message, context)
     except Exception as e:
@@ -255,7 +391,7 @@ def log_user_action(user, action: str):
     """Логирует действие обычного пользователя"""
     try:
         user_id, full_name, username = get_user_info(user)
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        timestamp = int(time.time())
         db_log_user_action(int(user_id), full_name, username, timestamp, action)
     except Exception as e:
         log_error("LOG_USER_ACTION", f"Ошибка логирования действия пользователя", str(e))
@@ -265,7 +401,7 @@ def log_admin_action(user, action: str):
     """Логирует действие администратора"""
     try:
         user_id, full_name, username = get_user_info(user)
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        timestamp = int(time.time())
         db_log_admin_action(int(user_id), full_name, username, timestamp, action)
     except Exception as e:
         log_error("LOG_ADMIN_ACTION", f"Ошибка логирования действия администратора", str(e))
@@ -275,7 +411,7 @@ def log_admin_command(user, command: str):
     """Логирует команду администратора"""
     try:
         user_id, full_name, username = get_user_info(user)
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        timestamp = int(time.time())
         db_log_admin_command(int(user_id), full_name, username, timestamp, command)
     except Exception as e:
         log_error("LOG_ADMIN_COMMAND", f"Ошибка логирования команды администратора", str(e))
@@ -284,29 +420,39 @@ def log_admin_command(user, command: str):
 def log_system_event(initiator: str, action: str):
     """Логирует системное событие"""
     try:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        timestamp = int(time.time())
         db_log_system_event(initiator, timestamp, action)
     except Exception as e:
         # Если не удалось записать системный лог, пытаемся записать в лог ошибок
         try:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            timestamp = int(time.time())
             db_log_error("SYSTEM_LOG_ERROR", timestamp, f"Ошибка записи системного лога: {str(e)}", "")
         except:
             pass
 
 
+REGISTERED_USERS_CACHE_SIZE = config.get("REGISTERED_USERS_CACHE_SIZE", 10000)
+
+# ID пользователей, уже зарегистрированных в этом процессе: повторный /start
+# не обращается к базе (смену имени отслеживает user_identity_middleware).
+# Вытесненный пользователь при следующем /start проверяется register_user,
+# который ничего не пишет, если запись не изменилась
+registered_user_ids = LRUCache(maxsize=REGISTERED_USERS_CACHE_SIZE)
+
+
 def add_user_to_list(user):
     """Добавляет пользователя в список пользователей, если его там еще нет"""
-    user_id, full_name, username = get_user_info(user)
+    if registered_user_ids.get(user.id) is not CACHE_MISS:
+        return
     
-    # Проверяем, есть ли пользователь уже в списке
-    profile = get_user_profile(int(user_id))
-    if profile:
-        return  # Пользователь уже в списке
+    user_id, full_name, username = get_user_info(user)
     
-    # Добавляем нового пользователя
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    add_user(int(user_id), full_name, username, timestamp)
+    # Запись выполняется, только если пользователь новый или сменил имя
+    timestamp = int(time.time())
+    if register_user(int(user_id), full_name, username, timestamp):
+        # Пользователь мог быть закэширован как ненайденный
+        invalidate_user_lookup(int(user_id), username)
+    registered_user_ids.set(user.id, True)
 
 
 # Функция is_admin уже импортирована из database
@@ -314,7 +460,7 @@ def add_user_to_list(user):
 def add_admin(user, admin_user):
     """Добавляет администратора в список"""
     admin_id, full_name, username = get_user_info(admin_user)
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = int(time.time())
     from database import add_admin as db_add_admin
     db_add_admin(int(admin_id), full_name, username, timestamp)
     log_admin_command(user, f"addadmin {admin_id}")
@@ -335,7 +481,7 @@ def ban_user(user, target_user):
     """Добавляет пользователя в черный список"""
     target_id, full_name, username = get_user_info(target_user)
     admin_id, admin_name, admin_username = get_user_info(user)
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = int(time.time())
     banned_by = f"{admin_id} {admin_username}"
     db_ban_user(int(target_id), full_name, username, timestamp, banned_by)
     log_admin_command(user, f"ban {target_id}")
@@ -361,7 +507,7 @@ def add_achievement(user, target_user, ach_id: str, ach_name: str):
     """Добавляет достижение пользователю"""
     target_id, full_name, username = get_user_info(target_user)
     admin_id, admin_name, admin_username = get_user_info(user)
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = int(time.time())
     given_by = f"{admin_id} {admin_username}"
     add_user_achievement(int(target_id), ach_id, timestamp, given_by)
     log_admin_command(user, f"sendach {ach_id} {target_id}")
@@ -369,7 +515,7 @@ def add_achievement(user, target_user, ach_id: str, ach_name: str):
 
 def create_achievement(user, ach_id: str, ach_name: str):
     """Создает новое достижение"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = int(time.time())
     from database import create_achievement as db_create_achievement
     db_create_achievement(ach_id, ach_name, timestamp)
     log_admin_command(user, f"newach {ach_id} {ach_name}")
@@ -398,9 +544,8 @@ def delete_achievement(user, ach_id: str) -> bool:
 def add_temp_ban(user_id: int, duration_hours: int, reason: str, banned_by: int):
     """Добавляет временный бан"""
     unban_time = datetime.now() + timedelta(hours=duration_hours)
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    unban_timestamp = unban_time.strftime("%Y-%m-%d %H:%M:%S")
-    add_temp_ban(user_id, unban_timestamp, reason, banned_by, timestamp)
+    timestamp = int(time.time())
+    db_add_temp_ban(user_id, to_epoch(unban_time), reason, banned_by, timestamp)
     return unban_time
 
 
@@ -409,17 +554,47 @@ def add_temp_ban(user_id: int, duration_hours: int, reason: str, banned_by: int)
 
 def get_all_admin_ids() -> List[int]:
     """Получает список всех ID администраторов (включая создателя)"""
-    admin_ids = [CREATOR_ID]
-    admins = get_all_admins()
-    for admin in admins:
-        admin_ids.append(int(admin["id"]))
-    return admin_ids
+    return [CREATOR_ID] + sorted(get_admin_ids() - {CREATOR_ID})
+
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = set()
+
+
+def run_in_background(coro):
+    """Запускает корутину в фоне, не дожидаясь ее завершения"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def send_to_admins(text: str, reply_markup=None, error_type: str = "ADMIN_SEND") -> int:
+    """
+    Отправляет сообщение всем администраторам параллельно
+    
+    Returns:
+        int: количество успешно доставленных сообщений
+    """
+    semaphore = asyncio.Semaphore(SUPPORT_FANOUT_CONCURRENCY)
+    
+    async def send(admin_id: int) -> bool:
+        async with semaphore:
+            try:
+                await bot.send_message(chat_id=admin_id, text=text, reply_markup=reply_markup)
+                return True
+            except Exception as e:
+                log_error(error_type, f"Ошибка отправки сообщения админу {admin_id}", str(e))
+                return False
+    
+    results = await asyncio.gather(*(send(admin_id) for admin_id in get_all_admin_ids()))
+    return sum(results)
 
 
 def log_transfer(from_user_id: int, to_user_id: int, amount: int, from_name: str, to_name: str):
     """Логирует перевод TPCoin между пользователями"""
     try:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        timestamp = int(time.time())
         db_log_transfer(timestamp, from_user_id, to_user_id, amount, from_name, to_name)
     except Exception as e:
         log_error("LOG_TRANSFER", f"Ошибка логирования перевода", str(e))
@@ -428,6 +603,14 @@ def log_transfer(from_user_id: int, to_user_id: int, amount: int, from_name: str
 # ========== ФУНКЦИИ ДЛЯ РАБОТЫ С DEEPSEEK API ==========
 
 async def call_deepseek_api(prompt: str) -> dict:
+    """Отправляет запрос в DeepSeek API, замеряя время ответа (см. request_deepseek_api)"""
+    started = time.perf_counter()
+    result = await request_deepseek_api(prompt)
+    AI_REQUEST_DURATION.observe(time.perf_counter() - started, status="ok" if result["success"] else "error")
+    return result
+
+
+async def request_deepseek_api(prompt: str) -> dict:
     """
     Отправляет запрос в DeepSeek API и возвращает ответ
     
@@ -451,7 +634,7 @@ async def call_deepseek_api(prompt: str) -> dict:
             "error": "API ключ не настроен. Заполните API_KEY в configai.json"
         }
     
-    url = "https://api.deepseek.com/v1/chat/completions"
+    url = DEEPSEEK_API_URL
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
@@ -539,9 +722,8 @@ class SupportStates(StatesGroup):
     admin_waiting_for_reply = State()  # Админ пишет ответ пользователю
     admin_waiting_for_reply_to_addition = State()  # Админ отвечает на дополнение
 
-# Словарь для хранения активных диалогов поддержки
-# Формат: {user_id: {"admin_id": admin_id, "message_id": message_id}}
-active_support_dialogs: Dict[int, Dict] = {}
+# Переписка поддержки хранится в тикетах (таблицы support_tickets и ticket_messages),
+# поэтому переживает перезапуск и видна всем процессам-обработчикам
 
 # ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
 
@@ -549,35 +731,224 @@ def get_user_status(user_id: int) -> str:
     """Определяет статус пользователя"""
     if user_id == CREATOR_ID:
         return "Creator"
-    elif is_admin(user_id):
+    elif get_user_card(user_id)["is_admin"]:
         return "Admin"
     else:
         return "User"
 
 
+# ========== КЭШ ПОИСКА ПОЛЬЗОВАТЕЛЕЙ ==========
+
+USER_LOOKUP_CACHE_SIZE = 10000
+# Пользователь, найденный через API, может сменить username незаметно для бота
+USER_LOOKUP_API_TTL = 3600
+# Отрицательный результат живет недолго: пользователь может появиться позже
+USER_LOOKUP_NEGATIVE_TTL = 300
+
+# Результаты поиска по ID/username: {"123" | "@username": (id, имя, username) | None}
+user_lookup_cache = LRUCache(maxsize=USER_LOOKUP_CACHE_SIZE)
+# Последние увиденные в апдейтах имя и username: {user_id: (имя, username)}
+known_user_identities = LRUCache(maxsize=USER_LOOKUP_CACHE_SIZE)
+
+
+def user_lookup_key(identifier: str) -> str:
+    """Ключ кэша поиска: ID как есть, username в нижнем регистре с @"""
+    identifier = identifier.lstrip("@")
+    return identifier if identifier.isdigit() else "@" + identifier.lower()
+
+
+def _drop_user_lookup(key: Tuple[int, Tuple[str, ...]]):
+    """Удаляет результаты поиска пользователя из кэша этого процесса"""
+    user_id, usernames = key
+    user_lookup_cache.pop(str(user_id))
+    for username in usernames:
+        if username and username != "NA":
+            user_lookup_cache.pop(user_lookup_key(username))
+
+
+register_cache_invalidator("user_lookup", _drop_user_lookup)
+
+
+def invalidate_user_lookup(user_id: int, *usernames: str):
+    """Сбрасывает закэшированные результаты поиска пользователя"""
+    invalidate_cache("user_lookup", (user_id, usernames))
+
+
+def refresh_user_identity(user):
+    """Обновляет имя и username пользователя в базе по данным входящего апдейта"""
+    user_id, full_name, username = get_user_info(user)
+    identity = (full_name, username)
+    if known_user_identities.get(user.id) == identity:
+        return
+    
+    previous = update_user_identity(user.id, full_name, username)
+    # Сменивший username пользователь мог быть закэширован под старым username.
+    # Если запись не изменилась, сброс не нужен (в многопроцессном режиме он
+    # рассылается всем процессам); новых пользователей сбрасывает add_user_to_list
+    if previous is not None:
+        invalidate_user_lookup(user.id, username, previous[1])
+    known_user_identities.set(user.id, identity)
+
+
+@dp.update.outer_middleware()
+async def user_identity_middleware(handler, event, data):
+    """Отслеживает смену имени и username у пользователей, от которых приходят апдейты"""
+    user = data.get("event_from_user")
+    if user and not user.is_bot:
+        try:
+            refresh_user_identity(user)
+        except Exception as e:
+            log_error("USER_IDENTITY", "Ошибка обновления имени пользователя", str(e))
+    return await handler(event, data)
+
+
+# ========== МЕТРИКИ ==========
+
+async def metrics_middleware(handler, event, data):
+    """Замеряет время работы хендлера, ошибки и число одновременно обрабатываемых апдейтов"""
+    handler_object = data.get("handler")
+    handler_name = handler_object.callback.__name__ if handler_object else "unknown"
+    event_type = "callback_query" if isinstance(event, CallbackQuery) else "message"
+    
+    HANDLERS_IN_FLIGHT.inc(event=event_type)
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        HANDLER_ERRORS.inc(event=event_type, handler=handler_name)
+        raise
+    finally:
+        HANDLER_DURATION.observe(time.perf_counter() - started, event=event_type, handler=handler_name)
+        HANDLERS_IN_FLIGHT.dec(event=event_type)
+
+
+# Внутренние middleware: вызываются только для найденного хендлера, имя которого и есть метка
+dp.message.middleware(metrics_middleware)
+dp.callback_query.middleware(metrics_middleware)
+add_query_listener(observe_db_query)
+
+# Начальное состояние профилирования из конфигурации (применяется в каждом процессе)
+apply_cache_invalidation("query_profiling", (QUERY_PROFILING_ENABLED, SLOW_QUERY_THRESHOLD_MS))
+
+# Монитор задержки цикла событий (запускается в main и в каждом процессе-обработчике)
+loop_monitor = LoopMonitor(threshold=LOOP_STALL_THRESHOLD_MS / 1000)
+
+# Снимки памяти tracemalloc (включаются командой /memprofile on)
+memory_profiler = MemoryProfiler()
+
+# Профилирование процессора по команде /cpuprofile
+cpu_profiler = CPUProfiler()
+CPU_PROFILE_DEFAULT_SECONDS = 10
+CPU_PROFILE_MAX_SECONDS = 120
+
+
+def report_loop_stall(duration: float, stack: str):
+    """Записывает блокировку цикла событий в логи ошибок"""
+    log_error(
+        "EVENT_LOOP_STALL",
+        f"Цикл событий был заблокирован на {duration * 1000:.0f} мс: {stack_location(stack)}",
+        stack
+    )
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """GET /metrics - метрики процесса в текстовом формате Prometheus"""
+    return web.Response(
+        body=REGISTRY.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+
+async def start_metrics_server(port: int):
+    """Запускает HTTP сервер метрик"""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    print(f"Метрики: http://{METRICS_HOST}:{port}/metrics")
+
+
+def format_metrics_summary(limit: int = 5) -> str:
+    """Сводка метрик процесса для /test"""
+    report = "📈 Метрики процесса:\n"
+    handlers = sorted(HANDLER_DURATION.summary(), key=lambda item: item["p99"], reverse=True)
+    in_flight = sum(HANDLERS_IN_FLIGHT.get(event=event) for event in ("message", "callback_query"))
+    report += f"  Обработано апдейтов: {sum(item['count'] for item in handlers)}\n"
+    report += f"  Ошибок в хендлерах: {int(HANDLER_ERRORS.total())}\n"
+    report += f"  Обрабатывается сейчас: {int(in_flight)}\n"
+    
+    if handlers:
+        report += "  Самые медленные хендлеры (p99):\n"
+        for item in handlers[:limit]:
+            report += (
+                f"    {item['labels']['handler']}: p50 {item['p50'] * 1000:.0f} мс, "
+                f"p99 {item['p99'] * 1000:.0f} мс, вызовов {item['count']}\n"
+            )
+    
+    queries = DB_QUERY_DURATION.summary()
+    query_count = sum(item["count"] for item in queries)
+    if query_count:
+        query_time = sum(item["sum"] for item in queries)
+        report += f"  SQL запросов: {query_count}, среднее {query_time / query_count * 1000:.2f} мс\n"
+    
+    for item in AI_REQUEST_DURATION.summary():
+        report += (
+            f"  AI запросы ({item['labels']['status']}): {item['count']}, "
+            f"p50 {item['p50']:.1f} с, p99 {item['p99']:.1f} с\n"
+        )
+    
+    loop_stats = loop_monitor.stats()
+    report += (
+        f"  Задержка цикла событий: p50 {loop_stats['p50'] * 1000:.1f} мс, "
+        f"p99 {loop_stats['p99'] * 1000:.1f} мс, макс. {loop_stats['max'] * 1000:.0f} мс\n"
+    )
+    report += f"  Блокировок дольше {LOOP_STALL_THRESHOLD_MS} мс: {loop_stats['stalls']}\n"
+    if loop_stats["last_stall"]:
+        last_stall = loop_stats["last_stall"]
+        report += (
+            f"  Последняя: {format_timestamp(last_stall['time'])}, {last_stall['duration'] * 1000:.0f} мс\n"
+            f"    {stack_location(last_stall['stack'])[:300]}\n"
+        )
+    return report
+
+
 async def get_user_by_id_or_username_async(identifier: str) -> Optional[Tuple[str, str, str]]:
-    """Находит пользователя по ID или username, сначала в файле, потом через API"""
+    """Находит пользователя по ID или username: сначала в кэше, потом в базе, потом через API"""
     # Убираем @ если есть
     identifier = identifier.lstrip("@")
+    key = user_lookup_key(identifier)
     
-    # Сначала ищем в файле
-    user_info = get_user_by_id_or_username(identifier)
-    if user_info:
+    user_info = user_lookup_cache.get(key)
+    if user_info is not CACHE_MISS:
         return user_info
     
-    # Если не найден в файле, пробуем получить через API (если это числовой ID)
-    if identifier.isdigit():
+    # Сначала ищем в базе
+    user_info = get_user_by_id_or_username(identifier)
+    ttl = None
+    
+    # Если не найден в базе, пробуем получить через API (если это числовой ID)
+    if not user_info and identifier.isdigit():
         try:
             chat = await bot.get_chat(int(identifier))
             if chat.type == "private":
                 user_id = str(chat.id)
                 full_name = f"{chat.first_name or ''} {chat.last_name or ''}".strip() or "NA"
                 username = chat.username or "NA"
-                return (user_id, full_name, username)
+                user_info = (user_id, full_name, username)
+                ttl = USER_LOOKUP_API_TTL
         except Exception:
             pass
     
-    return None
+    if user_info:
+        # Запоминаем под обоими ключами: повторный поиск по ID или username не идет в базу
+        user_lookup_cache.set(user_info[0], user_info, ttl=ttl)
+        if user_info[2] != "NA":
+            user_lookup_cache.set(user_lookup_key(user_info[2]), user_info, ttl=ttl)
+    else:
+        user_lookup_cache.set(key, None, ttl=USER_LOOKUP_NEGATIVE_TTL)
+    
+    return user_info
 
 
 async def check_ban_middleware(message: Message):
@@ -620,7 +991,7 @@ async def cmd_profile(message: Message):
     
     log_user_action(message.from_user, "/profile")
     
-    profile = get_user_profile(message.from_user.id)
+    profile = get_user_card(message.from_user.id)["profile"]
     if not profile:
         await message.answer("Профиль не найден. Используйте /start для регистрации.")
         return
@@ -632,7 +1003,7 @@ async def cmd_profile(message: Message):
         f"Имя и Фамилия: {profile['name']}\n"
         f"Telegram ID: {profile['id']}\n"
         f"Статус: {status}\n"
-        f"Дата первого запуска: {profile['first_start']}"
+        f"Дата первого запуска: {format_timestamp(profile['first_start'])}"
     )
     await message.answer(profile_text)
 
@@ -645,7 +1016,7 @@ async def cmd_balance(message: Message):
     
     log_user_action(message.from_user, "/balance")
     
-    balance = get_user_balance(message.from_user.id)
+    balance = get_user_card(message.from_user.id)["balance"]
     await message.answer(f"💰 Ваш баланс: {balance} TPCoin")
 
 
@@ -657,7 +1028,7 @@ async def cmd_myach(message: Message):
     
     log_user_action(message.from_user, "/myach")
     
-    achievements = get_user_achievements(message.from_user.id)
+    achievements = get_user_card(message.from_user.id)["achievements"]
     
     if not achievements:
         await message.answer("У вас пока нет достижений.")
@@ -666,7 +1037,7 @@ async def cmd_myach(message: Message):
     ach_text = "🏆 Ваши достижения:\n\n"
     for ach in achievements:
         ach_text += f"• {ach['name']} (ID: {ach['id']})\n"
-        ach_text += f"  Получено: {ach['date']}\n\n"
+        ach_text += f"  Получено: {format_timestamp(ach['date'])}\n\n"
     
     await message.answer(ach_text)
 
@@ -723,12 +1094,12 @@ async def cmd_transfer(message: Message):
     
     # Выполняем перевод
     try:
-        # Списываем средства у отправителя
-        set_user_balance(sender_id, sender_balance - amount)
-        
-        # Добавляем средства получателю
-        recipient_balance = get_user_balance(recipient_id)
-        set_user_balance(recipient_id, recipient_balance + amount)
+        # Списание и начисление одной транзакцией: баланс мог измениться с момента проверки
+        balances = transfer_balance(sender_id, recipient_id, amount)
+        if balances is None:
+            await message.answer(f"❌ Недостаточно средств. Ваш баланс: {get_user_balance(sender_id)} TPCoin")
+            return
+        sender_balance, recipient_balance = balances
         
         # Логируем перевод
         sender_name = f"{message.from_user.first_name or ''} {message.from_user.last_name or ''}".strip() or "NA"
@@ -741,7 +1112,7 @@ async def cmd_transfer(message: Message):
                 chat_id=recipient_id,
                 text=f"💰 Вы получили перевод от {sender_name} (@{message.from_user.username or 'отсутствует'})\n"
                      f"Сумма: {amount} TPCoin\n"
-                     f"Ваш новый баланс: {recipient_balance + amount} TPCoin"
+                     f"Ваш новый баланс: {recipient_balance} TPCoin"
             )
         except Exception as e:
             log_error("TRANSFER_NOTIFICATION", f"Ошибка отправки уведомления получателю {recipient_id}", str(e))
@@ -751,7 +1122,7 @@ async def cmd_transfer(message: Message):
             f"✅ Перевод выполнен успешно!\n\n"
             f"Получатель: {recipient_name} (@{recipient_info[2] if recipient_info[2] != 'NA' else 'отсутствует'})\n"
             f"Сумма: {amount} TPCoin\n"
-            f"Ваш новый баланс: {sender_balance - amount} TPCoin"
+            f"Ваш новый баланс: {sender_balance} TPCoin"
         )
         
         log_user_action(message.from_user, f"/transfer {amount} to {recipient_id}")
@@ -774,8 +1145,8 @@ async def cmd_contact(message: Message, state: FSMContext):
     
     log_user_action(message.from_user, "/contact")
     
-    # Проверяем, есть ли активный диалог
-    if message.from_user.id in active_support_dialogs:
+    # Проверяем, есть ли незакрытый тикет
+    if get_active_ticket(message.from_user.id):
         await message.answer(
             "⚠️ У вас уже есть активный диалог с поддержкой.\n"
             "Дождитесь ответа администратора или завершения текущего диалога."
@@ -800,9 +1171,18 @@ async def process_support_message(message: Message, state: FSMContext):
     user_name = f"{message.from_user.first_name or ''} {message.from_user.last_name or ''}".strip() or "Без имени"
     username = f"@{message.from_user.username}" if message.from_user.username else "отсутствует"
     
+    ticket_id = create_ticket(user_id, message.text or "Медиа-сообщение")
+    if ticket_id is None:
+        await message.answer(
+            "⚠️ У вас уже есть активный диалог с поддержкой.\n"
+            "Дождитесь ответа администратора или завершения текущего диалога."
+        )
+        await state.clear()
+        return
+    
     # Формируем текст сообщения для админов
     admin_message_text = (
-        f"📨 Новое сообщение от пользователя\n\n"
+        f"📨 Новое сообщение от пользователя (тикет #{ticket_id})\n\n"
         f"👤 Имя: {user_name}\n"
         f"📱 Username: {username}\n"
         f"🆔 ID: {user_id}\n\n"
@@ -811,37 +1191,33 @@ async def process_support_message(message: Message, state: FSMContext):
     
     # Создаем кнопку для админов
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Прочитать и ответить", callback_data=f"support_read_{user_id}")]
+        [InlineKeyboardButton(text="Прочитать и ответить", callback_data=f"ticket_take_{ticket_id}")]
     ])
     
-    # Отправляем сообщение всем админам
-    admin_ids = get_all_admin_ids()
-    sent_count = 0
-    
-    for admin_id in admin_ids:
-        try:
-            await bot.send_message(
-                chat_id=admin_id,
-                text=admin_message_text,
-                reply_markup=keyboard
-            )
-            sent_count += 1
-        except Exception as e:
-            log_error("SUPPORT_SEND", f"Ошибка отправки сообщения поддержки админу {admin_id}", str(e))
+    # Подтверждаем пользователю сразу, а админам рассылаем в фоне
+    await message.answer(
+        "✅ Ваше сообщение отправлено администраторам.\n"
+        "Ожидайте ответа в ближайшее время."
+    )
+    log_user_action(message.from_user, f"Отправил сообщение в поддержку: {message.text[:50] if message.text else 'Медиа'}")
+    await state.clear()
     
+    run_in_background(deliver_support_message(user_id, admin_message_text, keyboard))
+
+async def deliver_support_message(user_id: int, text: str, keyboard: InlineKeyboardMarkup):
+    """Рассылает сообщение поддержки админам и сообщает пользователю, если не доставлено никому"""
+    sent_count = await send_to_admins(text, keyboard, "SUPPORT_SEND")
     if sent_count > 0:
-        await message.answer(
-            "✅ Ваше сообщение отправлено администраторам.\n"
-            "Ожидайте ответа в ближайшее время."
-        )
-        log_user_action(message.from_user, f"Отправил сообщение в поддержку: {message.text[:50] if message.text else 'Медиа'}")
-    else:
-        await message.answer(
-            "❌ К сожалению, не удалось отправить сообщение администраторам.\n"
-            "Попробуйте позже."
-        )
+        return
     
-    await state.clear()
+    try:
+        await bot.send_message(
+            chat_id=user_id,
+            text="❌ К сожалению, не удалось отправить сообщение администраторам.\n"
+                 "Попробуйте позже."
+        )
+    except Exception as e:
+        log_error("SUPPORT_SEND", f"Ошибка уведомления пользователя {user_id} о недоставке", str(e))
 
 
 @dp.message(Command("ai"))
@@ -884,7 +1260,7 @@ async def cmd_ai(message: Message):
     try:
         # Получаем информацию о пользователе для логирования
         user_id, full_name, username = get_user_info(message.from_user)
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        timestamp = int(time.time())
         
         # Отправляем запрос в DeepSeek API
         result = await call_deepseek_api(user_query)
@@ -970,80 +1346,105 @@ async def cmd_ai(message: Message):
             await message.answer("❌ Произошла ошибка при обработке запроса. Попробуйте позже.")
 
 
-@dp.callback_query(F.data.startswith("support_read_"))
-async def handle_support_read(callback: CallbackQuery, state: FSMContext):
+# ========== ТИКЕТЫ ПОДДЕРЖКИ ==========
+
+TICKET_STATUS_NAMES = {
+    "open": "🟢 ожидает",
+    "assigned": "🟡 в работе",
+    "closed": "⚪ закрыт"
+}
+TICKET_PAGE_SIZE = 10
+# Сколько последних сообщений тикета показывать администратору
+TICKET_HISTORY_SIZE = 10
+
+
+def format_ticket_user(user_id: int) -> str:
+    """Имя и username пользователя для сообщений поддержки"""
+    user_profile = get_user_profile(user_id)
+    if user_profile:
+        return f"{user_profile['name']} (@{user_profile['username'] if user_profile['username'] != 'NA' else 'отсутствует'})"
+    return f"ID: {user_id}"
+
+
+def format_ticket_history(ticket_id: int) -> str:
+    """Последние сообщения переписки по тикету"""
+    lines = []
+    for ticket_message in get_ticket_messages(ticket_id, TICKET_HISTORY_SIZE):
+        author = "👮 Админ" if ticket_message["from_admin"] else "👤 Пользователь"
+        lines.append(f"{author} [{format_timestamp(ticket_message['created_at'])}]:\n{ticket_message['text']}")
+    return "\n\n".join(lines)
+
+
+def render_taken_ticket(ticket: dict) -> Tuple[str, InlineKeyboardMarkup]:
+    """Сообщение администратору, взявшему тикет, с кнопкой 'Завершить диалог'"""
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Завершить диалог", callback_data=f"ticket_close_{ticket['id']}")]
+    ])
+    text = (
+        f"✅ Вы взяли тикет #{ticket['id']} в обработку\n\n"
+        f"👤 Пользователь: {format_ticket_user(ticket['user_id'])}\n"
+        f"🆔 ID: {ticket['user_id']}\n\n"
+        f"{format_ticket_history(ticket['id'])[-3500:]}\n\n"
+        f"Напишите ответ пользователю:"
+    )
+    return text, keyboard
+
+
+async def begin_ticket_reply(state: FSMContext, ticket: dict, reply_state: State):
+    """Переводит администратора в режим ответа по тикету"""
+    await state.update_data(ticket_id=ticket["id"], user_id=ticket["user_id"])
+    await state.set_state(reply_state)
+
+
+@dp.callback_query(F.data.startswith("ticket_take_"))
+async def handle_ticket_take(callback: CallbackQuery, state: FSMContext):
     """Обработка нажатия кнопки 'Прочитать и ответить'"""
     if not is_admin(callback.from_user.id) and callback.from_user.id != CREATOR_ID:
         await callback.answer("❌ У вас нет прав для этого действия.", show_alert=True)
         return
     
-    # Извлекаем ID пользователя из callback_data
-    user_id = int(callback.data.split("_")[-1])
+    ticket_id = int(callback.data.split("_")[-1])
     
-    # Проверяем, не занят ли уже этот диалог другим админом
-    if user_id in active_support_dialogs:
+    # Закрепляем тикет за админом, если его еще не взял другой
+    if not assign_ticket(ticket_id, callback.from_user.id):
         await callback.answer("⚠️ Этот диалог уже обрабатывается другим администратором.", show_alert=True)
         return
     
-    # Сохраняем информацию о диалоге
-    active_support_dialogs[user_id] = {
-        "admin_id": callback.from_user.id,
-        "admin_message_id": callback.message.message_id
-    }
-    
-    # Получаем информацию о пользователе
-    user_profile = get_user_profile(user_id)
-    if user_profile:
-        user_info = f"{user_profile['name']} (@{user_profile['username'] if user_profile['username'] != 'NA' else 'отсутствует'})"
-    else:
-        user_info = f"ID: {user_id}"
-    
-    # Обновляем сообщение админу с кнопкой "Завершить диалог"
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Завершить диалог", callback_data=f"support_close_{user_id}")]
-    ])
+    ticket = get_ticket(ticket_id)
+    text, keyboard = render_taken_ticket(ticket)
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await begin_ticket_reply(state, ticket, SupportStates.admin_waiting_for_reply)
     
-    await callback.message.edit_text(
-        f"✅ Вы взяли диалог в обработку\n\n"
-        f"👤 Пользователь: {user_info}\n"
-        f"🆔 ID: {user_id}\n\n"
-        f"Напишите ответ пользователю:",
-        reply_markup=keyboard
-    )
-    
-    await state.update_data(user_id=user_id, original_message_id=callback.message.message_id)
-    await state.set_state(SupportStates.admin_waiting_for_reply)
-    
-    log_admin_action(callback.from_user, f"Взял диалог поддержки с пользователем {user_id}")
+    log_admin_action(callback.from_user, f"Взял тикет #{ticket_id} пользователя {ticket['user_id']}")
     await callback.answer()
 
 
-@dp.message(SupportStates.admin_waiting_for_reply)
-async def process_admin_reply(message: Message, state: FSMContext):
-    """Обработка ответа админа пользователю"""
+async def send_admin_reply(message: Message, state: FSMContext, confirmation: str, action: str, error_type: str):
+    """Отправляет ответ администратора пользователю по тикету из FSM данных"""
     if not is_admin(message.from_user.id) and message.from_user.id != CREATOR_ID:
         await state.clear()
         return
     
     data = await state.get_data()
-    user_id = data.get("user_id")
+    ticket_id = data.get("ticket_id")
+    ticket = get_ticket(ticket_id) if ticket_id else None
     
-    if not user_id or user_id not in active_support_dialogs:
+    if not ticket or ticket["status"] != "assigned":
         await message.answer("❌ Диалог не найден или был завершен.")
         await state.clear()
         return
     
-    # Проверяем, что отвечает тот же админ, который взял диалог
-    if active_support_dialogs[user_id]["admin_id"] != message.from_user.id:
+    # Проверяем, что отвечает тот же админ, который взял тикет
+    if ticket["admin_id"] != message.from_user.id:
         await message.answer("❌ Этот диалог обрабатывается другим администратором.")
         await state.clear()
         return
     
-    admin_name = f"{message.from_user.first_name or ''} {message.from_user.last_name or ''}".strip() or "Администратор"
+    user_id = ticket["user_id"]
     
     # Отправляем ответ пользователю с кнопкой "Дополнить"
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Дополнить", callback_data=f"support_add_{user_id}_{message.from_user.id}")]
+        [InlineKeyboardButton(text="Дополнить", callback_data=f"ticket_add_{ticket_id}")]
     ])
     
     try:
@@ -1052,63 +1453,61 @@ async def process_admin_reply(message: Message, state: FSMContext):
             text=f"💬 Ответ от администратора:\n\n{message.text}",
             reply_markup=keyboard
         )
+        add_ticket_message(ticket_id, message.from_user.id, True, message.text or "Медиа-сообщение")
         
         # Отправляем подтверждение админу с кнопкой "Завершить диалог"
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Завершить диалог", callback_data=f"support_close_{user_id}")]
+            [InlineKeyboardButton(text="Завершить диалог", callback_data=f"ticket_close_{ticket_id}")]
         ])
         
         await message.answer(
-            f"✅ Ответ отправлен пользователю (ID: {user_id})",
+            f"✅ {confirmation} (тикет #{ticket_id}, ID: {user_id})",
             reply_markup=keyboard
         )
         
-        log_admin_action(message.from_user, f"Ответил пользователю {user_id} в поддержке")
+        log_admin_action(message.from_user, f"{action} {user_id} (тикет #{ticket_id})")
     except Exception as e:
         await message.answer(f"❌ Ошибка отправки ответа: {str(e)}")
-        log_error("SUPPORT_REPLY", f"Ошибка отправки ответа пользователю {user_id}", str(e))
+        log_error(error_type, f"Ошибка отправки ответа пользователю {user_id}", str(e))
     
     await state.clear()
 
 
-@dp.callback_query(F.data.startswith("support_add_"))
-async def handle_support_add(callback: CallbackQuery, state: FSMContext):
+@dp.message(SupportStates.admin_waiting_for_reply)
+async def process_admin_reply(message: Message, state: FSMContext):
+    """Обработка ответа админа пользователю"""
+    await send_admin_reply(
+        message, state,
+        "Ответ отправлен пользователю",
+        "Ответил пользователю в поддержке",
+        "SUPPORT_REPLY"
+    )
+
+
+@dp.callback_query(F.data.startswith("ticket_add_"))
+async def handle_ticket_add(callback: CallbackQuery, state: FSMContext):
     """Обработка нажатия кнопки 'Дополнить' пользователем"""
-    # Формат: support_add_{user_id}_{admin_id}
-    parts = callback.data.split("_")
-    user_id = int(parts[2])
-    admin_id = int(parts[3])
+    ticket_id = int(callback.data.split("_")[-1])
+    ticket = get_ticket(ticket_id)
     
     # Проверяем, что нажал правильный пользователь
-    if callback.from_user.id != user_id:
+    if not ticket or callback.from_user.id != ticket["user_id"]:
         await callback.answer("❌ Это не ваше сообщение.", show_alert=True)
         return
     
-    # Проверяем, что диалог еще активен
-    if user_id not in active_support_dialogs:
+    # Проверяем, что тикет еще в работе
+    if ticket["status"] != "assigned":
         await callback.answer("❌ Диалог был завершен администратором.", show_alert=True)
         return
     
-    # Проверяем, что админ все еще тот же
-    if active_support_dialogs[user_id]["admin_id"] != admin_id:
-        await callback.answer("❌ Диалог был передан другому администратору.", show_alert=True)
-        return
-    
-    # Убираем префикс из текста сообщения
-    prefix = "💬 Ответ от администратора:\n\n"
-    message_text = callback.message.text
-    if message_text.startswith(prefix):
-        message_text = message_text[len(prefix):]
-    
-    await callback.message.edit_text(
-        f"💬 Ответ от администратора:\n\n{message_text}"
-    )
+    # Убираем кнопку, оставляя текст ответа
+    await callback.message.edit_text(callback.message.text)
     
     await callback.message.answer(
         "📝 Напишите ваше дополнение к сообщению:"
     )
     
-    await state.update_data(admin_id=admin_id, user_id=user_id)
+    await state.update_data(ticket_id=ticket_id)
     await state.set_state(SupportStates.waiting_for_addition)
     
     await callback.answer()
@@ -1122,34 +1521,30 @@ async def process_user_addition(message: Message, state: FSMContext):
         return
     
     data = await state.get_data()
-    admin_id = data.get("admin_id")
-    user_id = data.get("user_id")
+    ticket_id = data.get("ticket_id")
+    ticket = get_ticket(ticket_id) if ticket_id else None
     
-    # Проверяем, что диалог еще активен
-    if user_id not in active_support_dialogs:
+    # Проверяем, что тикет еще в работе
+    if not ticket or ticket["status"] != "assigned":
         await message.answer("❌ Диалог был завершен администратором.")
         await state.clear()
         return
     
-    # Проверяем, что админ все еще тот же
-    if active_support_dialogs[user_id]["admin_id"] != admin_id:
-        await message.answer("❌ Диалог был передан другому администратору.")
-        await state.clear()
-        return
-    
+    user_id = ticket["user_id"]
+    admin_id = ticket["admin_id"]
     user_name = f"{message.from_user.first_name or ''} {message.from_user.last_name or ''}".strip() or "Без имени"
     
     # Отправляем дополнение админу
     addition_text = (
-        f"📝 Дополнение от пользователя\n\n"
+        f"📝 Дополнение от пользователя (тикет #{ticket_id})\n\n"
         f"👤 Пользователь: {user_name}\n"
         f"🆔 ID: {user_id}\n\n"
         f"💬 Дополнение:\n{message.text or 'Медиа-сообщение'}"
     )
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Ответить", callback_data=f"support_reply_add_{user_id}")],
-        [InlineKeyboardButton(text="Завершить диалог", callback_data=f"support_close_{user_id}")]
+        [InlineKeyboardButton(text="Ответить", callback_data=f"ticket_reply_{ticket_id}")],
+        [InlineKeyboardButton(text="Завершить диалог", callback_data=f"ticket_close_{ticket_id}")]
     ])
     
     try:
@@ -1158,6 +1553,7 @@ async def process_user_addition(message: Message, state: FSMContext):
             text=addition_text,
             reply_markup=keyboard
         )
+        add_ticket_message(ticket_id, user_id, False, message.text or "Медиа-сообщение")
         
         await message.answer("✅ Ваше дополнение отправлено администратору.")
         log_user_action(message.from_user, f"Отправил дополнение в поддержку: {message.text[:50] if message.text else 'Медиа'}")
@@ -1168,21 +1564,21 @@ async def process_user_addition(message: Message, state: FSMContext):
     await state.clear()
 
 
-@dp.callback_query(F.data.startswith("support_reply_add_"))
-async def handle_support_reply_to_addition(callback: CallbackQuery, state: FSMContext):
+@dp.callback_query(F.data.startswith("ticket_reply_"))
+async def handle_ticket_reply(callback: CallbackQuery, state: FSMContext):
     """Обработка нажатия кнопки 'Ответить' на дополнение"""
     if not is_admin(callback.from_user.id) and callback.from_user.id != CREATOR_ID:
         await callback.answer("❌ У вас нет прав для этого действия.", show_alert=True)
         return
     
-    user_id = int(callback.data.split("_")[-1])
+    ticket = get_ticket(int(callback.data.split("_")[-1]))
     
-    # Проверяем, что диалог еще активен и админ правильный
-    if user_id not in active_support_dialogs:
+    # Проверяем, что тикет еще в работе и админ правильный
+    if not ticket or ticket["status"] != "assigned":
         await callback.answer("❌ Диалог был завершен.", show_alert=True)
         return
     
-    if active_support_dialogs[user_id]["admin_id"] != callback.from_user.id:
+    if ticket["admin_id"] != callback.from_user.id:
         await callback.answer("❌ Этот диалог обрабатывается другим администратором.", show_alert=True)
         return
     
@@ -1190,8 +1586,7 @@ async def handle_support_reply_to_addition(callback: CallbackQuery, state: FSMCo
         f"{callback.message.text}\n\n✅ Вы отвечаете на дополнение. Напишите ответ:"
     )
     
-    await state.update_data(user_id=user_id, original_message_id=callback.message.message_id)
-    await state.set_state(SupportStates.admin_waiting_for_reply_to_addition)
+    await begin_ticket_reply(state, ticket, SupportStates.admin_waiting_for_reply_to_addition)
     
     await callback.answer()
 
@@ -1199,76 +1594,33 @@ async def handle_support_reply_to_addition(callback: CallbackQuery, state: FSMCo
 @dp.message(SupportStates.admin_waiting_for_reply_to_addition)
 async def process_admin_reply_to_addition(message: Message, state: FSMContext):
     """Обработка ответа админа на дополнение"""
-    if not is_admin(message.from_user.id) and message.from_user.id != CREATOR_ID:
-        await state.clear()
-        return
-    
-    data = await state.get_data()
-    user_id = data.get("user_id")
-    
-    if not user_id or user_id not in active_support_dialogs:
-        await message.answer("❌ Диалог не найден или был завершен.")
-        await state.clear()
-        return
-    
-    # Проверяем, что отвечает тот же админ
-    if active_support_dialogs[user_id]["admin_id"] != message.from_user.id:
-        await message.answer("❌ Этот диалог обрабатывается другим администратором.")
-        await state.clear()
-        return
-    
-    admin_name = f"{message.from_user.first_name or ''} {message.from_user.last_name or ''}".strip() or "Администратор"
-    
-    # Отправляем ответ пользователю с кнопкой "Дополнить"
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Дополнить", callback_data=f"support_add_{user_id}_{message.from_user.id}")]
-    ])
-    
-    try:
-        await bot.send_message(
-            chat_id=user_id,
-            text=f"💬 Ответ от администратора:\n\n{message.text}",
-            reply_markup=keyboard
-        )
-        
-        # Отправляем подтверждение админу с кнопкой "Завершить диалог"
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Завершить диалог", callback_data=f"support_close_{user_id}")]
-        ])
-        
-        await message.answer(
-            f"✅ Ответ на дополнение отправлен пользователю (ID: {user_id})",
-            reply_markup=keyboard
-        )
-        
-        log_admin_action(message.from_user, f"Ответил на дополнение пользователя {user_id}")
-    except Exception as e:
-        await message.answer(f"❌ Ошибка отправки ответа: {str(e)}")
-        log_error("SUPPORT_REPLY_ADDITION", f"Ошибка отправки ответа на дополнение пользователю {user_id}", str(e))
-    
-    await state.clear()
+    await send_admin_reply(
+        message, state,
+        "Ответ на дополнение отправлен пользователю",
+        "Ответил на дополнение пользователя",
+        "SUPPORT_REPLY_ADDITION"
+    )
 
 
-@dp.callback_query(F.data.startswith("support_close_"))
-async def handle_support_close(callback: CallbackQuery, state: FSMContext):
+@dp.callback_query(F.data.startswith("ticket_close_"))
+async def handle_ticket_close(callback: CallbackQuery, state: FSMContext):
     """Обработка нажатия кнопки 'Завершить диалог'"""
     if not is_admin(callback.from_user.id) and callback.from_user.id != CREATOR_ID:
         await callback.answer("❌ У вас нет прав для этого действия.", show_alert=True)
         return
     
-    user_id = int(callback.data.split("_")[-1])
+    ticket = get_ticket(int(callback.data.split("_")[-1]))
     
-    # Проверяем, что диалог существует и админ правильный
-    if user_id not in active_support_dialogs:
+    # Проверяем, что тикет существует и админ правильный
+    if not ticket or ticket["status"] == "closed":
         await callback.answer("❌ Диалог уже завершен.", show_alert=True)
         return
     
-    if active_support_dialogs[user_id]["admin_id"] != callback.from_user.id:
+    if not close_ticket(ticket["id"], callback.from_user.id):
         await callback.answer("❌ Вы не можете завершить чужой диалог.", show_alert=True)
         return
     
-    # Удаляем диалог из активных
-    del active_support_dialogs[user_id]
+    user_id = ticket["user_id"]
     
     # Уведомляем пользователя
     try:
@@ -1284,10 +1636,172 @@ async def handle_support_close(callback: CallbackQuery, state: FSMContext):
         f"{callback.message.text}\n\n✅ Диалог завершен."
     )
     
-    log_admin_action(callback.from_user, f"Завершил диалог поддержки с пользователем {user_id}")
+    # Если админ еще не отправил ответ по этому тикету, выходим из режима ответа
+    data = await state.get_data()
+    if data.get("ticket_id") == ticket["id"]:
+        await state.clear()
+    
+    log_admin_action(callback.from_user, f"Закрыл тикет #{ticket['id']} пользователя {user_id}")
     await callback.answer("Диалог завершен")
 
 
+def render_tickets_page(ticket_filter: str, admin_id: int, before_id: Optional[int] = None,
+                        after_id: Optional[int] = None) -> Tuple[Optional[str], Optional[InlineKeyboardMarkup]]:
+    """Формирует страницу списка тикетов и клавиатуру навигации"""
+    page = get_tickets_page(
+        status=None if ticket_filter in ("all", "my") else ticket_filter,
+        admin_id=admin_id if ticket_filter == "my" else None,
+        before_id=before_id,
+        after_id=after_id,
+        limit=TICKET_PAGE_SIZE
+    )
+    
+    if not page["rows"]:
+        return None, None
+    
+    counts = get_ticket_counts()
+    text = (
+        f"🎫 Тикеты ({ticket_filter})\n"
+        f"Ожидают: {counts['open']} | В работе: {counts['assigned']} | Закрыто: {counts['closed']}\n\n"
+    )
+    for ticket in page["rows"]:
+        text += (
+            f"#{ticket['id']} {TICKET_STATUS_NAMES.get(ticket['status'], ticket['status'])} | "
+            f"👤 {ticket['user_id']} | 🕒 {format_timestamp(ticket['created_at'])}"
+        )
+        if ticket["admin_id"]:
+            text += f" | 👮 {ticket['admin_id']}"
+        text += "\n"
+    text += "\n/ticket id - переписка, /nextticket - взять следующий"
+    
+    # Кнопки расположены так же, как в просмотре логов: старее слева, новее справа
+    buttons = []
+    if page["has_older"]:
+        buttons.append(InlineKeyboardButton(
+            text="⬅️ Старее",
+            callback_data=f"tickets_{ticket_filter}_o_{page['rows'][-1]['id']}"
+        ))
+    if page["has_newer"]:
+        buttons.append(InlineKeyboardButton(
+            text="Новее ➡️",
+            callback_data=f"tickets_{ticket_filter}_n_{page['rows'][0]['id']}"
+        ))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    
+    return text[:4096], keyboard
+
+
+@dp.message(Command("tickets"))
+async def cmd_tickets(message: Message):
+    """Команда /tickets [open|assigned|closed|my|all]"""
+    if not await check_admin(message):
+        return
+    
+    if not await check_ban_middleware(message):
+        return
+    
+    log_admin_action(message.from_user, "/tickets")
+    
+    args = message.text.split()[1:]
+    ticket_filter = args[0] if args else "open"
+    if ticket_filter not in TICKET_STATUS_NAMES and ticket_filter not in ("all", "my"):
+        await message.answer("Использование: /tickets [open|assigned|closed|my|all]")
+        return
+    
+    text, keyboard = render_tickets_page(ticket_filter, message.from_user.id)
+    if not text:
+        await message.answer("🎫 Тикетов нет.")
+        return
+    
+    await message.answer(text, reply_markup=keyboard)
+
+
+@dp.callback_query(F.data.startswith("tickets_"))
+async def handle_tickets_page(callback: CallbackQuery):
+    """Обработка кнопок 'Старее'/'Новее' в списке тикетов"""
+    if not is_admin(callback.from_user.id) and callback.from_user.id != CREATOR_ID:
+        await callback.answer("❌ У вас нет прав для этого действия.", show_alert=True)
+        return
+    
+    # Формат: tickets_{filter}_{o|n}_{id}
+    _, ticket_filter, direction, cursor_id = callback.data.split("_")
+    if direction == "o":
+        text, keyboard = render_tickets_page(ticket_filter, callback.from_user.id, before_id=int(cursor_id))
+    else:
+        text, keyboard = render_tickets_page(ticket_filter, callback.from_user.id, after_id=int(cursor_id))
+    
+    if not text:
+        await callback.answer("Больше тикетов нет.")
+        return
+    
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+
+@dp.message(Command("ticket"))
+async def cmd_ticket(message: Message):
+    """Команда /ticket id - тикет и его переписка"""
+    if not await check_admin(message):
+        return
+    
+    if not await check_ban_middleware(message):
+        return
+    
+    args = message.text.split()[1:]
+    if not args or not args[0].lstrip("#").isdigit():
+        await message.answer("Использование: /ticket id")
+        return
+    
+    ticket = get_ticket(int(args[0].lstrip("#")))
+    log_admin_action(message.from_user, f"/ticket {args[0]}")
+    if not ticket:
+        await message.answer("❌ Тикет не найден.")
+        return
+    
+    text = (
+        f"🎫 Тикет #{ticket['id']} - {TICKET_STATUS_NAMES.get(ticket['status'], ticket['status'])}\n\n"
+        f"👤 Пользователь: {format_ticket_user(ticket['user_id'])}\n"
+        f"🆔 ID: {ticket['user_id']}\n"
+        f"🕒 Создан: {format_timestamp(ticket['created_at'])}\n"
+    )
+    if ticket["admin_id"]:
+        text += f"👮 Администратор: {ticket['admin_id']}\n"
+    if ticket["closed_at"]:
+        text += f"✅ Закрыт: {format_timestamp(ticket['closed_at'])}\n"
+    text += f"\n{format_ticket_history(ticket['id'])}"
+    
+    keyboard = None
+    if ticket["status"] == "open":
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Прочитать и ответить", callback_data=f"ticket_take_{ticket['id']}")]
+        ])
+    
+    await message.answer(text[:4096], reply_markup=keyboard)
+
+
+@dp.message(Command("nextticket"))
+async def cmd_nextticket(message: Message, state: FSMContext):
+    """Команда /nextticket - взять самый старый неназначенный тикет"""
+    if not await check_admin(message):
+        return
+    
+    if not await check_ban_middleware(message):
+        return
+    
+    log_admin_action(message.from_user, "/nextticket")
+    
+    ticket = take_next_ticket(message.from_user.id)
+    if not ticket:
+        await message.answer("🎫 Очередь пуста: неназначенных тикетов нет.")
+        return
+    
+    text, keyboard = render_taken_ticket(ticket)
+    await message.answer(text, reply_markup=keyboard)
+    await begin_ticket_reply(state, ticket, SupportStates.admin_waiting_for_reply)
+    
+    log_admin_action(message.from_user, f"Взял тикет #{ticket['id']} пользователя {ticket['user_id']}")
+
+
 @dp.message(Command("tonconnect"))
 async def cmd_tonconnect(message: Message):
     """Команда /tonconnect - подключение TON кошелька"""
@@ -1613,11 +2127,17 @@ async def cmd_help(message: Message):
         help_text += "/sendsms текст - рассылка всем пользователям\n"
         help_text += "/sendprivat текст --id123456789 - отправка сообщения одному пользователю\n"
     help_text += "/search id - информация о пользователе\n"
-    help_text += "/userlogs - последние 20 строк логов пользователей\n"
-    help_text += "/errorlogs - последние 20 строк логов ошибок\n"
+    help_text += "/tickets [open|assigned|closed|my|all] - тикеты поддержки\n"
+    help_text += "/ticket id - переписка по тикету\n"
+    help_text += "/nextticket - взять следующий тикет из очереди\n"
+    help_text += "/userlogs [user=id] [from=дата] [to=дата] - логи пользователей с листанием\n"
+    help_text += "/errorlogs [type=тип] [from=дата] [to=дата] - логи ошибок с листанием\n"
+    help_text += "/logsearch [table=u|e|a|s] текст - поиск по логам\n"
+    help_text += "/exportlogs таблица [csv|jsonl] [from=дата] [to=дата] - выгрузка логов файлом\n"
     help_text += "/ailogs - последние 20 строк логов AI запросов\n"
     help_text += "/aistats - общая статистика по AI запросам\n"
     help_text += "/aistats_user id - статистика AI запросов конкретного пользователя\n"
+    help_text += "/slowqueries [stats] - медленные SQL запросы и статистика по функциям\n"
     help_text += "/ping - время отклика бота\n\n"
     
     # Команды только для создателя
@@ -1630,9 +2150,11 @@ async def cmd_help(message: Message):
         help_text += "/masssendcoin сумма - массовая выдача монет всем\n"
         help_text += "/newach id название - создать новое достижение\n"
         help_text += "/deleteach idДОСТИЖЕНИЯ - удалить достижение из системы\n"
-        help_text += "/adminlogs - логи администраторов\n"
-        help_text += "/systemlogs - системные логи\n"
+        help_text += "/adminlogs [user=id] [from=дата] [to=дата] - логи администраторов\n"
+        help_text += "/systemlogs [from=дата] [to=дата] - системные логи\n"
         help_text += "/test - статистика системы\n"
+        help_text += "/memprofile [on|off|top|diff|reset] - профилирование памяти процесса\n"
+        help_text += "/cpuprofile [секунд] [sample|pstats] - профилирование процессора\n"
     
     await message.answer(help_text)
 
@@ -1956,23 +2478,30 @@ async def cmd_search(message: Message):
         return
     
     user_id = user_info[0]
-    profile = get_user_profile(int(user_id))
+    card = get_user_card(int(user_id))
+    profile = card["profile"]
     
     if not profile:
         await message.answer("Профиль не найден.")
         return
     
-    balance = get_user_balance(int(user_id))
-    achievements = get_user_achievements(int(user_id))
+    balance = card["balance"]
+    achievements = card["achievements"]
     
     info_text = (
         f"🔍 Информация о пользователе\n\n"
         f"Имя и Фамилия: {profile['name']}\n"
         f"Username: @{profile['username'] if profile['username'] != 'NA' else 'отсутствует'}\n"
         f"Telegram ID: {profile['id']}\n"
-        f"Дата первого запуска: {profile['first_start']}\n"
-        f"Баланс: {balance} TPCoin\n\n"
+        f"Статус: {get_user_status(int(user_id))}\n"
+        f"Дата первого запуска: {format_timestamp(profile['first_start'])}\n"
+        f"Баланс: {balance} TPCoin\n"
     )
+    if card["is_banned"]:
+        info_text += "Заблокирован: да\n"
+    if card["unban_time"] and card["unban_time"] > time.time():
+        info_text += f"Временный бан до: {format_timestamp(card['unban_time'])}\n"
+    info_text += "\n"
     
     if achievements:
         info_text += "🏆 Достижения:\n"
@@ -1981,65 +2510,349 @@ async def cmd_search(message: Message):
     else:
         info_text += "Достижений нет."
     
-    await message.answer(info_text)
+    await message.answer(info_text)
+
+
+# ========== ПРОСМОТР ЛОГОВ С ПАГИНАЦИЕЙ ==========
+
+LOG_PAGE_SIZE = 20
+
+# Короткие коды таблиц для callback_data (лимит Telegram - 64 байта)
+LOG_BROWSER_TABLES = {
+    "u": {"table": "user_logs", "title": "Логи пользователей", "empty": "Логи пусты.", "creator_only": False},
+    "e": {"table": "error_logs", "title": "Логи ошибок", "empty": "Логи ошибок пусты.", "creator_only": False},
+    "a": {"table": "admin_logs", "title": "Логи администраторов", "empty": "Логи пусты.", "creator_only": True},
+    "s": {"table": "system_logs", "title": "Системные логи", "empty": "Логи пусты.", "creator_only": True}
+}
+
+LOG_FILTERS_CACHE_SIZE = 1000
+# Сколько секунд фильтр доступен для листания после последнего сохранения
+LOG_FILTERS_TTL = 86400
+
+# Фильтры просмотра не помещаются в callback_data, поэтому хранятся по короткому ключу
+# Формат: {key: {"user_id": int, "error_type": str, "since": int, "until": int}}
+log_browser_filters = LRUCache(maxsize=LOG_FILTERS_CACHE_SIZE, ttl=LOG_FILTERS_TTL)
+
+
+def parse_log_filters(args: List[str]) -> Dict:
+    """Разбирает фильтры вида user=id type=ТИП from=ГГГГ-ММ-ДД to=ГГГГ-ММ-ДД"""
+    filters = {}
+    for arg in args:
+        if "=" not in arg:
+            raise ValueError(f"Неизвестный аргумент: {arg}")
+        key, value = arg.split("=", 1)
+        if key == "user" and value.isdigit():
+            filters["user_id"] = int(value)
+        elif key == "type":
+            filters["error_type"] = value
+        elif key == "from":
+            filters["since"] = to_epoch(datetime.strptime(value, "%Y-%m-%d"))
+        elif key == "to":
+            # Дата окончания включительно
+            until = datetime.strptime(value, "%Y-%m-%d") + timedelta(days=1)
+            filters["until"] = to_epoch(until)
+        else:
+            raise ValueError(f"Неизвестный фильтр: {key}")
+    return filters
+
+
+# Имена фильтров в командах: {ключ фильтра: аргумент}
+LOG_FILTER_ARGS = {"user_id": "user", "error_type": "type"}
+
+
+def inapplicable_log_filters(table_name: str, filters: Dict) -> List[str]:
+    """Аргументы фильтров, которые не применимы к таблице логов (from и to применимы ко всем)"""
+    return [
+        LOG_FILTER_ARGS[key] for key in filters
+        if key in LOG_FILTER_ARGS and key not in LOG_TABLES[table_name]["filters"]
+    ]
+
+
+def save_log_filters(filters: Dict) -> str:
+    """Сохраняет фильтры и возвращает ключ для callback_data"""
+    if not filters:
+        return "0"
+    key = hashlib.sha1(json.dumps(filters, sort_keys=True).encode()).hexdigest()[:10]
+    log_browser_filters.set(key, filters)
+    return key
+
+
+def render_logs_page(code: str, filters_key: str, before_id: Optional[int] = None,
+                     after_id: Optional[int] = None) -> Tuple[Optional[str], Optional[InlineKeyboardMarkup]]:
+    """Формирует текст страницы логов и клавиатуру навигации"""
+    browser = LOG_BROWSER_TABLES[code]
+    filters = log_browser_filters.get(filters_key, {}) if filters_key != "0" else {}
+    page = get_logs_page(
+        browser["table"],
+        before_id=before_id,
+        after_id=after_id,
+        limit=LOG_PAGE_SIZE,
+        **filters
+    )
+    
+    if not page["rows"]:
+        return None, None
+    
+    log_text = f"📋 {browser['title']}"
+    if filters:
+        log_text += " (" + ", ".join(
+            f"{key}={format_timestamp(value) if key in ('since', 'until') else value}"
+            for key, value in filters.items()
+        ) + ")"
+    log_text += ":\n\n"
+    for row in page["rows"]:
+        # Обрезаем длинные строки, чтобы страница поместилась в одно сообщение
+        log_text += format_log_row(browser["table"], row)[:190] + "\n"
+    
+    buttons = []
+    if page["has_older"]:
+        buttons.append(InlineKeyboardButton(
+            text="⬅️ Старее",
+            callback_data=f"logs_{code}_o_{page['rows'][0]['id']}_{filters_key}"
+        ))
+    if page["has_newer"]:
+        buttons.append(InlineKeyboardButton(
+            text="Новее ➡️",
+            callback_data=f"logs_{code}_n_{page['rows'][-1]['id']}_{filters_key}"
+        ))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    
+    return log_text[:4096], keyboard
+
+
+async def send_logs_page(message: Message, code: str):
+    """Отправляет первую страницу логов с учетом фильтров из аргументов команды"""
+    args = message.text.split()[1:]
+    try:
+        filters = parse_log_filters(args)
+    except ValueError:
+        await message.answer(
+            "❌ Неверный фильтр.\n\n"
+            "Фильтры: user=id, type=ТИП_ОШИБКИ, from=ГГГГ-ММ-ДД, to=ГГГГ-ММ-ДД"
+        )
+        return
+    
+    browser = LOG_BROWSER_TABLES[code]
+    inapplicable = inapplicable_log_filters(browser["table"], filters)
+    if inapplicable:
+        await message.answer(
+            f"❌ Фильтр {', '.join(inapplicable)} не применим к разделу «{browser['title']}» ({browser['table']})."
+        )
+        return
+    
+    log_text, keyboard = render_logs_page(code, save_log_filters(filters))
+    if not log_text:
+        await message.answer(LOG_BROWSER_TABLES[code]["empty"])
+        return
+    
+    await message.answer(log_text, reply_markup=keyboard)
+
+
+@dp.callback_query(F.data.startswith("logs_"))
+async def handle_logs_page(callback: CallbackQuery):
+    """Обработка кнопок 'Старее'/'Новее' в просмотре логов"""
+    # Формат: logs_{code}_{o|n}_{id}_{filters_key}
+    _, code, direction, cursor_id, filters_key = callback.data.split("_")
+    browser = LOG_BROWSER_TABLES.get(code)
+    if not browser:
+        await callback.answer()
+        return
+    
+    user_id = callback.from_user.id
+    allowed = user_id == CREATOR_ID or (not browser["creator_only"] and is_admin(user_id))
+    if not allowed:
+        await callback.answer("❌ У вас нет прав для этого действия.", show_alert=True)
+        return
+    
+    if filters_key != "0" and log_browser_filters.get(filters_key) is CACHE_MISS:
+        await callback.answer("⚠️ Фильтр устарел. Повторите команду.", show_alert=True)
+        return
+    
+    if direction == "o":
+        log_text, keyboard = render_logs_page(code, filters_key, before_id=int(cursor_id))
+    else:
+        log_text, keyboard = render_logs_page(code, filters_key, after_id=int(cursor_id))
+    
+    if not log_text:
+        await callback.answer("Больше записей нет.")
+        return
+    
+    await callback.message.edit_text(log_text, reply_markup=keyboard)
+    await callback.answer()
+
+
+@dp.message(Command("userlogs"))
+async def cmd_userlogs(message: Message):
+    """Команда /userlogs"""
+    if not await check_admin(message):
+        return
+    
+    if not await check_ban_middleware(message):
+        return
+    
+    log_admin_action(message.from_user, "/userlogs")
+    
+    await send_logs_page(message, "u")
+
+
+@dp.message(Command("errorlogs"))
+async def cmd_errorlogs(message: Message):
+    """Команда /errorlogs"""
+    if not await check_admin(message):
+        return
+    
+    if not await check_ban_middleware(message):
+        return
+    
+    log_admin_action(message.from_user, "/errorlogs")
+    
+    await send_logs_page(message, "e")
 
 
-@dp.message(Command("userlogs"))
-async def cmd_userlogs(message: Message):
-    """Команда /userlogs"""
+@dp.message(Command("logsearch"))
+async def cmd_logsearch(message: Message):
+    """Команда /logsearch - полнотекстовый поиск по логам"""
     if not await check_admin(message):
         return
     
     if not await check_ban_middleware(message):
         return
     
-    log_admin_action(message.from_user, "/userlogs")
+    log_admin_action(message.from_user, "/logsearch")
+    
+    if not is_fts_available():
+        await message.answer("❌ Поиск по логам недоступен: SQLite собран без FTS5.")
+        return
+    
+    usage = (
+        "Использование: /logsearch [table=u|e|a|s] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] текст\n\n"
+        "u - пользователи, e - ошибки, a - администраторы, s - системные"
+    )
     
-    logs = get_last_logs("user_logs", 20)
+    # Аргументы вида ключ=значение - фильтры, остальное - поисковый запрос
+    args = message.text.split()[1:]
+    filter_args = [arg for arg in args if arg.split("=", 1)[0] in ("table", "from", "to") and "=" in arg]
+    query = " ".join(arg for arg in args if arg not in filter_args)
     
-    if not logs:
-        await message.answer("Логи пусты.")
+    codes = [arg.split("=", 1)[1] for arg in filter_args if arg.startswith("table=")]
+    try:
+        filters = parse_log_filters([arg for arg in filter_args if not arg.startswith("table=")])
+    except ValueError:
+        await message.answer(f"❌ Неверный фильтр.\n\n{usage}")
         return
     
-    log_text = "📋 Последние 20 строк логов пользователей:\n\n"
-    log_text += "".join(logs)
+    if not query or any(code not in LOG_BROWSER_TABLES for code in codes):
+        await message.answer(usage)
+        return
     
-    # Разбиваем на части, если сообщение слишком длинное
-    if len(log_text) > 4096:
-        parts = [log_text[i:i+4096] for i in range(0, len(log_text), 4096)]
-        for part in parts:
-            await message.answer(part)
-    else:
-        await message.answer(log_text)
+    # Логи администраторов и системные логи доступны только создателю
+    if not codes:
+        codes = [code for code in LOG_BROWSER_TABLES if message.from_user.id == CREATOR_ID or not LOG_BROWSER_TABLES[code]["creator_only"]]
+    elif message.from_user.id != CREATOR_ID and any(LOG_BROWSER_TABLES[code]["creator_only"] for code in codes):
+        await message.answer("❌ Эти логи доступны только создателю бота.")
+        return
+    
+    tables = [LOG_BROWSER_TABLES[code]["table"] for code in codes]
+    results = search_logs(query, tables=tables, limit=LOG_PAGE_SIZE, **filters)
+    
+    if not results:
+        await message.answer("🔍 Ничего не найдено.")
+        return
+    
+    table_titles = {browser["table"]: browser["title"] for browser in LOG_BROWSER_TABLES.values()}
+    result_text = f"🔍 Результаты поиска «{query}»:\n\n"
+    for table, row in results:
+        result_text += f"[{table_titles[table]}] {format_log_row(table, row)[:170]}\n"
+    
+    await message.answer(result_text[:4096])
 
 
-@dp.message(Command("errorlogs"))
-async def cmd_errorlogs(message: Message):
-    """Команда /errorlogs"""
+# Таблицы для /exportlogs: имя -> доступно ли администраторам (иначе только создателю)
+EXPORT_LOG_TABLES = {
+    "user_logs": True,
+    "error_logs": True,
+    "ai_requests": True,
+    "admin_logs": False,
+    "admin_command_logs": False,
+    "system_logs": False,
+    "transfer_logs": False
+}
+
+# Ограничение Bot API на размер отправляемого документа
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+
+@dp.message(Command("exportlogs"))
+async def cmd_exportlogs(message: Message):
+    """Команда /exportlogs - выгрузка логов файлом"""
     if not await check_admin(message):
         return
     
     if not await check_ban_middleware(message):
         return
     
-    log_admin_action(message.from_user, "/errorlogs")
+    log_admin_action(message.from_user, "/exportlogs")
     
-    logs = get_last_logs("error_logs", 20)
+    usage = (
+        "Использование: /exportlogs таблица [csv|jsonl] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]\n\n"
+        f"Таблицы: {', '.join(EXPORT_LOG_TABLES)}"
+    )
     
-    if not logs:
-        await message.answer("Логи ошибок пусты.")
+    args = message.text.split()[1:]
+    if not args or args[0] not in EXPORT_LOG_TABLES:
+        await message.answer(usage)
         return
     
-    log_text = "📋 Последние 20 строк логов ошибок:\n\n"
-    log_text += "".join(logs)
+    table = args[0]
+    fmt = "csv"
+    filter_args = []
+    for arg in args[1:]:
+        if arg in ("csv", "jsonl"):
+            fmt = arg
+        else:
+            filter_args.append(arg)
     
-    # Разбиваем на части, если сообщение слишком длинное
-    if len(log_text) > 4096:
-        parts = [log_text[i:i+4096] for i in range(0, len(log_text), 4096)]
-        for part in parts:
-            await message.answer(part)
-    else:
-        await message.answer(log_text)
+    try:
+        filters = parse_log_filters(filter_args)
+    except ValueError:
+        await message.answer(f"❌ Неверный фильтр.\n\n{usage}")
+        return
+    if "user_id" in filters or "error_type" in filters:
+        await message.answer(f"❌ Для выгрузки доступны только фильтры from и to.\n\n{usage}")
+        return
+    
+    if not EXPORT_LOG_TABLES[table] and message.from_user.id != CREATOR_ID:
+        await message.answer("❌ Эти логи доступны только создателю бота.")
+        return
+    
+    status_msg = await message.answer("⏳ Выгружаю логи...")
+    
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}.gz")
+    os.close(fd)
+    try:
+        # Запрос и сжатие идут в отдельном потоке, чтобы не блокировать обработку обновлений
+        exported = await asyncio.to_thread(export_logs, table, path, fmt, **filters)
+        
+        if not exported:
+            await status_msg.edit_text("Логи за выбранный период пусты.")
+            return
+        
+        if os.path.getsize(path) > MAX_DOCUMENT_SIZE:
+            await status_msg.edit_text("❌ Файл выгрузки больше 50 МБ. Укажите более узкий период (from/to).")
+            return
+        
+        filename = f"{table}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}.gz"
+        await message.answer_document(
+            FSInputFile(path, filename=filename),
+            caption=f"📦 {table}: {exported} записей"
+        )
+        await status_msg.delete()
+        log_admin_command(message.from_user, f"/exportlogs {table} {fmt} {exported}")
+    except Exception as e:
+        log_error("EXPORTLOGS", f"Ошибка выгрузки логов {table}", str(e))
+        await status_msg.edit_text("❌ Произошла ошибка при выгрузке логов.")
+    finally:
+        os.remove(path)
 
 
 @dp.message(Command("ailogs"))
@@ -2195,6 +3008,88 @@ async def cmd_ping(message: Message):
         await message.answer(f"❌ Ошибка: {str(e)}")
 
 
+@dp.message(Command("slowqueries"))
+async def cmd_slowqueries(message: Message):
+    """Команда /slowqueries [stats|on [мс]|off|reset] - журнал медленных SQL запросов"""
+    if not await check_admin(message):
+        return
+    
+    if not await check_ban_middleware(message):
+        return
+    
+    args = message.text.split()[1:]
+    action = args[0].lower() if args else "list"
+    log_admin_action(message.from_user, f"/slowqueries {action}")
+    
+    if action in ("on", "off", "reset"):
+        if message.from_user.id != CREATOR_ID:
+            await message.answer("❌ Включать и выключать профилирование может только создатель бота.")
+            return
+        
+        if action == "reset":
+            reset_query_stats()
+            await message.answer("✅ Статистика запросов этого процесса сброшена.")
+            return
+        
+        threshold_ms = None
+        if action == "on" and len(args) > 1:
+            try:
+                threshold_ms = float(args[1])
+            except ValueError:
+                await message.answer("❌ Порог должен быть числом в миллисекундах.")
+                return
+        
+        set_query_profiling(action == "on", threshold_ms)
+        if action == "on":
+            await message.answer(
+                f"✅ Профилирование запросов включено, порог медленного запроса: "
+                f"{QUERY_PROFILING['threshold_ms']:g} мс"
+            )
+        else:
+            await message.answer("✅ Профилирование запросов выключено.")
+        return
+    
+    status = "включено" if QUERY_PROFILING["enabled"] else "выключено"
+    header = f"🐢 Профилирование: {status}, порог {QUERY_PROFILING['threshold_ms']:g} мс\n\n"
+    
+    if action == "stats":
+        stats = get_query_stats()
+        if not stats:
+            await message.answer(header + "Статистики пока нет.")
+            return
+        
+        text = header + "📊 Запросы по функциям (этот процесс, по общему времени):\n\n"
+        for item in stats[:15]:
+            text += (
+                f"{item['function']}\n"
+                f"  вызовов {item['count']}, всего {item['total_ms']:.0f} мс, "
+                f"среднее {item['avg_ms']:.2f} мс, p99 {item['p99_ms']:.2f} мс\n"
+            )
+        await message.answer(text[:4096])
+        return
+    
+    if action != "list":
+        await message.answer("Использование: /slowqueries [stats|on [мс]|off|reset]")
+        return
+    
+    await asyncio.to_thread(flush_slow_queries)
+    slow_queries = get_slow_queries(10)
+    if not slow_queries:
+        await message.answer(header + "Медленных запросов нет.")
+        return
+    
+    text = header
+    for query in slow_queries:
+        text += (
+            f"[{format_timestamp(query['timestamp'])}] {query['function']} - {query['duration_ms']:.1f} мс\n"
+            f"{query['sql'][:300]}\n"
+        )
+        if query["query_plan"]:
+            text += f"📋 {query['query_plan'][:300]}\n"
+        text += "\n"
+    await message.answer(text[:4096])
+
+
 @dp.message(Command("achlist"))
 async def cmd_achlist(message: Message):
     """Команда /achlist - список всех достижений"""
@@ -2215,8 +3110,8 @@ async def cmd_achlist(message: Message):
     ach_text = "🏆 Список всех достижений:\n\n"
     for ach in achievements:
         ach_text += f"• {ach['name']} (ID: {ach['id']})\n"
-        if ach['created'] != "NA":
-            ach_text += f"  Создано: {ach['created']}\n"
+        if ach['created']:
+            ach_text += f"  Создано: {format_timestamp(ach['created'])}\n"
         ach_text += "\n"
     
     # Разбиваем на части, если сообщение слишком длинное
@@ -2249,7 +3144,7 @@ async def cmd_banlist(message: Message):
     for user in banned:
         ban_text += f"• {user['name']} (@{user['username'] if user['username'] != 'NA' else 'отсутствует'})\n"
         ban_text += f"  ID: {user['id']}\n"
-        ban_text += f"  Забанен: {user['banned_date']}\n"
+        ban_text += f"  Забанен: {format_timestamp(user['banned_date'])}\n"
         if user['banned_by'] != "NA":
             ban_text += f"  Забанен администратором: {user['banned_by']}\n"
         ban_text += "\n"
@@ -2296,9 +3191,8 @@ async def cmd_addbalance(message: Message):
         return
     
     target_id = int(user_info[0])
-    old_balance = get_user_balance(target_id)
-    add_user_balance(target_id, amount)
-    new_balance = get_user_balance(target_id)
+    new_balance = add_user_balance(target_id, amount)
+    old_balance = new_balance - amount
     
     log_admin_command(message.from_user, f"/addbalance {amount} {target_id}")
     
@@ -2385,7 +3279,8 @@ async def cmd_topbalance(message: Message):
     
     log_admin_action(message.from_user, "/topbalance")
     
-    top_users = get_top_users_by_balance(20)
+    # Топ хранится в памяти и перечитывается одним JOIN-запросом только после изменения
+    top_users = get_top_users_cached(20)
     
     if not top_users:
         await message.answer("Нет пользователей с балансом.")
@@ -2393,14 +3288,13 @@ async def cmd_topbalance(message: Message):
     
     top_text = "🏆 Топ пользователей по балансу:\n\n"
     
-    for idx, (user_id, balance) in enumerate(top_users, 1):
-        profile = get_user_profile(user_id)
-        if profile:
-            username = f"@{profile['username']}" if profile['username'] != 'NA' else "отсутствует"
-            top_text += f"{idx}. {profile['name']} ({username})\n"
+    for idx, user in enumerate(top_users, 1):
+        if user['name']:
+            username = f"@{user['username']}" if user['username'] != 'NA' else "отсутствует"
+            top_text += f"{idx}. {user['name']} ({username})\n"
         else:
-            top_text += f"{idx}. ID: {user_id}\n"
-        top_text += f"   💰 {balance} TPCoin\n\n"
+            top_text += f"{idx}. ID: {user['id']}\n"
+        top_text += f"   💰 {user['balance']} TPCoin\n\n"
     
     # Разбиваем на части, если сообщение слишком длинное
     if len(top_text) > 4096:
@@ -2915,21 +3809,7 @@ async def cmd_adminlogs(message: Message):
     
     log_admin_action(message.from_user, "/adminlogs")
     
-    logs = get_last_logs("admin_logs", 20)
-    
-    if not logs:
-        await message.answer("Логи пусты.")
-        return
-    
-    log_text = "📋 Последние 20 строк логов администраторов:\n\n"
-    log_text += "".join(logs)
-    
-    if len(log_text) > 4096:
-        parts = [log_text[i:i+4096] for i in range(0, len(log_text), 4096)]
-        for part in parts:
-            await message.answer(part)
-    else:
-        await message.answer(log_text)
+    await send_logs_page(message, "a")
 
 
 @dp.message(Command("systemlogs"))
@@ -2943,21 +3823,7 @@ async def cmd_systemlogs(message: Message):
     
     log_admin_action(message.from_user, "/systemlogs")
     
-    logs = get_last_logs("system_logs", 20)
-    
-    if not logs:
-        await message.answer("Логи пусты.")
-        return
-    
-    log_text = "📋 Последние 20 строк системных логов:\n\n"
-    log_text += "".join(logs)
-    
-    if len(log_text) > 4096:
-        parts = [log_text[i:i+4096] for i in range(0, len(log_text), 4096)]
-        for part in parts:
-            await message.answer(part)
-    else:
-        await message.answer(log_text)
+    await send_logs_page(message, "s")
 
 
 @dp.message(Command("adminlist"))
@@ -2989,8 +3855,8 @@ async def cmd_adminlist(message: Message):
         for admin in admins:
             admin_text += f"• {admin['name']} (@{admin['username'] if admin['username'] != 'NA' else 'отсутствует'})\n"
             admin_text += f"  ID: {admin['id']}\n"
-            if admin['added_date'] != "NA":
-                admin_text += f"  Назначен: {admin['added_date']}\n"
+            if admin['added_date']:
+                admin_text += f"  Назначен: {format_timestamp(admin['added_date'])}\n"
             admin_text += "\n"
     
     # Разбиваем на части, если сообщение слишком длинное
@@ -3047,8 +3913,7 @@ async def cmd_test(message: Message):
     total_balance = cursor.fetchone()["total"] or 0
     
     # Количество активных временных банов
-    from datetime import datetime
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    now = int(time.time())
     cursor.execute("SELECT COUNT(*) as count FROM temp_bans WHERE unban_time > ?", (now,))
     active_temp_bans = cursor.fetchone()["count"]
     
@@ -3086,11 +3951,187 @@ async def cmd_test(message: Message):
     report += f"  Логи команд админов: {logs_stats.get('admin_command_logs', 0)}\n"
     report += f"  Системные логи: {logs_stats.get('system_logs', 0)}\n"
     report += f"  Логи ошибок: {logs_stats.get('error_logs', 0)}\n"
-    report += f"  Логи переводов: {logs_stats.get('transfer_logs', 0)}\n"
+    report += f"  Логи переводов: {logs_stats.get('transfer_logs', 0)}\n\n"
+    
+    report += format_metrics_summary()
     
     await message.answer(report)
 
 
+def format_bytes(size: float) -> str:
+    """Размер в байтах в читаемом виде"""
+    for unit in ("B", "KB", "MB"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def get_registry_sizes() -> Dict[str, int]:
+    """Количество записей в глобальных реестрах и кэшах процесса"""
+    sizes = {
+        "active_connectors": len(active_connectors),
+        "registered_user_ids": len(registered_user_ids),
+        "user_lookup_cache": len(user_lookup_cache),
+        "known_user_identities": len(known_user_identities),
+        "log_browser_filters": len(log_browser_filters),
+        "fsm_states": len(storage.states),
+        "background_tasks": len(background_tasks),
+        "webhook_tasks": len(webhook_tasks)
+    }
+    sizes.update({f"database.{name}": size for name, size in get_cache_sizes().items()})
+    return sizes
+
+
+def format_memory_status() -> str:
+    """Память процесса, состояние tracemalloc и размеры реестров для /memprofile"""
+    rss = get_rss()
+    report = "🧠 Память процесса\n\n"
+    report += f"RSS: {format_bytes(rss) if rss is not None else 'неизвестно'}\n"
+    if memory_profiler.enabled:
+        current, peak = memory_profiler.traced_memory()
+        report += f"tracemalloc: включен, отслеживается {format_bytes(current)}, пик {format_bytes(peak)}\n"
+        report += f"Базовый снимок: {format_timestamp(memory_profiler.baseline_time)}\n"
+    else:
+        report += "tracemalloc: выключен\n"
+    
+    report += "\n📦 Реестры (записей):\n"
+    for name, size in get_registry_sizes().items():
+        report += f"  {name}: {size}\n"
+    return report
+
+
+@dp.message(Command("memprofile"))
+async def cmd_memprofile(message: Message):
+    """Команда /memprofile [on [кадров]|off|top|diff|reset] - профилирование памяти процесса"""
+    if not await check_creator(message):
+        return
+    
+    if not await check_ban_middleware(message):
+        return
+    
+    args = message.text.split()[1:]
+    action = args[0].lower() if args else "status"
+    log_admin_action(message.from_user, f"/memprofile {action}")
+    
+    if action == "on":
+        frames = 1
+        if len(args) > 1:
+            try:
+                frames = int(args[1])
+            except ValueError:
+                frames = 0
+            if not 1 <= frames <= 50:
+                await message.answer("❌ Глубина стека должна быть числом от 1 до 50.")
+                return
+        # Базовый снимок большой кучи занимает заметное время, поэтому снимается в потоке
+        await asyncio.to_thread(memory_profiler.start, frames)
+        await message.answer(
+            "✅ tracemalloc включен, базовый снимок снят.\n"
+            "/memprofile diff - рост памяти с этого момента, /memprofile top - крупнейшие места"
+        )
+        return
+    
+    if action == "off":
+        memory_profiler.stop()
+        await message.answer("✅ tracemalloc выключен, снимки удалены.")
+        return
+    
+    if action not in ("status", "top", "diff", "reset"):
+        await message.answer("Использование: /memprofile [on [кадров]|off|top|diff|reset]")
+        return
+    
+    if action != "status" and not memory_profiler.enabled:
+        await message.answer("❌ tracemalloc выключен. Включите его командой /memprofile on")
+        return
+    
+    if action == "reset":
+        await asyncio.to_thread(memory_profiler.take_baseline)
+        await message.answer("✅ Базовый снимок снят заново.")
+        return
+    
+    report = format_memory_status()
+    if action == "top":
+        report += "\n🔝 Крупнейшие места выделения памяти:\n"
+        for item in await asyncio.to_thread(memory_profiler.top, 15):
+            report += f"  {format_bytes(item['size'])} ({item['count']} объектов) {item['location']}\n"
+    elif action == "diff":
+        report += "\n📈 Рост с базового снимка:\n"
+        for item in await asyncio.to_thread(memory_profiler.diff, 15):
+            report += (
+                f"  {'+' if item['size_diff'] >= 0 else ''}{format_bytes(item['size_diff'])} "
+                f"({item['count_diff']:+d} объектов, всего {format_bytes(item['size'])}) {item['location']}\n"
+            )
+    
+    await message.answer(report[:4096])
+
+
+@dp.message(Command("cpuprofile"))
+async def cmd_cpuprofile(message: Message):
+    """Команда /cpuprofile [секунд] [sample|pstats] - профилирование процессора"""
+    if not await check_creator(message):
+        return
+    
+    if not await check_ban_middleware(message):
+        return
+    
+    log_admin_action(message.from_user, "/cpuprofile")
+    
+    usage = (
+        f"Использование: /cpuprofile [секунд] [sample|pstats]\n"
+        f"sample - сэмплер стеков (collapsed stacks для flamegraph), pstats - cProfile. "
+        f"По умолчанию {CPU_PROFILE_DEFAULT_SECONDS} с, sample."
+    )
+    duration = CPU_PROFILE_DEFAULT_SECONDS
+    mode = "sample"
+    for arg in message.text.split()[1:]:
+        if arg.lower() in ("sample", "pstats"):
+            mode = arg.lower()
+            continue
+        try:
+            duration = float(arg)
+        except ValueError:
+            await message.answer(usage)
+            return
+    if not 1 <= duration <= CPU_PROFILE_MAX_SECONDS:
+        await message.answer(f"❌ Длительность должна быть от 1 до {CPU_PROFILE_MAX_SECONDS} секунд.")
+        return
+    
+    if cpu_profiler.running:
+        await message.answer("❌ Профилирование уже идет.")
+        return
+    
+    status_msg = await message.answer(f"⏳ Профилирую процесс {duration:g} с ({mode})...")
+    
+    suffix = ".txt" if mode == "sample" else ".pstats"
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        if mode == "sample":
+            result = await cpu_profiler.sample(duration, path)
+            caption = (
+                f"🔥 Сэмплов: {result['samples']}, цикл простаивал {result['idle'] * 100:.0f}%\n"
+                f"Собственное время:\n"
+            )
+            caption += "".join(f"{share * 100:.1f}% {name}\n" for name, share in result["top"])
+        else:
+            result = await cpu_profiler.profile(duration, path)
+            caption = f"🔥 Вызовов: {result['calls']}, время: {result['total']:.2f} с\nСобственное / общее время:\n"
+            caption += "".join(
+                f"{own:.3f} / {cumulative:.3f} с {name}\n" for name, own, cumulative in result["top"]
+            )
+        
+        filename = f"cpu_{mode}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{suffix}"
+        await message.answer_document(FSInputFile(path, filename=filename), caption=caption[:1024])
+        await status_msg.delete()
+        log_admin_command(message.from_user, f"/cpuprofile {duration:g} {mode}")
+    except Exception as e:
+        log_error("CPUPROFILE", "Ошибка профилирования процессора", str(e))
+        await status_msg.edit_text("❌ Произошла ошибка при профилировании.")
+    finally:
+        os.remove(path)
+
+
 # Обработка всех остальных сообщений
 @dp.message()
 async def handle_message(message: Message, state: FSMContext):
@@ -3163,7 +4204,274 @@ async def temp_ban_checker():
             await asyncio.sleep(300)
 
 
+# ========== АРХИВАЦИЯ СТАРЫХ ЛОГОВ ==========
+
+async def process_log_retention():
+    """Архивирует и удаляет логи старше политики хранения"""
+    total_archived = 0
+    for table, policy in LOG_RETENTION.items():
+        try:
+            # Выгрузка идет порциями в отдельном потоке, не блокируя обработку обновлений
+            archived = await asyncio.to_thread(
+                archive_old_logs,
+                table,
+                LOG_ARCHIVE_DIR,
+                policy.get("max_age_days"),
+                policy.get("max_rows")
+            )
+            if archived:
+                total_archived += archived
+                log_system_event("SYSTEM", f"Архивировано записей из {table}: {archived}")
+        except Exception as e:
+            log_error("LOG_RETENTION", f"Ошибка архивации таблицы {table}", str(e))
+    
+    if total_archived:
+        try:
+            await asyncio.to_thread(incremental_vacuum)
+        except Exception as e:
+            log_error("LOG_RETENTION", "Ошибка incremental_vacuum", str(e))
+
+
+async def log_retention_checker():
+    """Периодическая архивация логов (низкий приоритет)"""
+    # Первый запуск откладываем, чтобы не мешать старту бота
+    await asyncio.sleep(600)
+    while True:
+        try:
+            await process_log_retention()
+        except Exception as e:
+            log_error("LOG_RETENTION_CHECKER", "Ошибка в периодической архивации логов", str(e))
+        await asyncio.sleep(LOG_RETENTION_INTERVAL_HOURS * 3600)
+
+
+async def slow_query_flusher():
+    """Периодическая запись медленных запросов из памяти процесса в slow_queries"""
+    while True:
+        await asyncio.sleep(SLOW_QUERY_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(flush_slow_queries)
+        except Exception as e:
+            log_error("SLOW_QUERY_FLUSHER", "Ошибка записи медленных запросов", str(e))
+
+
+async def fsm_cleanup_checker():
+    """Периодическое удаление устаревших FSM состояний и закрытие зависших тикетов"""
+    while True:
+        try:
+            states_deleted = await asyncio.to_thread(storage.cleanup, FSM_STATE_TTL_HOURS * 3600)
+            tickets_closed = await asyncio.to_thread(close_stale_tickets, SUPPORT_TICKET_TTL_DAYS * 86400)
+            if states_deleted or tickets_closed:
+                log_system_event(
+                    "FSM_CLEANUP",
+                    f"Удалено FSM состояний: {states_deleted}, закрыто зависших тикетов: {tickets_closed}"
+                )
+        except Exception as e:
+            log_error("FSM_CLEANUP_CHECKER", "Ошибка очистки FSM хранилища", str(e))
+        await asyncio.sleep(3600)
+
+
 # ========== ГЛАВНАЯ ФУНКЦИЯ ==========
+# ========== WEBHOOK ==========
+
+# Ограничивает число одновременно обрабатываемых апдейтов (создается в run_webhook)
+webhook_slots: Optional[asyncio.Semaphore] = None
+# Ссылки на задачи обработки, чтобы их не собрал сборщик мусора
+webhook_tasks = set()
+
+
+async def process_webhook_update(update: Update):
+    """Обрабатывает апдейт из webhook и освобождает слот"""
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        log_error("WEBHOOK_UPDATE", f"Ошибка обработки апдейта {update.update_id}", str(e))
+    finally:
+        webhook_slots.release()
+
+
+async def handle_webhook(request: web.Request) -> web.Response:
+    """Принимает апдейт от Telegram и запускает его обработку в фоне"""
+    if WEBHOOK_SECRET_TOKEN and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET_TOKEN:
+        return web.Response(status=401)
+    
+    if worker_inboxes:
+        try:
+            dispatch_to_worker(await request.json())
+        except Exception:
+            return web.Response(status=400)
+        return web.Response()
+    
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except Exception:
+        return web.Response(status=400)
+    
+    # Когда все слоты заняты, ответ задерживается и Telegram сам снижает темп доставки
+    await webhook_slots.acquire()
+    task = asyncio.create_task(process_webhook_update(update))
+    webhook_tasks.add(task)
+    task.add_done_callback(webhook_tasks.discard)
+    return web.Response()
+
+
+async def run_webhook():
+    """Запускает aiohttp сервер для webhook и регистрирует его в Telegram"""
+    global webhook_slots
+    webhook_slots = asyncio.Semaphore(WEBHOOK_MAX_IN_FLIGHT)
+    
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    
+    await bot.set_webhook(
+        WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET_TOKEN,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=min(WEBHOOK_MAX_IN_FLIGHT, 100)
+    )
+    print(f"Webhook запущен на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    try:
+        await asyncio.Event().wait()
+    finally:
+        # Дожидаемся апдейтов, которые уже в обработке
+        if webhook_tasks:
+            await asyncio.gather(*webhook_tasks, return_exceptions=True)
+        await runner.cleanup()
+        await bot.session.close()
+
+
+# ========== МНОГОПРОЦЕССНЫЙ РЕЖИМ ==========
+# Основной процесс получает апдейты (webhook или polling) и кладет каждый в очередь
+# процесса-обработчика с номером from_user.id % WORKERS. Все апдейты пользователя
+# обрабатывает один процесс, поэтому порядок и FSM состояние пользователя локальны.
+# Общие данные (баны, администраторы, балансы) хранятся в базе, а сбросы кэшей
+# рассылаются остальным процессам через основной.
+
+# Очереди процессов-обработчиков: ("update", dict) или ("invalidate", вид, ключ)
+worker_inboxes: List = []
+# Сбросы кэшей от всех процессов: (номер процесса или -1 для основного, вид, ключ)
+invalidation_hub = None
+
+
+def update_user_id(update: dict) -> int:
+    """Находит ID пользователя, от которого пришел апдейт (0, если его нет)"""
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"].get("id", 0)
+    return 0
+
+
+def dispatch_to_worker(update: dict):
+    """Передает апдейт процессу-обработчику, отвечающему за пользователя"""
+    worker_inboxes[update_user_id(update) % len(worker_inboxes)].put(("update", update))
+
+
+def forward_invalidations():
+    """Рассылает сбросы кэшей всем процессам-обработчикам, кроме отправителя (поток основного процесса)"""
+    while True:
+        sender, kind, key = invalidation_hub.get()
+        for index, inbox in enumerate(worker_inboxes):
+            if index != sender:
+                inbox.put(("invalidate", kind, key))
+
+
+def start_workers():
+    """Запускает процессы-обработчики и поток рассылки сбросов кэшей"""
+    global invalidation_hub
+    # spawn: каждый процесс заново импортирует бота и открывает свои соединения
+    context = multiprocessing.get_context("spawn")
+    invalidation_hub = context.Queue()
+    for index in range(WORKERS):
+        inbox = context.Queue()
+        worker_inboxes.append(inbox)
+        context.Process(
+            target=run_worker,
+            args=(index, inbox, invalidation_hub),
+            name=f"bot-worker-{index}",
+            daemon=True
+        ).start()
+    
+    # Изменения, сделанные фоновыми задачами основного процесса, тоже рассылаются
+    add_invalidation_listener(lambda kind, key: invalidation_hub.put((-1, kind, key)))
+    threading.Thread(target=forward_invalidations, name="cache-invalidations", daemon=True).start()
+    print(f"Запущено процессов-обработчиков: {WORKERS}")
+
+
+async def process_worker_update(update: dict, previous: Optional[asyncio.Task], slots: asyncio.Semaphore):
+    """
+    Обрабатывает апдейт после предыдущего апдейта того же пользователя
+    
+    Слот занимается только после завершения предыдущего апдейта: ожидающие
+    своей очереди апдейты одного пользователя не занимают слоты остальных.
+    """
+    if previous:
+        await asyncio.gather(previous, return_exceptions=True)
+    async with slots:
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            log_error("WORKER_UPDATE", f"Ошибка обработки апдейта {update.get('update_id')}", str(e))
+
+
+async def worker_main(index: int, inbox, hub):
+    """Цикл процесса-обработчика: апдейты пользователей и сбросы кэшей из очереди"""
+    add_invalidation_listener(lambda kind, key: hub.put((index, kind, key)))
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT + index + 1)
+    asyncio.create_task(slow_query_flusher())
+    asyncio.create_task(loop_monitor.run(report_loop_stall))
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(WORKER_MAX_IN_FLIGHT)
+    # Последняя задача каждого пользователя: следующий апдейт ждет ее завершения
+    user_tasks: Dict[int, asyncio.Task] = {}
+    
+    def forget(user_id: int, task: asyncio.Task):
+        if user_tasks.get(user_id) is task:
+            del user_tasks[user_id]
+    
+    try:
+        while True:
+            item = await loop.run_in_executor(None, inbox.get)
+            if item[0] == "invalidate":
+                apply_cache_invalidation(item[1], item[2])
+                continue
+            
+            update = item[1]
+            user_id = update_user_id(update)
+            task = asyncio.create_task(process_worker_update(update, user_tasks.get(user_id), slots))
+            user_tasks[user_id] = task
+            task.add_done_callback(lambda done, user_id=user_id: forget(user_id, done))
+    finally:
+        await bot.session.close()
+
+
+def run_worker(index: int, inbox, hub):
+    """Точка входа процесса-обработчика"""
+    asyncio.run(worker_main(index, inbox, hub))
+
+
+async def poll_for_workers():
+    """Long polling в основном процессе с передачей апдейтов обработчикам"""
+    await bot.delete_webhook()
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            log_error("POLLING", "Ошибка получения апдейтов", str(e))
+            await asyncio.sleep(1)
+            continue
+        
+        for update in updates:
+            dispatch_to_worker(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+            offset = update.update_id + 1
+
+
 async def main():
     """Главная функция запуска бота"""
     try:
@@ -3176,7 +4484,30 @@ async def main():
         # Запускаем периодическую проверку временных банов
         asyncio.create_task(temp_ban_checker())
         
-        await dp.start_polling(bot)
+        # Запускаем фоновую архивацию старых логов
+        asyncio.create_task(log_retention_checker())
+        
+        # Запускаем очистку устаревших FSM состояний
+        asyncio.create_task(fsm_cleanup_checker())
+        
+        # Запускаем запись медленных запросов в журнал
+        asyncio.create_task(slow_query_flusher())
+        
+        # Запускаем монитор задержки цикла событий
+        asyncio.create_task(loop_monitor.run(report_loop_stall))
+        
+        if METRICS_PORT:
+            await start_metrics_server(METRICS_PORT)
+        
+        if WORKERS > 1:
+            start_workers()
+        
+        if WEBHOOK_URL:
+            await run_webhook()
+        elif WORKERS > 1:
+            await poll_for_workers()
+        else:
+            await dp.start_polling(bot)
     except Exception as e:
         log_error("MAIN", "Критическая ошибка при запуске бота", str(e))
         print(f"Критическая ошибка: {e}")
@@ -3,177 +3,322 @@
 """
 import sqlite3
 import os
+import sys
+import threading
+import csv
+import gzip
+import json
+import time
+from collections import OrderedDict, deque
 from datetime import datetime
-from typing import Optional, List, Tuple, Dict
+from typing import Optional, List, Tuple, Dict, Callable
 
 
 DB_FILE = "bot_database.db"
 
+# Сколько секунд запись ждет, пока другой процесс держит блокировку базы
+DB_BUSY_TIMEOUT = 5.0
+
+# Полнотекстовый поиск по логам (FTS5 может отсутствовать в сборке SQLite)
+FTS_AVAILABLE = False
+
+# Индексируемые колонки таблиц логов для FTS5
+FTS_TABLES = {
+    "user_logs": ("action",),
+    "admin_logs": ("action",),
+    "system_logs": ("initiator", "action"),
+    "error_logs": ("error_type", "error_message", "context")
+}
+
+
+# Подписчики на время выполнения запросов: listener(sql, seconds)
+_query_listeners: List[Callable] = []
+
+# Профилирование запросов по функциям и журнал медленных запросов (включается на лету)
+QUERY_PROFILING = {"enabled": False, "threshold_ms": 100.0}
+# Последние замеры каждой функции для оценки p99
+QUERY_SAMPLE_SIZE = 1000
+# {"модуль.функция": {"count": int, "total": float, "samples": deque}}
+_query_stats: Dict[str, dict] = {}
+_query_stats_lock = threading.Lock()
+# Медленные запросы, ожидающие записи в slow_queries: (время, функция, секунды, sql, параметры)
+_pending_slow_queries = deque(maxlen=1000)
+# Запросы журнала медленных запросов сами не профилируются
+_profiling_local = threading.local()
+
+
+def add_query_listener(listener: Callable):
+    """Подписывает listener(sql, seconds) на время выполнения каждого запроса"""
+    _query_listeners.append(listener)
+
+
+def _record_query(sql: str, parameters, elapsed: float):
+    for listener in _query_listeners:
+        listener(sql, elapsed)
+    
+    if not QUERY_PROFILING["enabled"] or getattr(_profiling_local, "suspended", False):
+        return
+    
+    # Кадры: _record_query <- execute <- функция, выполнившая запрос
+    caller = sys._getframe(2).f_code
+    # Вложенные функции (например, fetch в get_logs_page) учитываются за внешней
+    name = getattr(caller, "co_qualname", caller.co_name).split(".<locals>", 1)[0]
+    function = f"{os.path.splitext(os.path.basename(caller.co_filename))[0]}.{name}"
+    with _query_stats_lock:
+        stats = _query_stats.get(function)
+        if stats is None:
+            stats = _query_stats[function] = {
+                "count": 0,
+                "total": 0.0,
+                "samples": deque(maxlen=QUERY_SAMPLE_SIZE)
+            }
+        stats["count"] += 1
+        stats["total"] += elapsed
+        stats["samples"].append(elapsed)
+    
+    if elapsed * 1000 >= QUERY_PROFILING["threshold_ms"]:
+        _pending_slow_queries.append((int(time.time()), function, elapsed, sql, parameters))
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, замеряющий время execute/executemany для подписчиков и профилирования"""
+    
+    def execute(self, sql, parameters=()):
+        if not _query_listeners and not QUERY_PROFILING["enabled"]:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_query(sql, parameters, time.perf_counter() - started)
+    
+    def executemany(self, sql, seq_of_parameters):
+        if not _query_listeners and not QUERY_PROFILING["enabled"]:
+            return super().executemany(sql, seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # Параметры executemany для EXPLAIN не сохраняются
+            _record_query(sql, None, time.perf_counter() - started)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Соединение, курсоры которого замеряют время запросов"""
+    
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
 
 def get_db_connection():
     """Создает и возвращает соединение с базой данных"""
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT, check_same_thread=False, factory=TimedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
 
-def init_database():
-    """Инициализирует базу данных и создает все необходимые таблицы"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+# Версия схемы базы данных (PRAGMA user_version)
+# 1 - время хранится как INTEGER unix timestamp вместо TEXT "%Y-%m-%d %H:%M:%S"
+# 2 - логи пользователей ссылаются на user_id, имена хранятся в user_names
+SCHEMA_VERSION = 2
+
+# Формат времени, в котором оно хранилось до версии схемы 1 и выводится пользователю
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Схемы таблиц. {table} подставляется при создании и при перестройке таблицы в миграциях
+TABLE_SCHEMAS = {
     # Таблица пользователей
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
+    "users": """
+        CREATE TABLE IF NOT EXISTS {table} (
             user_id INTEGER PRIMARY KEY,
             full_name TEXT NOT NULL,
             username TEXT,
-            first_start TEXT NOT NULL
+            first_start INTEGER NOT NULL
         )
-    """)
-    
+    """,
     # Таблица администраторов
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS admins (
+    "admins": """
+        CREATE TABLE IF NOT EXISTS {table} (
             admin_id INTEGER PRIMARY KEY,
             full_name TEXT NOT NULL,
             username TEXT,
-            added_date TEXT NOT NULL
+            added_date INTEGER NOT NULL
         )
-    """)
-    
+    """,
     # Таблица черного списка
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS blacklist (
+    "blacklist": """
+        CREATE TABLE IF NOT EXISTS {table} (
             user_id INTEGER PRIMARY KEY,
             full_name TEXT NOT NULL,
             username TEXT,
-            banned_date TEXT NOT NULL,
+            banned_date INTEGER NOT NULL,
             banned_by TEXT
         )
-    """)
-    
+    """,
     # Таблица достижений
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS achievements (
+    "achievements": """
+        CREATE TABLE IF NOT EXISTS {table} (
             ach_id TEXT PRIMARY KEY,
             ach_name TEXT NOT NULL,
-            created TEXT NOT NULL
+            created INTEGER NOT NULL
         )
-    """)
-    
+    """,
     # Таблица достижений пользователей
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_achievements (
+    "user_achievements": """
+        CREATE TABLE IF NOT EXISTS {table} (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
             ach_id TEXT NOT NULL,
-            given_date TEXT NOT NULL,
+            given_date INTEGER NOT NULL,
             given_by TEXT NOT NULL,
             FOREIGN KEY (user_id) REFERENCES users(user_id),
             FOREIGN KEY (ach_id) REFERENCES achievements(ach_id)
         )
-    """)
-    
+    """,
     # Таблица балансов
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS balances (
+    "balances": """
+        CREATE TABLE IF NOT EXISTS {table} (
             user_id INTEGER PRIMARY KEY,
             balance INTEGER NOT NULL DEFAULT 0,
             FOREIGN KEY (user_id) REFERENCES users(user_id)
         )
-    """)
-    
+    """,
     # Таблица временных банов
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS temp_bans (
+    "temp_bans": """
+        CREATE TABLE IF NOT EXISTS {table} (
             user_id INTEGER PRIMARY KEY,
-            unban_time TEXT NOT NULL,
+            unban_time INTEGER NOT NULL,
             reason TEXT NOT NULL,
             banned_by INTEGER NOT NULL,
-            banned_at TEXT NOT NULL,
+            banned_at INTEGER NOT NULL,
             FOREIGN KEY (user_id) REFERENCES users(user_id)
         )
-    """)
-    
-    # Таблица логов пользователей
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_logs (
+    """,
+    # История имен пользователей (запись добавляется при смене имени или username)
+    "user_names": """
+        CREATE TABLE IF NOT EXISTS {table} (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
             full_name TEXT NOT NULL,
             username TEXT,
-            timestamp TEXT NOT NULL,
+            first_seen INTEGER NOT NULL
+        )
+    """,
+    # Таблица логов пользователей
+    "user_logs": """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL,
             action TEXT NOT NULL
         )
-    """)
-    
+    """,
     # Таблица логов администраторов
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS admin_logs (
+    "admin_logs": """
+        CREATE TABLE IF NOT EXISTS {table} (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
-            full_name TEXT NOT NULL,
-            username TEXT,
-            timestamp TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
             action TEXT NOT NULL
         )
-    """)
-    
+    """,
     # Таблица логов команд администраторов
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS admin_command_logs (
+    "admin_command_logs": """
+        CREATE TABLE IF NOT EXISTS {table} (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
-            full_name TEXT NOT NULL,
-            username TEXT,
-            timestamp TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
             command TEXT NOT NULL
         )
-    """)
-    
+    """,
     # Таблица системных логов
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS system_logs (
+    "system_logs": """
+        CREATE TABLE IF NOT EXISTS {table} (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             initiator TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
             action TEXT NOT NULL
         )
-    """)
-    
+    """,
     # Таблица логов ошибок
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS error_logs (
+    "error_logs": """
+        CREATE TABLE IF NOT EXISTS {table} (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             error_type TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
             error_message TEXT NOT NULL,
             context TEXT
         )
-    """)
-    
+    """,
     # Таблица логов переводов
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS transfer_logs (
+    "transfer_logs": """
+        CREATE TABLE IF NOT EXISTS {table} (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
             from_user_id INTEGER NOT NULL,
             to_user_id INTEGER NOT NULL,
             amount INTEGER NOT NULL,
             from_name TEXT NOT NULL,
             to_name TEXT NOT NULL
         )
-    """)
-    
+    """,
+    # FSM состояния aiogram (fsm_storage.SQLiteStorage)
+    "fsm_states": """
+        CREATE TABLE IF NOT EXISTS {table} (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    """,
+    # Данные подключений TON Connect (tonconnect_storage.DatabaseStorage)
+    "tonconnect_storage": """
+        CREATE TABLE IF NOT EXISTS {table} (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    """,
+    # Тикеты поддержки: status - open (ждет администратора), assigned (в работе), closed
+    "support_tickets": """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'open',
+            admin_id INTEGER,
+            created_at INTEGER NOT NULL,
+            assigned_at INTEGER,
+            closed_at INTEGER,
+            updated_at INTEGER NOT NULL
+        )
+    """,
+    # Переписка по тикетам
+    "ticket_messages": """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticket_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            from_admin INTEGER NOT NULL DEFAULT 0,
+            text TEXT,
+            created_at INTEGER NOT NULL
+        )
+    """,
+    # Журнал медленных запросов (включается через set_query_profiling)
+    "slow_queries": """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp INTEGER NOT NULL,
+            function TEXT NOT NULL,
+            duration_ms REAL NOT NULL,
+            sql TEXT NOT NULL,
+            query_plan TEXT
+        )
+    """,
     # Таблица логов AI запросов
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS ai_requests (
+    "ai_requests": """
+        CREATE TABLE IF NOT EXISTS {table} (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
-            full_name TEXT NOT NULL,
-            username TEXT,
-            timestamp TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
             request_text TEXT NOT NULL,
             response_text TEXT,
             prompt_tokens INTEGER DEFAULT 0,
@@ -184,24 +329,577 @@ def init_database():
             error_message TEXT,
             FOREIGN KEY (user_id) REFERENCES users(user_id)
         )
+    """
+}
+
+# Колонки времени, переведенные в версии схемы 1 из TEXT в INTEGER
+TIMESTAMP_COLUMNS = {
+    "users": ("first_start",),
+    "admins": ("added_date",),
+    "blacklist": ("banned_date",),
+    "achievements": ("created",),
+    "user_achievements": ("given_date",),
+    "temp_bans": ("unban_time", "banned_at"),
+    "user_logs": ("timestamp",),
+    "admin_logs": ("timestamp",),
+    "admin_command_logs": ("timestamp",),
+    "system_logs": ("timestamp",),
+    "error_logs": ("timestamp",),
+    "transfer_logs": ("timestamp",),
+    "ai_requests": ("timestamp",)
+}
+
+# Логи, в которых имя пользователя не копируется в каждую строку, а берется из user_names
+NAMED_LOG_TABLES = ("user_logs", "admin_logs", "admin_command_logs", "ai_requests")
+
+
+def to_epoch(value) -> int:
+    """Приводит время к unix timestamp (принимает int, datetime и строки старого формата)"""
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    if isinstance(value, str):
+        try:
+            return int(datetime.strptime(value, TIMESTAMP_FORMAT).timestamp())
+        except ValueError:
+            # Нераспознанное значение (например, "NA") хранится как 0
+            return int(value) if value.isdigit() else 0
+    return int(value or 0)
+
+
+def format_timestamp(value) -> str:
+    """Форматирует время из базы для вывода (строки старого формата возвращаются как есть)"""
+    if isinstance(value, str):
+        return value
+    if not value:
+        return "NA"
+    return datetime.fromtimestamp(value).strftime(TIMESTAMP_FORMAT)
+
+
+def init_database():
+    """Инициализирует базу данных и создает все необходимые таблицы"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    _enable_incremental_vacuum(conn)
+    # WAL: чтение не блокирует запись, а запись - чтение, что важно, когда
+    # базой пользуются несколько процессов-воркеров (режим хранится в файле базы)
+    cursor.execute("PRAGMA journal_mode = WAL")
+    
+    cursor.execute("PRAGMA user_version")
+    version = cursor.fetchone()[0]
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    existing_tables = {row["name"] for row in cursor.fetchall()}
+    
+    # Миграции существующей базы (новая база сразу создается по актуальной схеме)
+    if "users" in existing_tables and version < SCHEMA_VERSION:
+        _migrate_schema(conn, existing_tables, version)
+    
+    for table, schema in TABLE_SCHEMAS.items():
+        cursor.execute(schema.format(table=table))
+    
+    # Индекс для топа по балансу (без него ORDER BY balance сортирует всю таблицу)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_balances_balance ON balances(balance)")
+    
+    # Достижения пользователя для карточки и /myach
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_achievements_user_id ON user_achievements(user_id)")
+    
+    # Индексы для выборок по времени
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_first_start ON users(first_start)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_temp_bans_unban_time ON temp_bans(unban_time)")
+    
+    # Очистка устаревших FSM состояний
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states(updated_at)")
+    
+    # Тикеты поддержки: не больше одного незакрытого тикета на пользователя,
+    # очередь неназначенных тикетов, списки по статусу и закрытие зависших
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_support_tickets_active_user
+        ON support_tickets(user_id) WHERE status != 'closed'
+    """)
+    # (status, id) обслуживает и очередь: первый open по возрастанию id
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_support_tickets_status ON support_tickets(status, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_support_tickets_admin ON support_tickets(admin_id, id)")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_support_tickets_updated_at
+        ON support_tickets(updated_at) WHERE status != 'closed'
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ticket_messages_ticket_id ON ticket_messages(ticket_id, id)")
+    
+    # Диалоги поддержки из прежней таблицы переносятся в тикеты
+    if "support_dialogs" in existing_tables:
+        _migrate_support_dialogs(cursor)
+    
+    # Поиск пользователя по username без учета регистра
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE)")
+    
+    # Поиск имени пользователя на момент записи лога
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_names_user_id ON user_names(user_id, first_seen)")
+    
+    # Индексы для фильтров просмотра логов (keyset-пагинация идет по id)
+    for table in ("user_logs", "admin_logs", "admin_command_logs", "ai_requests"):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user_id ON {table}(user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_error_logs_error_type ON error_logs(error_type)")
+    for table in ("user_logs", "admin_logs", "admin_command_logs", "system_logs", "error_logs",
+                  "transfer_logs", "ai_requests"):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_timestamp ON {table}(timestamp)")
+    
+    _init_fts(cursor)
+    
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+    conn.close()
+
+
+def _rebuild_table(conn, table: str, select_columns: str, insert_columns: str, batch_size: int = 50000):
+    """
+    Перестраивает таблицу по актуальной схеме из TABLE_SCHEMAS
+    
+    SQLite не умеет менять и удалять колонки с индексами, поэтому данные
+    копируются в новую таблицу порциями по rowid (с коммитом после каждой
+    порции, чтобы журнал не разрастался), старая удаляется, а новая
+    переименовывается. id записей сохраняются, так что FTS индексы логов
+    остаются действительными. Индексы и триггеры пересоздаются в init_database.
+    """
+    cursor = conn.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS {table}_new")
+    cursor.execute(TABLE_SCHEMAS[table].format(table=f"{table}_new"))
+    
+    last_rowid = -(2 ** 63)
+    while True:
+        cursor.execute(f"""
+            SELECT MAX(rowid) AS batch_end FROM (
+                SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?
+            )
+        """, (last_rowid, batch_size))
+        batch_end = cursor.fetchone()["batch_end"]
+        if batch_end is None:
+            break
+        cursor.execute(f"""
+            INSERT INTO {table}_new ({insert_columns})
+            SELECT {select_columns} FROM {table}
+            WHERE rowid > ? AND rowid <= ?
+        """, (last_rowid, batch_end))
+        conn.commit()
+        last_rowid = batch_end
+    
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    conn.commit()
+
+
+def _epoch_sql(column: str) -> str:
+    """SQL выражение, переводящее время старого формата TEXT в unix timestamp"""
+    # Старое время хранилось в локальном часовом поясе: модификатор 'utc' переводит его в UTC.
+    # Нераспознанные значения (например, "NA") становятся 0
+    return f"""CASE WHEN typeof({column}) = 'integer' THEN {column}
+        ELSE COALESCE(CAST(strftime('%s', {column}, 'utc') AS INTEGER), 0) END"""
+
+
+def _collect_user_names(conn, table: str, timestamp_sql: str, batch_size: int = 50000):
+    """
+    Переносит в user_names смены имени пользователя из старой таблицы логов
+    
+    Таблица обрабатывается порциями по rowid с коммитом после каждой, как в
+    _rebuild_table. Первая запись пользователя в порции попадает в user_names,
+    даже если имя не менялось с предыдущей порции: такие повторы удаляет
+    _collapse_user_names.
+    """
+    cursor = conn.cursor()
+    last_rowid = -(2 ** 63)
+    while True:
+        cursor.execute(f"""
+            SELECT MAX(rowid) AS batch_end FROM (
+                SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?
+            )
+        """, (last_rowid, batch_size))
+        batch_end = cursor.fetchone()["batch_end"]
+        if batch_end is None:
+            break
+        cursor.execute(f"""
+            INSERT INTO user_names (user_id, full_name, username, first_seen)
+            SELECT user_id, full_name, NULLIF(username, 'NA'), first_seen FROM (
+                SELECT user_id, full_name, username, {timestamp_sql} AS first_seen,
+                       LAG(full_name) OVER w AS prev_full_name,
+                       LAG(username) OVER w AS prev_username
+                FROM {table}
+                WHERE rowid > ? AND rowid <= ?
+                WINDOW w AS (PARTITION BY user_id ORDER BY id)
+            )
+            WHERE prev_full_name IS NOT full_name OR prev_username IS NOT username
+        """, (last_rowid, batch_end))
+        conn.commit()
+        last_rowid = batch_end
+
+
+def _collapse_user_names(cursor):
+    """Удаляет записи user_names, повторяющие предыдущее имя того же пользователя"""
+    cursor.execute("""
+        DELETE FROM user_names WHERE id IN (
+            SELECT id FROM (
+                SELECT id, full_name, username,
+                       LAG(full_name) OVER w AS prev_full_name,
+                       LAG(username) OVER w AS prev_username
+                FROM user_names
+                WINDOW w AS (PARTITION BY user_id ORDER BY first_seen, id)
+            )
+            WHERE prev_full_name IS full_name AND prev_username IS username
+        )
     """)
+
+
+def _migrate_schema(conn, existing_tables: set, version: int):
+    """
+    Приводит существующую базу к актуальной схеме
+    
+    Версия 1: время из TEXT "%Y-%m-%d %H:%M:%S" в INTEGER unix timestamp.
+    Версия 2: full_name/username из логов пользователей переносятся в user_names.
+    Каждая таблица перестраивается не более одного раза, даже если
+    применяется сразу несколько версий.
+    """
+    print("⏳ Миграция базы данных: обновление схемы таблиц...")
+    cursor = conn.cursor()
+    cursor.execute(TABLE_SCHEMAS["user_names"].format(table="user_names"))
+    
+    for table in TABLE_SCHEMAS:
+        if table not in existing_tables:
+            continue
+        
+        cursor.execute(f"PRAGMA table_info({table})")
+        columns = [row["name"] for row in cursor.fetchall()]
+        
+        timestamp_columns = TIMESTAMP_COLUMNS.get(table, ()) if version < 1 else ()
+        drop_names = table in NAMED_LOG_TABLES and "full_name" in columns
+        if not timestamp_columns and not drop_names:
+            continue
+        
+        def value(column: str) -> str:
+            return _epoch_sql(column) if column in timestamp_columns else column
+        
+        if drop_names:
+            _collect_user_names(conn, table, value("timestamp"))
+            columns = [column for column in columns if column not in ("full_name", "username")]
+        
+        _rebuild_table(
+            conn,
+            table,
+            ", ".join(value(column) for column in columns),
+            ", ".join(columns)
+        )
     
+    _collapse_user_names(cursor)
     conn.commit()
+
+
+def _migrate_support_dialogs(cursor):
+    """Переносит активные диалоги из support_dialogs в тикеты и удаляет старую таблицу"""
+    cursor.execute("""
+        INSERT OR IGNORE INTO support_tickets
+            (user_id, status, admin_id, created_at, assigned_at, updated_at)
+        SELECT user_id, 'assigned', admin_id, started_at, started_at, started_at
+        FROM support_dialogs
+    """)
+    cursor.execute("DROP TABLE support_dialogs")
+
+
+def _enable_incremental_vacuum(conn):
+    """Включает auto_vacuum=INCREMENTAL, чтобы место после очистки логов возвращалось файлу"""
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA auto_vacuum")
+    if cursor.fetchone()[0] == 2:
+        return
+    
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master")
+    if cursor.fetchone()[0] > 0:
+        # Для существующей базы режим применяется только после полного VACUUM (один раз)
+        print("⏳ Перестройка базы данных для incremental_vacuum (выполняется один раз)...")
+        cursor.execute("VACUUM")
+
+
+def _init_fts(cursor):
+    """Создает FTS5 индексы логов и триггеры их синхронизации"""
+    global FTS_AVAILABLE
+    
+    for table, columns in FTS_TABLES.items():
+        fts_table = f"{table}_fts"
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts_table,))
+        exists = cursor.fetchone() is not None
+        
+        try:
+            cursor.execute(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+                    {", ".join(columns)},
+                    content='{table}',
+                    content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+            """)
+        except sqlite3.OperationalError:
+            # SQLite собран без FTS5 - поиск по логам будет недоступен
+            FTS_AVAILABLE = False
+            return
+        
+        new_values = ", ".join(f"new.{column}" for column in columns)
+        old_values = ", ".join(f"old.{column}" for column in columns)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts_table}(rowid, {", ".join(columns)}) VALUES (new.id, {new_values});
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts_table}({fts_table}, rowid, {", ".join(columns)}) VALUES ('delete', old.id, {old_values});
+            END
+        """)
+        
+        if not exists:
+            # Индексируем уже накопленные записи
+            cursor.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+    
+    FTS_AVAILABLE = True
+
+
+# ========== КЭШИРОВАНИЕ ==========
+
+# Признак отсутствия ключа в кэше (None - допустимое закэшированное значение)
+CACHE_MISS = object()
+
+
+class LRUCache:
+    """
+    Ограниченный по размеру кэш с вытеснением давно не использованных записей.
+    
+    Записи могут иметь время жизни (ttl в секундах): общее для кэша или
+    отдельное для записи, например короткое для отрицательных результатов.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[object, Tuple[object, Optional[float]]]" = OrderedDict()
+
+    def get(self, key, default=CACHE_MISS):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        ttl = ttl if ttl is not None else self.ttl
+        self._data[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return item[0] if item is not None else default
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# Сброс кэшей по видам: {вид: функция(key)}. Кэши регистрируются рядом с объявлением
+_cache_invalidators: Dict[str, Callable] = {}
+# Подписчики на каждый сброс (в многопроцессном режиме bot.py рассылает их другим процессам)
+_invalidation_listeners: List[Callable] = []
+
+
+def register_cache_invalidator(kind: str, handler: Callable):
+    """Регистрирует функцию сброса кэша указанного вида"""
+    _cache_invalidators[kind] = handler
+
+
+def add_invalidation_listener(listener: Callable):
+    """Подписывает listener(kind, key) на все сбросы кэшей этого процесса"""
+    _invalidation_listeners.append(listener)
+
+
+def apply_cache_invalidation(kind: str, key=None):
+    """Сбрасывает кэш только в этом процессе (для сбросов, полученных от других процессов)"""
+    handler = _cache_invalidators.get(kind)
+    if handler:
+        handler(key)
+
+
+def invalidate_cache(kind: str, key=None):
+    """Сбрасывает кэш в этом процессе и оповещает подписчиков"""
+    apply_cache_invalidation(kind, key)
+    for listener in _invalidation_listeners:
+        listener(kind, key)
+
+
+# ========== ПРОФИЛИРОВАНИЕ ЗАПРОСОВ ==========
+
+# Сколько последних медленных запросов хранится в slow_queries
+SLOW_QUERY_MAX_ROWS = 10000
+
+# Операции, для которых EXPLAIN QUERY PLAN имеет смысл
+EXPLAINABLE_OPERATIONS = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+
+def set_query_profiling(enabled: bool, threshold_ms: Optional[float] = None):
+    """Включает или выключает профилирование запросов во всех процессах бота"""
+    invalidate_cache("query_profiling", (enabled, threshold_ms))
+
+
+def _apply_query_profiling(key):
+    enabled, threshold_ms = key
+    QUERY_PROFILING["enabled"] = enabled
+    if threshold_ms is not None:
+        QUERY_PROFILING["threshold_ms"] = float(threshold_ms)
+
+
+register_cache_invalidator("query_profiling", _apply_query_profiling)
+
+
+def get_query_stats() -> List[dict]:
+    """
+    Статистика запросов по функциям текущего процесса (с момента включения или сброса)
+    
+    Returns:
+        list: [{"function", "count", "total_ms", "avg_ms", "p99_ms"}, ...] по убыванию общего времени
+    """
+    with _query_stats_lock:
+        items = [(function, stats["count"], stats["total"], sorted(stats["samples"]))
+                 for function, stats in _query_stats.items()]
+    
+    result = []
+    for function, count, total, samples in items:
+        p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))] if samples else 0.0
+        result.append({
+            "function": function,
+            "count": count,
+            "total_ms": total * 1000,
+            "avg_ms": total * 1000 / count,
+            "p99_ms": p99 * 1000
+        })
+    result.sort(key=lambda item: item["total_ms"], reverse=True)
+    return result
+
+
+def reset_query_stats():
+    """Сбрасывает статистику запросов текущего процесса"""
+    with _query_stats_lock:
+        _query_stats.clear()
+
+
+def flush_slow_queries() -> int:
+    """
+    Записывает накопленные медленные запросы в slow_queries вместе с EXPLAIN QUERY PLAN
+    
+    Запись идет отдельно от самого запроса (из фоновой задачи), чтобы не ждать
+    блокировку базы, которую может держать транзакция медленного запроса.
+    
+    Returns:
+        int: количество записанных запросов
+    """
+    if not _pending_slow_queries:
+        return 0
+    
+    pending = []
+    while _pending_slow_queries:
+        pending.append(_pending_slow_queries.popleft())
+    
+    _profiling_local.suspended = True
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        rows = []
+        for timestamp, function, elapsed, sql, parameters in pending:
+            query_plan = None
+            operation = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ""
+            if parameters is not None and operation in EXPLAINABLE_OPERATIONS:
+                try:
+                    cursor.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)
+                    query_plan = "\n".join(row["detail"] for row in cursor.fetchall())
+                except sqlite3.Error as e:
+                    query_plan = f"EXPLAIN недоступен: {e}"
+            rows.append((timestamp, function, round(elapsed * 1000, 3), " ".join(sql.split()), query_plan))
+        
+        cursor.executemany("""
+            INSERT INTO slow_queries (timestamp, function, duration_ms, sql, query_plan)
+            VALUES (?, ?, ?, ?, ?)
+        """, rows)
+        cursor.execute(
+            "DELETE FROM slow_queries WHERE id <= (SELECT MAX(id) FROM slow_queries) - ?",
+            (SLOW_QUERY_MAX_ROWS,)
+        )
+        conn.commit()
+        conn.close()
+    finally:
+        _profiling_local.suspended = False
+    return len(rows)
+
+
+def get_slow_queries(limit: int = 10) -> List[dict]:
+    """Получает последние медленные запросы (от новых к старым)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM slow_queries ORDER BY id DESC LIMIT ?", (limit,))
+    rows = cursor.fetchall()
     conn.close()
+    return [dict(row) for row in rows]
 
 
 # ========== ФУНКЦИИ ДЛЯ РАБОТЫ С ПОЛЬЗОВАТЕЛЯМИ ==========
 
-def add_user(user_id: int, full_name: str, username: str, first_start: str):
+def add_user(user_id: int, full_name: str, username: str, first_start: int):
     """Добавляет пользователя в базу данных"""
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("""
         INSERT OR IGNORE INTO users (user_id, full_name, username, first_start)
         VALUES (?, ?, ?, ?)
-    """, (user_id, full_name, username, first_start))
+    """, (user_id, full_name, username, to_epoch(first_start)))
     conn.commit()
     conn.close()
+    invalidate_user_card(user_id)
+
+
+def register_user(user_id: int, full_name: str, username: str, first_start: int) -> bool:
+    """
+    Регистрирует пользователя или обновляет его имя и username
+    
+    Условный upsert: запись меняется, только если пользователь новый или
+    его имя/username отличаются от сохраненных, иначе запись не выполняется.
+    
+    Returns:
+        bool: True, если запись была добавлена или изменена
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO users (user_id, full_name, username, first_start)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            full_name = excluded.full_name,
+            username = excluded.username
+        WHERE users.full_name IS NOT excluded.full_name
+           OR users.username IS NOT excluded.username
+    """, (user_id, full_name, username, to_epoch(first_start)))
+    changed = cursor.rowcount > 0
+    if changed:
+        conn.commit()
+    conn.close()
+    
+    if changed:
+        invalidate_user_card(user_id)
+        invalidate_cache("top_balance_name", user_id)
+    return changed
 
 
 def get_user_profile(user_id: int) -> Optional[dict]:
@@ -233,15 +931,22 @@ def get_all_users() -> List[str]:
 
 
 def get_user_by_id_or_username(identifier: str) -> Optional[Tuple[str, str, str]]:
-    """Находит пользователя по ID или username"""
+    """Находит пользователя по ID или username (username без учета регистра)"""
     identifier = identifier.lstrip("@")
+    if not identifier or identifier.upper() == "NA":
+        # "NA" хранится у пользователей без username и не является username
+        return None
+    
     conn = get_db_connection()
     cursor = conn.cursor()
     
     if identifier.isdigit():
         cursor.execute("SELECT user_id, full_name, username FROM users WHERE user_id = ?", (int(identifier),))
     else:
-        cursor.execute("SELECT user_id, full_name, username FROM users WHERE username = ?", (identifier,))
+        cursor.execute(
+            "SELECT user_id, full_name, username FROM users WHERE username = ? COLLATE NOCASE LIMIT 1",
+            (identifier,)
+        )
     
     row = cursor.fetchone()
     conn.close()
@@ -251,28 +956,82 @@ def get_user_by_id_or_username(identifier: str) -> Optional[Tuple[str, str, str]
     return None
 
 
+def update_user_identity(user_id: int, full_name: str, username: str) -> Optional[Tuple[str, str]]:
+    """
+    Обновляет имя и username пользователя, если они изменились
+    
+    Returns:
+        tuple: прежние (full_name, username), если запись изменилась, иначе None
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT full_name, username FROM users WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
+    
+    previous = None
+    if row and (row["full_name"], row["username"]) != (full_name, username):
+        cursor.execute(
+            "UPDATE users SET full_name = ?, username = ? WHERE user_id = ?",
+            (full_name, username, user_id)
+        )
+        conn.commit()
+        previous = (row["full_name"], row["username"])
+    
+    conn.close()
+    if previous:
+        invalidate_user_card(user_id)
+        invalidate_cache("top_balance_name", user_id)
+    return previous
+
+
 # ========== ФУНКЦИИ ДЛЯ РАБОТЫ С АДМИНИСТРАТОРАМИ ==========
 
+# Список администраторов меняется редко, а читается при каждой проверке прав
+# и рассылке в поддержку, поэтому держим его в памяти до изменения
+_admin_ids_cache: Optional[frozenset] = None
+
+
+def _drop_admin_ids(key=None):
+    global _admin_ids_cache
+    _admin_ids_cache = None
+
+
+register_cache_invalidator("admin_ids", _drop_admin_ids)
+
+
+def get_admin_ids() -> frozenset:
+    """Получает множество ID администраторов (без создателя)"""
+    global _admin_ids_cache
+    admin_ids = _admin_ids_cache
+    if admin_ids is None:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT admin_id FROM admins")
+        admin_ids = frozenset(row["admin_id"] for row in cursor.fetchall())
+        conn.close()
+        _admin_ids_cache = admin_ids
+    return admin_ids
+
+
 def is_admin(user_id: int) -> bool:
     """Проверяет, является ли пользователь администратором"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM admins WHERE admin_id = ?", (user_id,))
-    result = cursor.fetchone() is not None
-    conn.close()
-    return result
+    return user_id in get_admin_ids()
 
 
-def add_admin(admin_id: int, full_name: str, username: str, added_date: str):
+def add_admin(admin_id: int, full_name: str, username: str, added_date: int):
     """Добавляет администратора"""
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("""
         INSERT OR IGNORE INTO admins (admin_id, full_name, username, added_date)
         VALUES (?, ?, ?, ?)
-    """, (admin_id, full_name, username, added_date))
+    """, (admin_id, full_name, username, to_epoch(added_date)))
+    added = cursor.rowcount > 0
     conn.commit()
     conn.close()
+    if added:
+        invalidate_cache("admin_ids")
+    invalidate_user_card(admin_id)
 
 
 def remove_admin(admin_id: int) -> bool:
@@ -283,6 +1042,9 @@ def remove_admin(admin_id: int) -> bool:
     deleted = cursor.rowcount > 0
     conn.commit()
     conn.close()
+    if deleted:
+        invalidate_cache("admin_ids")
+        invalidate_user_card(admin_id)
     return deleted
 
 
@@ -316,16 +1078,17 @@ def is_banned(user_id: int) -> bool:
     return result
 
 
-def ban_user(user_id: int, full_name: str, username: str, banned_date: str, banned_by: str):
+def ban_user(user_id: int, full_name: str, username: str, banned_date: int, banned_by: str):
     """Добавляет пользователя в черный список"""
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("""
         INSERT OR REPLACE INTO blacklist (user_id, full_name, username, banned_date, banned_by)
         VALUES (?, ?, ?, ?, ?)
-    """, (user_id, full_name, username, banned_date, banned_by))
+    """, (user_id, full_name, username, to_epoch(banned_date), banned_by))
     conn.commit()
     conn.close()
+    invalidate_user_card(user_id)
 
 
 def unban_user(user_id: int) -> bool:
@@ -336,6 +1099,8 @@ def unban_user(user_id: int) -> bool:
     deleted = cursor.rowcount > 0
     conn.commit()
     conn.close()
+    if deleted:
+        invalidate_user_card(user_id)
     return deleted
 
 
@@ -380,22 +1145,93 @@ def set_user_balance(user_id: int, amount: int):
     """, (user_id, amount))
     conn.commit()
     conn.close()
+    invalidate_cache("top_balance", (user_id, amount))
+    invalidate_user_card(user_id)
 
 
-def add_user_balance(user_id: int, amount: int):
-    """Добавляет баланс пользователю"""
-    current = get_user_balance(user_id)
-    set_user_balance(user_id, current + amount)
+def _credit_balance(cursor, user_id: int, amount: int) -> int:
+    """Начисляет amount одним запросом (без чтения баланса заранее) и возвращает новый баланс"""
+    cursor.execute("""
+        INSERT INTO balances (user_id, balance) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance
+    """, (user_id, amount))
+    cursor.execute("SELECT balance FROM balances WHERE user_id = ?", (user_id,))
+    return cursor.fetchone()["balance"]
+
+
+def _balance_changed(user_id: int, balance: int):
+    invalidate_cache("top_balance", (user_id, balance))
+    invalidate_user_card(user_id)
+
+
+def add_user_balance(user_id: int, amount: int) -> int:
+    """
+    Добавляет баланс пользователю
+    
+    Баланс меняется одним UPDATE, поэтому одновременные начисления из
+    разных процессов не теряются.
+    
+    Returns:
+        int: новый баланс
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    new_balance = _credit_balance(cursor, user_id, amount)
+    conn.commit()
+    conn.close()
+    _balance_changed(user_id, new_balance)
+    return new_balance
 
 
 def remove_user_balance(user_id: int, amount: int) -> int:
-    """Снимает баланс у пользователя"""
-    current = get_user_balance(user_id)
-    new_balance = max(0, current - amount)
-    set_user_balance(user_id, new_balance)
+    """Снимает баланс у пользователя (не ниже нуля) и возвращает новый баланс"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE balances SET balance = MAX(0, balance - ?)
+        WHERE user_id = ?
+    """, (amount, user_id))
+    cursor.execute("SELECT balance FROM balances WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
+    conn.commit()
+    conn.close()
+    new_balance = row["balance"] if row else 0
+    if row:
+        _balance_changed(user_id, new_balance)
     return new_balance
 
 
+def transfer_balance(from_user_id: int, to_user_id: int, amount: int) -> Optional[Tuple[int, int]]:
+    """
+    Переводит amount от одного пользователя другому в одной транзакции
+    
+    Списание выполняется условным UPDATE (balance >= amount), поэтому
+    баланс не уходит в минус, даже если его одновременно меняет другой процесс.
+    
+    Returns:
+        tuple: (новый баланс отправителя, новый баланс получателя) или None, если средств недостаточно
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE balances SET balance = balance - ?
+        WHERE user_id = ? AND balance >= ?
+    """, (amount, from_user_id, amount))
+    if cursor.rowcount == 0:
+        conn.rollback()
+        conn.close()
+        return None
+    
+    cursor.execute("SELECT balance FROM balances WHERE user_id = ?", (from_user_id,))
+    sender_balance = cursor.fetchone()["balance"]
+    recipient_balance = _credit_balance(cursor, to_user_id, amount)
+    conn.commit()
+    conn.close()
+    _balance_changed(from_user_id, sender_balance)
+    _balance_changed(to_user_id, recipient_balance)
+    return sender_balance, recipient_balance
+
+
 def get_top_users_by_balance(limit: int = 10) -> List[Tuple[int, int]]:
     """Получает топ пользователей по балансу"""
     conn = get_db_connection()
@@ -411,18 +1247,94 @@ def get_top_users_by_balance(limit: int = 10) -> List[Tuple[int, int]]:
     return [(row["user_id"], row["balance"]) for row in rows]
 
 
+def get_top_users_with_names(limit: int = 10) -> List[dict]:
+    """Получает топ пользователей по балансу вместе с именами одним запросом"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT b.user_id, b.balance, u.full_name, u.username
+        FROM balances b
+        LEFT JOIN users u ON u.user_id = b.user_id
+        WHERE b.balance > 0
+        ORDER BY b.balance DESC
+        LIMIT ?
+    """, (limit,))
+    rows = cursor.fetchall()
+    conn.close()
+    return [
+        {
+            "id": str(row["user_id"]),
+            "balance": row["balance"],
+            "name": row["full_name"],
+            "username": row["username"] or "NA"
+        }
+        for row in rows
+    ]
+
+
+class _TopBalanceCache:
+    """
+    Топ пользователей по балансу в памяти.
+    
+    Хранит последние K строк из get_top_users_with_names и сбрасывается
+    только тогда, когда изменение баланса может затронуть топ: пользователь
+    уже в топе или его новый баланс не ниже порога попадания.
+    """
+
+    def __init__(self):
+        self.limit = 0
+        self.rows: Optional[List[dict]] = None
+        self.user_ids = set()
+        self.threshold = 0
+
+    def get(self, limit: int) -> List[dict]:
+        if self.rows is None or limit > self.limit:
+            self.rows = get_top_users_with_names(limit)
+            self.limit = limit
+            self.user_ids = {int(row["id"]) for row in self.rows}
+            # Пока топ не заполнен, в него попадает любой положительный баланс
+            self.threshold = self.rows[-1]["balance"] if len(self.rows) >= limit else 1
+        return self.rows[:limit]
+
+    def invalidate(self):
+        self.rows = None
+
+    def on_balance_change(self, user_id: int, balance: int):
+        if self.rows is None:
+            return
+        if user_id in self.user_ids or balance >= self.threshold:
+            self.invalidate()
+
+    def on_name_change(self, user_id: int):
+        # Топ показывает имена, поэтому смена имени участника топа его сбрасывает
+        if self.rows is not None and user_id in self.user_ids:
+            self.invalidate()
+
+
+_top_balance_cache = _TopBalanceCache()
+register_cache_invalidator("top_balance", lambda key: _top_balance_cache.on_balance_change(*key))
+register_cache_invalidator("top_balance_name", _top_balance_cache.on_name_change)
+
+
+def get_top_users_cached(limit: int = 20) -> List[dict]:
+    """Получает топ пользователей по балансу из кэша в памяти"""
+    return _top_balance_cache.get(limit)
+
+
 # ========== ФУНКЦИИ ДЛЯ РАБОТЫ С ДОСТИЖЕНИЯМИ ==========
 
-def create_achievement(ach_id: str, ach_name: str, created: str):
+def create_achievement(ach_id: str, ach_name: str, created: int):
     """Создает новое достижение"""
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("""
         INSERT OR IGNORE INTO achievements (ach_id, ach_name, created)
         VALUES (?, ?, ?)
-    """, (ach_id, ach_name, created))
+    """, (ach_id, ach_name, to_epoch(created)))
     conn.commit()
     conn.close()
+    # Достижение с тем же ID могло быть удалено и у пользователей остались записи о нем
+    invalidate_cache("user_card")
 
 
 def delete_achievement(ach_id: str) -> bool:
@@ -433,6 +1345,8 @@ def delete_achievement(ach_id: str) -> bool:
     deleted = cursor.rowcount > 0
     conn.commit()
     conn.close()
+    if deleted:
+        invalidate_cache("user_card")
     return deleted
 
 
@@ -453,16 +1367,17 @@ def get_all_achievements() -> List[dict]:
     ]
 
 
-def add_user_achievement(user_id: int, ach_id: str, given_date: str, given_by: str):
+def add_user_achievement(user_id: int, ach_id: str, given_date: int, given_by: str):
     """Добавляет достижение пользователю"""
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("""
         INSERT INTO user_achievements (user_id, ach_id, given_date, given_by)
         VALUES (?, ?, ?, ?)
-    """, (user_id, ach_id, given_date, given_by))
+    """, (user_id, ach_id, to_epoch(given_date), given_by))
     conn.commit()
     conn.close()
+    invalidate_user_card(user_id)
 
 
 def get_user_achievements(user_id: int) -> List[dict]:
@@ -499,21 +1414,114 @@ def remove_achievement_from_user(user_id: int, ach_id: str) -> bool:
     deleted = cursor.rowcount > 0
     conn.commit()
     conn.close()
+    if deleted:
+        invalidate_user_card(user_id)
     return deleted
 
 
+# ========== КАРТОЧКА ПОЛЬЗОВАТЕЛЯ ==========
+
+USER_CARD_CACHE_SIZE = 5000
+
+# Карточки по user_id. Сбрасываются функциями, которые меняют их данные:
+# add_user, update_user_identity, изменения баланса (set_user_balance,
+# add_user_balance, remove_user_balance, transfer_balance), выдача и удаление достижений, баны, временные баны
+# и назначение администраторов
+_user_card_cache = LRUCache(maxsize=USER_CARD_CACHE_SIZE)
+# key None - сброс всех карточек
+register_cache_invalidator(
+    "user_card",
+    lambda user_id: _user_card_cache.clear() if user_id is None else _user_card_cache.pop(user_id)
+)
+
+
+def load_user_card(user_id: int) -> dict:
+    """
+    Загружает профиль, баланс, статус бана, флаг администратора и
+    достижения пользователя одним запросом (без кэша)
+    
+    Returns:
+        dict: {"profile": dict или None, "balance": int, "is_banned": bool,
+               "unban_time": int или None, "is_admin": bool, "achievements": list}
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT
+            u.user_id, u.full_name, u.username, u.first_start,
+            COALESCE(b.balance, 0) AS balance,
+            bl.user_id IS NOT NULL AS is_banned,
+            tb.unban_time,
+            a.admin_id IS NOT NULL AS is_admin,
+            (
+                SELECT json_group_array(json_object(
+                    'id', ach_id, 'name', ach_name, 'date', given_date, 'given_by', given_by
+                ))
+                FROM (
+                    SELECT ua.ach_id, ach.ach_name, ua.given_date, ua.given_by
+                    FROM user_achievements ua
+                    JOIN achievements ach ON ach.ach_id = ua.ach_id
+                    WHERE ua.user_id = q.user_id
+                    ORDER BY ua.id
+                )
+            ) AS achievements
+        FROM (SELECT ? AS user_id) q
+        LEFT JOIN users u ON u.user_id = q.user_id
+        LEFT JOIN balances b ON b.user_id = q.user_id
+        LEFT JOIN blacklist bl ON bl.user_id = q.user_id
+        LEFT JOIN temp_bans tb ON tb.user_id = q.user_id
+        LEFT JOIN admins a ON a.admin_id = q.user_id
+    """, (user_id,))
+    row = cursor.fetchone()
+    conn.close()
+    
+    profile = None
+    if row["user_id"] is not None:
+        profile = {
+            "id": str(row["user_id"]),
+            "name": row["full_name"],
+            "username": row["username"] or "NA",
+            "first_start": row["first_start"]
+        }
+    
+    return {
+        "profile": profile,
+        "balance": row["balance"],
+        "is_banned": bool(row["is_banned"]),
+        # Время окончания хранится как есть: истечение бана проверяется при чтении
+        "unban_time": row["unban_time"],
+        "is_admin": bool(row["is_admin"]),
+        "achievements": json.loads(row["achievements"])
+    }
+
+
+def get_user_card(user_id: int) -> dict:
+    """Получает карточку пользователя (read-through кэш над load_user_card)"""
+    card = _user_card_cache.get(user_id)
+    if card is CACHE_MISS:
+        card = load_user_card(user_id)
+        _user_card_cache.set(user_id, card)
+    return card
+
+
+def invalidate_user_card(user_id: int):
+    """Сбрасывает закэшированную карточку пользователя"""
+    invalidate_cache("user_card", user_id)
+
+
 # ========== ФУНКЦИИ ДЛЯ РАБОТЫ С ВРЕМЕННЫМИ БАНАМИ ==========
 
-def add_temp_ban(user_id: int, unban_time: str, reason: str, banned_by: int, banned_at: str):
+def add_temp_ban(user_id: int, unban_time: int, reason: str, banned_by: int, banned_at: int):
     """Добавляет временный бан"""
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("""
         INSERT OR REPLACE INTO temp_bans (user_id, unban_time, reason, banned_by, banned_at)
         VALUES (?, ?, ?, ?, ?)
-    """, (user_id, unban_time, reason, banned_by, banned_at))
+    """, (user_id, to_epoch(unban_time), reason, banned_by, to_epoch(banned_at)))
     conn.commit()
     conn.close()
+    invalidate_user_card(user_id)
 
 
 def get_temp_bans() -> List[dict]:
@@ -537,25 +1545,22 @@ def get_temp_bans() -> List[dict]:
 
 def is_temp_banned(user_id: int) -> bool:
     """Проверяет, есть ли у пользователя активный временный бан"""
-    temp_bans = get_temp_bans()
-    now = datetime.now()
-    
-    for ban in temp_bans:
-        if ban["user_id"] == str(user_id):
-            try:
-                unban_time = datetime.strptime(ban["unban_time"], "%Y-%m-%d %H:%M:%S")
-                if unban_time > now:
-                    return True
-            except ValueError:
-                continue
-    return False
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT 1 FROM temp_bans WHERE user_id = ? AND unban_time > ?",
+        (user_id, int(time.time()))
+    )
+    result = cursor.fetchone() is not None
+    conn.close()
+    return result
 
 
 def remove_expired_temp_bans() -> List[int]:
     """Удаляет истекшие временные баны и возвращает список разбаненных пользователей"""
     conn = get_db_connection()
     cursor = conn.cursor()
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    now = int(time.time())
     
     # Получаем истекшие баны
     cursor.execute("SELECT user_id FROM temp_bans WHERE unban_time <= ?", (now,))
@@ -567,6 +1572,8 @@ def remove_expired_temp_bans() -> List[int]:
     conn.commit()
     conn.close()
     
+    for user_id in expired_user_ids:
+        invalidate_user_card(user_id)
     return expired_user_ids
 
 
@@ -578,86 +1585,400 @@ def remove_temp_ban(user_id: int) -> bool:
     deleted = cursor.rowcount > 0
     conn.commit()
     conn.close()
+    if deleted:
+        invalidate_user_card(user_id)
     return deleted
 
 
+# ========== ТИКЕТЫ ПОДДЕРЖКИ ==========
+
+TICKET_STATUSES = ("open", "assigned", "closed")
+
+
+def create_ticket(user_id: int, text: str) -> Optional[int]:
+    """
+    Создает тикет с первым сообщением пользователя
+    
+    Returns:
+        Optional[int]: ID тикета или None, если у пользователя уже есть незакрытый тикет
+    """
+    now = int(time.time())
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            INSERT INTO support_tickets (user_id, status, created_at, updated_at)
+            VALUES (?, 'open', ?, ?)
+        """, (user_id, now, now))
+    except sqlite3.IntegrityError:
+        conn.close()
+        return None
+    ticket_id = cursor.lastrowid
+    cursor.execute("""
+        INSERT INTO ticket_messages (ticket_id, sender_id, from_admin, text, created_at)
+        VALUES (?, ?, 0, ?, ?)
+    """, (ticket_id, user_id, text, now))
+    conn.commit()
+    conn.close()
+    return ticket_id
+
+
+def get_ticket(ticket_id: int) -> Optional[dict]:
+    """Получает тикет по ID"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM support_tickets WHERE id = ?", (ticket_id,))
+    row = cursor.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def get_active_ticket(user_id: int) -> Optional[dict]:
+    """Получает незакрытый тикет пользователя"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT * FROM support_tickets WHERE user_id = ? AND status != 'closed'",
+        (user_id,)
+    )
+    row = cursor.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def assign_ticket(ticket_id: int, admin_id: int) -> bool:
+    """
+    Назначает открытый тикет администратору
+    
+    Returns:
+        bool: False, если тикет уже взял другой администратор или он закрыт
+    """
+    now = int(time.time())
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE support_tickets
+        SET status = 'assigned', admin_id = ?, assigned_at = ?, updated_at = ?
+        WHERE id = ? AND status = 'open'
+    """, (admin_id, now, now, ticket_id))
+    assigned = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    return assigned
+
+
+def take_next_ticket(admin_id: int) -> Optional[dict]:
+    """Назначает администратору самый старый неназначенный тикет"""
+    now = int(time.time())
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # Выбор и назначение в одной транзакции записи, чтобы два администратора не взяли один тикет
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("SELECT id FROM support_tickets WHERE status = 'open' ORDER BY id LIMIT 1")
+    row = cursor.fetchone()
+    if not row:
+        conn.rollback()
+        conn.close()
+        return None
+    cursor.execute("""
+        UPDATE support_tickets
+        SET status = 'assigned', admin_id = ?, assigned_at = ?, updated_at = ?
+        WHERE id = ?
+    """, (admin_id, now, now, row["id"]))
+    cursor.execute("SELECT * FROM support_tickets WHERE id = ?", (row["id"],))
+    ticket = dict(cursor.fetchone())
+    conn.commit()
+    conn.close()
+    return ticket
+
+
+def add_ticket_message(ticket_id: int, sender_id: int, from_admin: bool, text: str):
+    """Добавляет сообщение в переписку по тикету"""
+    now = int(time.time())
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO ticket_messages (ticket_id, sender_id, from_admin, text, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, (ticket_id, sender_id, int(from_admin), text, now))
+    cursor.execute("UPDATE support_tickets SET updated_at = ? WHERE id = ?", (now, ticket_id))
+    conn.commit()
+    conn.close()
+
+
+def close_ticket(ticket_id: int, admin_id: int) -> bool:
+    """
+    Закрывает тикет, назначенный администратору
+    
+    Returns:
+        bool: False, если тикет уже закрыт или назначен другому администратору
+    """
+    now = int(time.time())
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE support_tickets
+        SET status = 'closed', closed_at = ?, updated_at = ?
+        WHERE id = ? AND admin_id = ? AND status = 'assigned'
+    """, (now, now, ticket_id, admin_id))
+    closed = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    return closed
+
+
+def close_stale_tickets(max_idle: int) -> int:
+    """Закрывает незакрытые тикеты без активности дольше max_idle секунд"""
+    now = int(time.time())
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE support_tickets
+        SET status = 'closed', closed_at = ?, updated_at = ?
+        WHERE status != 'closed' AND updated_at < ?
+    """, (now, now, now - max_idle))
+    closed = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return closed
+
+
+def get_ticket_messages(ticket_id: int, limit: int = 20) -> List[dict]:
+    """Получает последние сообщения тикета (от старых к новым)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT * FROM ticket_messages
+        WHERE ticket_id = ?
+        ORDER BY id DESC
+        LIMIT ?
+    """, (ticket_id, limit))
+    rows = cursor.fetchall()
+    conn.close()
+    return [dict(row) for row in reversed(rows)]
+
+
+def get_tickets_page(status: Optional[str] = None, admin_id: Optional[int] = None,
+                     before_id: Optional[int] = None, after_id: Optional[int] = None,
+                     limit: int = 10) -> dict:
+    """
+    Получает страницу тикетов с keyset-пагинацией по id
+    
+    Returns:
+        dict: {"rows": [...] от новых к старым, "has_older": bool, "has_newer": bool}
+    """
+    conditions = []
+    params = []
+    if status:
+        conditions.append("status = ?")
+        params.append(status)
+    if admin_id is not None:
+        conditions.append("admin_id = ?")
+        params.append(admin_id)
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    def fetch(extra: str, extra_params: list, order: str, count: int, columns: str = "*"):
+        where = " AND ".join(conditions + [extra]) if extra else " AND ".join(conditions)
+        cursor.execute(f"""
+            SELECT {columns} FROM support_tickets
+            {'WHERE ' + where if where else ''}
+            ORDER BY id {order}
+            LIMIT ?
+        """, params + extra_params + [count])
+        return cursor.fetchall()
+    
+    if after_id is not None:
+        rows = fetch("id > ?", [after_id], "ASC", limit + 1)
+        has_newer = len(rows) > limit
+        rows = list(reversed(rows[:limit]))
+        has_older = bool(fetch("id <= ?", [after_id], "DESC", 1, "id"))
+    else:
+        if before_id is not None:
+            rows = fetch("id < ?", [before_id], "DESC", limit + 1)
+        else:
+            rows = fetch("", [], "DESC", limit + 1)
+        has_older = len(rows) > limit
+        rows = rows[:limit]
+        has_newer = before_id is not None and bool(fetch("id >= ?", [before_id], "ASC", 1, "id"))
+    
+    conn.close()
+    return {"rows": [dict(row) for row in rows], "has_older": has_older, "has_newer": has_newer}
+
+
+def get_ticket_counts() -> Dict[str, int]:
+    """Получает количество тикетов по статусам"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT status, COUNT(*) AS count FROM support_tickets GROUP BY status")
+    counts = {status: 0 for status in TICKET_STATUSES}
+    counts.update({row["status"]: row["count"] for row in cursor.fetchall()})
+    conn.close()
+    return counts
+
+
+# ========== ИСТОРИЯ ИМЕН ПОЛЬЗОВАТЕЛЕЙ ==========
+
+USER_NAMES_CACHE_SIZE = 10000
+
+# Последнее записанное имя пользователя: {user_id: (full_name, username)}
+# Позволяет не обращаться к user_names при каждой записи лога
+_last_user_names = LRUCache(maxsize=USER_NAMES_CACHE_SIZE)
+
+
+def _remember_user_name(cursor, user_id: int, full_name: str, username: Optional[str], timestamp: int):
+    """Добавляет запись в user_names, если имя или username пользователя изменились"""
+    name = (full_name, username if username and username != "NA" else None)
+    if _last_user_names.get(user_id) == name:
+        return
+    
+    cursor.execute("""
+        SELECT full_name, username FROM user_names
+        WHERE user_id = ?
+        ORDER BY first_seen DESC, id DESC
+        LIMIT 1
+    """, (user_id,))
+    row = cursor.fetchone()
+    if row is None or (row["full_name"], row["username"]) != name:
+        cursor.execute("""
+            INSERT INTO user_names (user_id, full_name, username, first_seen)
+            VALUES (?, ?, ?, ?)
+        """, (user_id, name[0], name[1], timestamp))
+    _last_user_names.set(user_id, name)
+
+
+def get_user_name_history(user_id: int) -> List[dict]:
+    """Получает историю имен пользователя (от старых к новым)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT full_name, username, first_seen FROM user_names
+        WHERE user_id = ?
+        ORDER BY first_seen, id
+    """, (user_id,))
+    rows = cursor.fetchall()
+    conn.close()
+    return [
+        {
+            "name": row["full_name"],
+            "username": row["username"] or "NA",
+            "first_seen": row["first_seen"]
+        }
+        for row in rows
+    ]
+
+
+def _log_name_join(table_name: str) -> str:
+    """
+    JOIN имени пользователя на момент записи лога (таблица логов должна иметь псевдоним t)
+    
+    Берется последняя запись user_names не позже времени лога, а если
+    ее нет (лог старше первой известной записи) - самая ранняя.
+    """
+    if table_name not in NAMED_LOG_TABLES:
+        return ""
+    return """
+        LEFT JOIN user_names n ON n.id = COALESCE(
+            (SELECT id FROM user_names WHERE user_id = t.user_id AND first_seen <= t.timestamp
+             ORDER BY first_seen DESC, id DESC LIMIT 1),
+            (SELECT id FROM user_names WHERE user_id = t.user_id
+             ORDER BY first_seen, id LIMIT 1)
+        )
+    """
+
+
+def _log_columns(table_name: str, columns: str) -> str:
+    """Колонки выборки логов с псевдонимом t и, для логов пользователей, full_name/username"""
+    result = ", ".join(f"t.{column.strip()}" for column in columns.split(","))
+    if table_name in NAMED_LOG_TABLES:
+        result += ", COALESCE(n.full_name, 'NA') AS full_name, COALESCE(n.username, 'NA') AS username"
+    return result
+
+
 # ========== ФУНКЦИИ ДЛЯ ЛОГИРОВАНИЯ ==========
 
-def log_user_action(user_id: int, full_name: str, username: str, timestamp: str, action: str):
+def log_user_action(user_id: int, full_name: str, username: str, timestamp: int, action: str):
     """Логирует действие пользователя"""
     conn = get_db_connection()
     cursor = conn.cursor()
+    timestamp = to_epoch(timestamp)
     cursor.execute("""
-        INSERT INTO user_logs (user_id, full_name, username, timestamp, action)
-        VALUES (?, ?, ?, ?, ?)
-    """, (user_id, full_name, username or "NA", timestamp, action))
+        INSERT INTO user_logs (user_id, timestamp, action)
+        VALUES (?, ?, ?)
+    """, (user_id, timestamp, action))
+    _remember_user_name(cursor, user_id, full_name, username, timestamp)
     conn.commit()
     conn.close()
 
 
-def log_admin_action(user_id: int, full_name: str, username: str, timestamp: str, action: str):
+def log_admin_action(user_id: int, full_name: str, username: str, timestamp: int, action: str):
     """Логирует действие администратора"""
     conn = get_db_connection()
     cursor = conn.cursor()
+    timestamp = to_epoch(timestamp)
     cursor.execute("""
-        INSERT INTO admin_logs (user_id, full_name, username, timestamp, action)
-        VALUES (?, ?, ?, ?, ?)
-    """, (user_id, full_name, username or "NA", timestamp, action))
+        INSERT INTO admin_logs (user_id, timestamp, action)
+        VALUES (?, ?, ?)
+    """, (user_id, timestamp, action))
+    _remember_user_name(cursor, user_id, full_name, username, timestamp)
     conn.commit()
     conn.close()
 
 
-def log_admin_command(user_id: int, full_name: str, username: str, timestamp: str, command: str):
+def log_admin_command(user_id: int, full_name: str, username: str, timestamp: int, command: str):
     """Логирует команду администратора"""
     conn = get_db_connection()
     cursor = conn.cursor()
+    timestamp = to_epoch(timestamp)
     cursor.execute("""
-        INSERT INTO admin_command_logs (user_id, full_name, username, timestamp, command)
-        VALUES (?, ?, ?, ?, ?)
-    """, (user_id, full_name, username or "NA", timestamp, command))
+        INSERT INTO admin_command_logs (user_id, timestamp, command)
+        VALUES (?, ?, ?)
+    """, (user_id, timestamp, command))
+    _remember_user_name(cursor, user_id, full_name, username, timestamp)
     conn.commit()
     conn.close()
 
 
-def log_system_event(initiator: str, timestamp: str, action: str):
+def log_system_event(initiator: str, timestamp: int, action: str):
     """Логирует системное событие"""
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("""
         INSERT INTO system_logs (initiator, timestamp, action)
         VALUES (?, ?, ?)
-    """, (initiator, timestamp, action))
+    """, (initiator, to_epoch(timestamp), action))
     conn.commit()
     conn.close()
 
 
-def log_error(error_type: str, timestamp: str, error_message: str, context: str = ""):
+def log_error(error_type: str, timestamp: int, error_message: str, context: str = ""):
     """Логирует ошибку"""
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("""
         INSERT INTO error_logs (error_type, timestamp, error_message, context)
         VALUES (?, ?, ?, ?)
-    """, (error_type, timestamp, error_message, context or ""))
+    """, (error_type, to_epoch(timestamp), error_message, context or ""))
     conn.commit()
     conn.close()
 
 
-def log_transfer(timestamp: str, from_user_id: int, to_user_id: int, amount: int, from_name: str, to_name: str):
+def log_transfer(timestamp: int, from_user_id: int, to_user_id: int, amount: int, from_name: str, to_name: str):
     """Логирует перевод TPCoin"""
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("""
         INSERT INTO transfer_logs (timestamp, from_user_id, to_user_id, amount, from_name, to_name)
         VALUES (?, ?, ?, ?, ?, ?)
-    """, (timestamp, from_user_id, to_user_id, amount, from_name, to_name))
+    """, (to_epoch(timestamp), from_user_id, to_user_id, amount, from_name, to_name))
     conn.commit()
     conn.close()
 
 
 # ========== ФУНКЦИИ ДЛЯ ЛОГИРОВАНИЯ AI ЗАПРОСОВ ==========
 
-def log_ai_request(user_id: int, full_name: str, username: str, timestamp: str, 
+def log_ai_request(user_id: int, full_name: str, username: str, timestamp: int, 
                    request_text: str, response_text: str = None, 
                    prompt_tokens: int = 0, completion_tokens: int = 0, 
                    total_tokens: int = 0, model: str = None, 
@@ -665,18 +1986,20 @@ def log_ai_request(user_id: int, full_name: str, username: str, timestamp: str,
     """Логирует AI запрос пользователя"""
     conn = get_db_connection()
     cursor = conn.cursor()
+    timestamp = to_epoch(timestamp)
     cursor.execute("""
         INSERT INTO ai_requests (
-            user_id, full_name, username, timestamp, request_text, 
+            user_id, timestamp, request_text, 
             response_text, prompt_tokens, completion_tokens, total_tokens, 
             model, success, error_message
         )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     """, (
-        user_id, full_name, username or "NA", timestamp, request_text,
+        user_id, timestamp, request_text,
         response_text, prompt_tokens, completion_tokens, total_tokens,
         model, 1 if success else 0, error_message
     ))
+    _remember_user_name(cursor, user_id, full_name, username, timestamp)
     conn.commit()
     conn.close()
 
@@ -740,91 +2063,402 @@ def get_all_ai_stats() -> dict:
     }
 
 
+# Описание таблиц логов: выбираемые колонки, допустимые фильтры и формат строки
+# (full_name и username для NAMED_LOG_TABLES подставляются из user_names)
+LOG_TABLES = {
+    "user_logs": {
+        "columns": "id, user_id, timestamp, action",
+        "filters": ("user_id",),
+        "format": lambda row: f"{row['user_id']} | {row['full_name']} | {row['username']} | {format_timestamp(row['timestamp'])} | {row['action']}"
+    },
+    "admin_logs": {
+        "columns": "id, user_id, timestamp, action",
+        "filters": ("user_id",),
+        "format": lambda row: f"{row['user_id']} | {row['full_name']} | {row['username']} | {format_timestamp(row['timestamp'])} | {row['action']}"
+    },
+    "admin_command_logs": {
+        "columns": "id, user_id, timestamp, command",
+        "filters": ("user_id",),
+        "format": lambda row: f"{row['user_id']} | {row['full_name']} | {row['username']} | {format_timestamp(row['timestamp'])} | {row['command']}"
+    },
+    "system_logs": {
+        "columns": "id, initiator, timestamp, action",
+        "filters": (),
+        "format": lambda row: f"{row['initiator']} | {format_timestamp(row['timestamp'])} | {row['action']}"
+    },
+    "error_logs": {
+        "columns": "id, error_type, timestamp, error_message, context",
+        "filters": ("error_type",),
+        "format": lambda row: f"{row['error_type']} | {format_timestamp(row['timestamp'])} | {row['error_message']}{' | ' + row['context'] if row['context'] else ''}"
+    },
+    "ai_requests": {
+        "columns": "id, user_id, timestamp, request_text, "
+                   "prompt_tokens, completion_tokens, total_tokens, model, success",
+        "filters": ("user_id",),
+        "format": lambda row: (
+            f"{row['user_id']} | {row['full_name']} | {row['username']} | {format_timestamp(row['timestamp'])} | "
+            f"Запрос: {row['request_text'][:50]}... | Токены: {row['total_tokens']} | "
+            f"Модель: {row['model']} | Успех: {'Да' if row['success'] else 'Нет'}"
+        )
+    }
+}
+
+
+def format_log_row(table_name: str, row) -> str:
+    """Форматирует строку лога для вывода"""
+    return LOG_TABLES[table_name]["format"](row)
+
+
 def get_last_logs(table_name: str, count: int = 20) -> List[str]:
     """Получает последние N записей из таблицы логов"""
+    if table_name not in LOG_TABLES:
+        return []
+    
+    page = get_logs_page(table_name, limit=count)
+    return [format_log_row(table_name, row) + "\n" for row in page["rows"]]
+
+
+def _log_id_at(cursor, table_name: str, timestamp: int) -> Optional[int]:
+    """Находит первый id с временем не раньше timestamp (поиск по индексу timestamp)"""
+    cursor.execute(f"""
+        SELECT id FROM {table_name}
+        WHERE timestamp >= ?
+        ORDER BY timestamp, id
+        LIMIT 1
+    """, (timestamp,))
+    row = cursor.fetchone()
+    return row["id"] if row else None
+
+
+def get_logs_page(table_name: str, before_id: Optional[int] = None, after_id: Optional[int] = None,
+                  limit: int = 20, user_id: Optional[int] = None, error_type: Optional[str] = None,
+                  since: Optional[int] = None, until: Optional[int] = None) -> dict:
+    """
+    Получает страницу логов с keyset-пагинацией по id
+    
+    before_id - страница записей старше указанного id, after_id - новее.
+    Без курсора возвращается самая свежая страница. Диапазон времени
+    переводится в границы id, поэтому глубина листания не влияет на скорость.
+    
+    Returns:
+        dict: {"rows": [...] от старых к новым, "has_older": bool, "has_newer": bool}
+    """
+    spec = LOG_TABLES[table_name]
+    # Фильтр, которого у таблицы нет, не пропускается молча: иначе вернулись бы нефильтрованные логи
+    if user_id is not None and "user_id" not in spec["filters"]:
+        raise ValueError(f"Фильтр user_id не применим к {table_name}")
+    if error_type and "error_type" not in spec["filters"]:
+        raise ValueError(f"Фильтр error_type не применим к {table_name}")
+    
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    if table_name == "user_logs":
-        cursor.execute("""
-            SELECT user_id, full_name, username, timestamp, action
-            FROM user_logs
-            ORDER BY id DESC
-            LIMIT ?
-        """, (count,))
-        rows = cursor.fetchall()
-        logs = [
-            f"{row['user_id']} | {row['full_name']} | {row['username']} | {row['timestamp']} | {row['action']}\n"
-            for row in reversed(rows)
-        ]
-    elif table_name == "admin_logs":
-        cursor.execute("""
-            SELECT user_id, full_name, username, timestamp, action
-            FROM admin_logs
-            ORDER BY id DESC
-            LIMIT ?
-        """, (count,))
-        rows = cursor.fetchall()
-        logs = [
-            f"{row['user_id']} | {row['full_name']} | {row['username']} | {row['timestamp']} | {row['action']}\n"
-            for row in reversed(rows)
-        ]
-    elif table_name == "admin_command_logs":
-        cursor.execute("""
-            SELECT user_id, full_name, username, timestamp, command
-            FROM admin_command_logs
-            ORDER BY id DESC
-            LIMIT ?
-        """, (count,))
-        rows = cursor.fetchall()
-        logs = [
-            f"{row['user_id']} | {row['full_name']} | {row['username']} | {row['timestamp']} | {row['command']}\n"
-            for row in reversed(rows)
-        ]
-    elif table_name == "system_logs":
-        cursor.execute("""
-            SELECT initiator, timestamp, action
-            FROM system_logs
-            ORDER BY id DESC
-            LIMIT ?
-        """, (count,))
-        rows = cursor.fetchall()
-        logs = [
-            f"{row['initiator']} | {row['timestamp']} | {row['action']}\n"
-            for row in reversed(rows)
-        ]
-    elif table_name == "error_logs":
-        cursor.execute("""
-            SELECT error_type, timestamp, error_message, context
-            FROM error_logs
-            ORDER BY id DESC
-            LIMIT ?
-        """, (count,))
-        rows = cursor.fetchall()
-        logs = [
-            f"{row['error_type']} | {row['timestamp']} | {row['error_message']}{' | ' + row['context'] if row['context'] else ''}\n"
-            for row in reversed(rows)
-        ]
-    elif table_name == "ai_requests":
-        cursor.execute("""
-            SELECT user_id, full_name, username, timestamp, request_text, 
-                   prompt_tokens, completion_tokens, total_tokens, model, success
-            FROM ai_requests
-            ORDER BY id DESC
+    conditions = []
+    params = []
+    if user_id is not None:
+        conditions.append("t.user_id = ?")
+        params.append(user_id)
+    if error_type:
+        conditions.append("t.error_type = ?")
+        params.append(error_type)
+    if since:
+        low_id = _log_id_at(cursor, table_name, since)
+        if low_id is None:
+            conn.close()
+            return {"rows": [], "has_older": False, "has_newer": False}
+        conditions.append("t.id >= ? AND t.timestamp >= ?")
+        params.extend([low_id, since])
+    if until:
+        high_id = _log_id_at(cursor, table_name, until)
+        conditions.append("t.timestamp < ?")
+        params.append(until)
+        if high_id is not None:
+            conditions.append("t.id < ?")
+            params.append(high_id)
+    
+    def fetch(extra: str, extra_params: list, order: str, count: int, columns: str):
+        where = " AND ".join(conditions + [extra]) if extra else " AND ".join(conditions)
+        # Имена подставляются только для строк страницы, проверки соседних страниц их не читают
+        cursor.execute(f"""
+            SELECT {columns} FROM {table_name} t
+            {_log_name_join(table_name) if columns != "t.id" else ""}
+            {'WHERE ' + where if where else ''}
+            ORDER BY t.id {order}
             LIMIT ?
-        """, (count,))
-        rows = cursor.fetchall()
-        logs = [
-            f"{row['user_id']} | {row['full_name']} | {row['username']} | {row['timestamp']} | "
-            f"Запрос: {row['request_text'][:50]}... | Токены: {row['total_tokens']} | "
-            f"Модель: {row['model']} | Успех: {'Да' if row['success'] else 'Нет'}\n"
-            for row in reversed(rows)
-        ]
+        """, params + extra_params + [count])
+        return cursor.fetchall()
+    
+    columns = _log_columns(table_name, spec["columns"])
+    if after_id is not None:
+        rows = fetch("t.id > ?", [after_id], "ASC", limit + 1, columns)
+        has_newer = len(rows) > limit
+        rows = rows[:limit]
+        has_older = bool(fetch("t.id <= ?", [after_id], "DESC", 1, "t.id"))
     else:
-        logs = []
+        if before_id is not None:
+            rows = fetch("t.id < ?", [before_id], "DESC", limit + 1, columns)
+            has_newer = bool(fetch("t.id >= ?", [before_id], "ASC", 1, "t.id"))
+        else:
+            rows = fetch("", [], "DESC", limit + 1, columns)
+            has_newer = False
+        has_older = len(rows) > limit
+        rows = list(reversed(rows[:limit]))
+    
+    conn.close()
+    return {"rows": rows, "has_older": has_older, "has_newer": has_newer}
+
+
+def is_fts_available() -> bool:
+    """Проверяет, доступен ли полнотекстовый поиск по логам"""
+    return FTS_AVAILABLE
+
+
+def detect_fts():
+    """
+    Определяет доступность FTS по уже подготовленной базе
+    
+    Для процессов, которые не вызывают init_database() (ее выполняет
+    основной процесс до их запуска).
+    """
+    global FTS_AVAILABLE
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                   (f"{next(iter(FTS_TABLES))}_fts",))
+    FTS_AVAILABLE = cursor.fetchone() is not None
+    conn.close()
+
+
+def _fts_query(text: str) -> str:
+    """Превращает пользовательский текст в запрос FTS5: каждое слово ищется как префикс"""
+    terms = [term.replace('"', '""') for term in text.split()]
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def search_logs(query: str, tables: Optional[List[str]] = None, limit: int = 20,
+                since: Optional[int] = None, until: Optional[int] = None) -> List[Tuple[str, sqlite3.Row]]:
+    """
+    Полнотекстовый поиск по логам через FTS5
+    
+    Returns:
+        list: [(table_name, row), ...] отсортированные по релевантности (bm25)
+    """
+    if not FTS_AVAILABLE or not query.strip():
+        return []
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    results = []
+    for table in tables or list(FTS_TABLES):
+        conditions = [f"{table}_fts MATCH ?"]
+        params = [_fts_query(query)]
+        if since:
+            conditions.append("t.timestamp >= ?")
+            params.append(since)
+        if until:
+            conditions.append("t.timestamp < ?")
+            params.append(until)
+        
+        columns = _log_columns(table, LOG_TABLES[table]["columns"])
+        cursor.execute(f"""
+            SELECT {columns}, bm25({table}_fts) AS rank
+            FROM {table}_fts
+            JOIN {table} t ON t.id = {table}_fts.rowid
+            {_log_name_join(table)}
+            WHERE {" AND ".join(conditions)}
+            ORDER BY rank
+            LIMIT ?
+        """, params + [limit])
+        results.extend((table, row) for row in cursor.fetchall())
+    
+    conn.close()
+    
+    results.sort(key=lambda item: item[1]["rank"])
+    return results[:limit]
+
+
+def export_logs(table_name: str, path: str, fmt: str = "csv", since: Optional[int] = None,
+                until: Optional[int] = None, batch_size: int = 1000) -> int:
+    """
+    Потоково выгружает таблицу логов в gzip файл (CSV или JSONL)
+    
+    Строки читаются страницами по id (keyset) и сразу пишутся в сжатый поток,
+    поэтому расход памяти не зависит от размера выгрузки. Каждая страница -
+    отдельный короткий запрос: блокировка чтения снимается между страницами,
+    и запись в базу не ждет окончания всей выгрузки.
+    
+    Returns:
+        int: количество выгруженных записей
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    conditions = ["t.id > ?"]
+    params = []
+    last_id = 0
+    if since:
+        low_id = _log_id_at(cursor, table_name, since)
+        if low_id is None:
+            # Записей не раньше since нет
+            conn.close()
+            return 0
+        last_id = low_id - 1
+        conditions.append("t.timestamp >= ?")
+        params.append(since)
+    if until:
+        high_id = _log_id_at(cursor, table_name, until)
+        if high_id is not None:
+            conditions.append("t.id < ?")
+            params.append(high_id)
+        conditions.append("t.timestamp < ?")
+        params.append(until)
+    
+    query = f"""
+        SELECT {_log_columns(table_name, "*")} FROM {table_name} t
+        {_log_name_join(table_name)}
+        WHERE {" AND ".join(conditions)}
+        ORDER BY t.id
+        LIMIT ?
+    """
+    
+    exported = 0
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as output:
+        writer = csv.writer(output) if fmt == "csv" else None
+        columns = None
+        
+        while True:
+            cursor.execute(query, [last_id, *params, batch_size])
+            if columns is None:
+                columns = [column[0] for column in cursor.description]
+                if writer:
+                    writer.writerow(columns)
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                if writer:
+                    writer.writerow(tuple(row))
+                else:
+                    output.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+            exported += len(rows)
+            last_id = rows[-1]["id"]
+    
+    conn.close()
+    return exported
+
+
+# ========== ХРАНЕНИЕ И АРХИВАЦИЯ ЛОГОВ ==========
+
+# Таблицы, к которым применяется политика хранения
+RETENTION_TABLES = (
+    "user_logs",
+    "admin_logs",
+    "admin_command_logs",
+    "system_logs",
+    "error_logs",
+    "transfer_logs",
+    "ai_requests"
+)
+
+
+def _retention_cutoff_id(cursor, table_name: str, max_age_days: Optional[int],
+                         max_rows: Optional[int]) -> Optional[int]:
+    """Находит id, начиная с которого записи сохраняются (все, что меньше, - в архив)"""
+    cutoff_ids = []
+    
+    if max_age_days:
+        cutoff_time = int(time.time()) - max_age_days * 86400
+        first_kept_id = _log_id_at(cursor, table_name, cutoff_time)
+        if first_kept_id is None:
+            # Все записи старше порога
+            cursor.execute(f"SELECT MAX(id) AS max_id FROM {table_name}")
+            max_id = cursor.fetchone()["max_id"]
+            first_kept_id = max_id + 1 if max_id is not None else None
+        if first_kept_id is not None:
+            cutoff_ids.append(first_kept_id)
+    
+    if max_rows:
+        cursor.execute(f"SELECT id FROM {table_name} ORDER BY id DESC LIMIT 1 OFFSET ?", (max_rows - 1,))
+        row = cursor.fetchone()
+        if row:
+            cutoff_ids.append(row["id"])
+    
+    return max(cutoff_ids) if cutoff_ids else None
+
+
+def archive_old_logs(table_name: str, archive_dir: str, max_age_days: Optional[int] = None,
+                     max_rows: Optional[int] = None, chunk_size: int = 5000,
+                     pause: float = 0.05) -> int:
+    """
+    Выгружает старые записи логов в gzip JSONL архив и удаляет их из базы
+    
+    Записи выгружаются и удаляются порциями по chunk_size с паузой между ними,
+    чтобы не блокировать запись логов обработчиками бота. Каждая порция
+    пишется отдельным gzip-членом и сбрасывается на диск (fsync) до удаления
+    из базы: после сбоя в архиве остаются целые порции, а не обрезанный поток.
+    
+    Returns:
+        int: количество заархивированных записей
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cutoff_id = _retention_cutoff_id(cursor, table_name, max_age_days, max_rows)
+    if cutoff_id is None:
+        conn.close()
+        return 0
+    
+    cursor.execute(f"SELECT 1 FROM {table_name} WHERE id < ? LIMIT 1", (cutoff_id,))
+    if cursor.fetchone() is None:
+        conn.close()
+        return 0
+    
+    os.makedirs(archive_dir, exist_ok=True)
+    archive_path = os.path.join(
+        archive_dir,
+        f"{table_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl.gz"
+    )
+    
+    archived = 0
+    last_id = 0
+    with open(archive_path, "wb") as archive:
+        while True:
+            # Имена подставляются в архив, чтобы он оставался самодостаточным
+            cursor.execute(f"""
+                SELECT {_log_columns(table_name, "*")} FROM {table_name} t
+                {_log_name_join(table_name)}
+                WHERE t.id > ? AND t.id < ?
+                ORDER BY t.id
+                LIMIT ?
+            """, (last_id, cutoff_id, chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            
+            chunk = "".join(json.dumps(dict(row), ensure_ascii=False) + "\n" for row in rows)
+            archive.write(gzip.compress(chunk.encode("utf-8")))
+            # Данные должны попасть на диск до удаления из базы
+            archive.flush()
+            os.fsync(archive.fileno())
+            
+            last_id = rows[-1]["id"]
+            cursor.execute(f"DELETE FROM {table_name} WHERE id >= ? AND id <= ?", (rows[0]["id"], last_id))
+            conn.commit()
+            archived += len(rows)
+            
+            time.sleep(pause)
     
     conn.close()
-    return logs
+    return archived
+
+
+def incremental_vacuum(pages: int = 0):
+    """Возвращает файлу базы освободившиеся страницы (0 - все)"""
+    conn = get_db_connection()
+    # executescript выполняет PRAGMA до конца, обычный execute освобождает только одну страницу
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    conn.close()
 
 
 # ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
@@ -841,9 +2475,7 @@ def get_total_users_count() -> int:
 
 def get_new_users_last_24h() -> int:
     """Получает количество новых пользователей за последние 24 часа"""
-    from datetime import timedelta
-    now = datetime.now()
-    day_ago = (now - timedelta(hours=24)).strftime("%Y-%m-%d %H:%M:%S")
+    day_ago = int(time.time()) - 24 * 3600
     
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -908,3 +2540,15 @@ def get_logs_statistics() -> dict:
     
     conn.close()
     return stats
+
+
+def get_cache_sizes() -> Dict[str, int]:
+    """Количество записей в кэшах и накопителях модуля (для поиска утечек памяти)"""
+    return {
+        "user_card": len(_user_card_cache),
+        "last_user_names": len(_last_user_names),
+        "top_balance": len(_top_balance_cache.rows or ()),
+        "admin_ids": len(_admin_ids_cache or ()),
+        "query_stats": len(_query_stats),
+        "pending_slow_queries": len(_pending_slow_queries)
+    }
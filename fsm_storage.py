@@ -0,0 +1,111 @@
+"""
+Хранилище FSM состояний на основе SQLite
+"""
+import json
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+from database import (
+    get_db_connection,
+    LRUCache,
+    CACHE_MISS,
+    register_cache_invalidator,
+    invalidate_cache
+)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Реализация FSM хранилища aiogram на основе SQLite с кэшем в памяти
+
+    Кэш работает по схеме write-through: чтение идет из памяти, а запись
+    сразу попадает и в кэш, и в базу, поэтому состояния переживают
+    перезапуск. Ключи FSM привязаны к пользователю, а в многопроцессном
+    режиме все апдейты пользователя обрабатывает один процесс, так что
+    кэш процесса не расходится с базой.
+    """
+
+    def __init__(self, cache_size: int = 10000):
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+        # {ключ FSM: (состояние, данные)}
+        self.states = LRUCache(maxsize=cache_size)
+
+        register_cache_invalidator(
+            "fsm_state",
+            lambda key: self.states.clear() if key is None else self.states.pop(key)
+        )
+
+    # ========== FSM ==========
+
+    def _load(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        record = self.states.get(key)
+        if record is CACHE_MISS:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT state, data FROM fsm_states WHERE key = ?", (key,))
+            row = cursor.fetchone()
+            conn.close()
+            record = (row["state"], json.loads(row["data"])) if row else (None, {})
+            self.states.set(key, record)
+        return record
+
+    def _save(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        if state is None and not data:
+            # Пустое состояние не хранится
+            cursor.execute("DELETE FROM fsm_states WHERE key = ?", (key,))
+        else:
+            cursor.execute("""
+                INSERT INTO fsm_states (key, state, data, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state = excluded.state,
+                    data = excluded.data,
+                    updated_at = excluded.updated_at
+            """, (key, state, json.dumps(data, ensure_ascii=False), int(time.time())))
+        conn.commit()
+        conn.close()
+        self.states.set(key, (state, data))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        key = self.key_builder.build(key)
+        _, data = self._load(key)
+        self._save(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._load(self.key_builder.build(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        key = self.key_builder.build(key)
+        state, _ = self._load(key)
+        self._save(key, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._load(self.key_builder.build(key))[1].copy()
+
+    async def close(self) -> None:
+        self.states.clear()
+
+    # ========== ОЧИСТКА ==========
+
+    def cleanup(self, state_ttl: int) -> int:
+        """
+        Удаляет FSM состояния, не менявшиеся дольше state_ttl секунд
+
+        Returns:
+            int: количество удаленных состояний
+        """
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM fsm_states WHERE updated_at < ?", (int(time.time()) - state_ttl,))
+        deleted = cursor.rowcount
+        conn.commit()
+        conn.close()
+
+        if deleted:
+            invalidate_cache("fsm_state")
+        return deleted
@@ -0,0 +1,252 @@
+"""
+Метрики бота в текстовом формате Prometheus (text exposition format)
+
+Счетчики, gauge и гистограммы хранятся в памяти процесса. В многопроцессном
+режиме у каждого процесса свои метрики и свой адрес /metrics.
+"""
+import bisect
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+# Границы корзин гистограмм времени, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Базовый класс метрики с набором меток"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], **extra) -> Dict[str, str]:
+        labels = dict(zip(self.labelnames, key))
+        labels.update(extra)
+        return labels
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}"
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self) -> float:
+        with self.lock:
+            return sum(self.values.values())
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [(self.name, self._labels(key), value) for key, value in items]
+
+
+class Gauge(Metric):
+    """Текущее значение, которое может расти и уменьшаться"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [(self.name, self._labels(key), value) for key, value in items]
+
+
+class Histogram(Metric):
+    """Гистограмма с фиксированными корзинами (cumulative buckets, как в Prometheus)"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # {метки: [счетчики по корзинам + корзина +Inf, сумма, количество]}
+        self.values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Оценка квантиля по корзинам (линейная интерполяция внутри корзины)"""
+        with self.lock:
+            series = self.values.get(self._key(labels))
+            if not series or not series[2]:
+                return None
+            counts = list(series[0])
+            total = series[2]
+        return self._quantile(counts, total, q)
+
+    def _quantile(self, counts: List[int], total: int, q: float) -> float:
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index >= len(self.buckets):
+                    # Значение выше последней границы: точнее оценить нельзя
+                    return self.buckets[-1]
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def summary(self) -> List[Dict]:
+        """
+        Сводка по всем наборам меток
+
+        Returns:
+            list: [{"labels": dict, "count": int, "sum": float, "p50": float, "p99": float}, ...]
+        """
+        with self.lock:
+            items = [(key, list(series[0]), series[1], series[2]) for key, series in self.values.items()]
+        return [
+            {
+                "labels": self._labels(key),
+                "count": total,
+                "sum": value_sum,
+                "p50": self._quantile(counts, total, 0.5),
+                "p99": self._quantile(counts, total, 0.99)
+            }
+            for key, counts, value_sum, total in items
+            if total
+        ]
+
+    def samples(self):
+        result = []
+        with self.lock:
+            items = sorted((key, list(series[0]), series[1], series[2]) for key, series in self.values.items())
+        for key, counts, value_sum, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                result.append((f"{self.name}_bucket", self._labels(key, le=_format_value(bound)), cumulative))
+            result.append((f"{self.name}_sum", self._labels(key), value_sum))
+            result.append((f"{self.name}_count", self._labels(key), total))
+        return result
+
+
+class Registry:
+    """Набор метрик, отдаваемых на /metrics"""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+# ========== МЕТРИКИ БОТА ==========
+
+HANDLER_DURATION = REGISTRY.register(Histogram(
+    "bot_handler_duration_seconds",
+    "Время обработки апдейта хендлером",
+    ("event", "handler")
+))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    "bot_handler_errors_total",
+    "Необработанные исключения в хендлерах",
+    ("event", "handler")
+))
+HANDLERS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "bot_handlers_in_flight",
+    "Апдейты, обрабатываемые в данный момент",
+    ("event",)
+))
+DB_QUERY_DURATION = REGISTRY.register(Histogram(
+    "bot_db_query_duration_seconds",
+    "Время выполнения SQL запросов",
+    ("operation",),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+))
+AI_REQUEST_DURATION = REGISTRY.register(Histogram(
+    "bot_ai_request_duration_seconds",
+    "Время запросов к DeepSeek API",
+    ("status",)
+))
+
+
+def observe_db_query(sql: str, seconds: float):
+    """Слушатель database.add_query_listener: время запроса по типу операции"""
+    operation = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "OTHER"
+    DB_QUERY_DURATION.observe(seconds, operation=operation)
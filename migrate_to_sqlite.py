@@ -1,11 +1,21 @@
 """
 Скрипт миграции данных из .txt файлов в SQLite базу данных
+
+По умолчанию каждая строка записывается функциями database.py (отдельное
+соединение и коммит на строку). С --bulk данные загружаются массово:
+одно соединение, транзакция на таблицу, executemany пачками, индексы
+строятся после загрузки. Так многогигабайтные логи переносятся за минуты.
 """
+import argparse
 import os
 import glob
+import time
 from datetime import datetime
 from database import (
     init_database,
+    FTS_TABLES,
+    get_db_connection,
+    to_epoch,
     add_user,
     add_admin,
     ban_user,
@@ -22,13 +32,12 @@ from database import (
 )
 
 
-def migrate_users():
-    """Мигрирует пользователей из userlist.txt"""
+def read_users():
+    """Читает пользователей из userlist.txt"""
     if not os.path.exists("userlist.txt"):
         print("Файл userlist.txt не найден, пропускаем...")
-        return 0
+        return
     
-    count = 0
     with open("userlist.txt", "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -41,20 +50,15 @@ def migrate_users():
                 full_name = parts[1]
                 username = parts[2]
                 first_start = parts[3]
-                add_user(user_id, full_name, username, first_start)
-                count += 1
-    
-    print(f"✅ Мигрировано пользователей: {count}")
-    return count
+                yield user_id, full_name, username, first_start
 
 
-def migrate_admins():
-    """Мигрирует администраторов из adminlist.txt"""
+def read_admins():
+    """Читает администраторов из adminlist.txt"""
     if not os.path.exists("adminlist.txt"):
         print("Файл adminlist.txt не найден, пропускаем...")
-        return 0
+        return
     
-    count = 0
     with open("adminlist.txt", "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -67,20 +71,15 @@ def migrate_admins():
                 full_name = parts[1]
                 username = parts[2]
                 added_date = parts[3]
-                add_admin(admin_id, full_name, username, added_date)
-                count += 1
-    
-    print(f"✅ Мигрировано администраторов: {count}")
-    return count
+                yield admin_id, full_name, username, added_date
 
 
-def migrate_blacklist():
-    """Мигрирует черный список из blacklist.txt"""
+def read_blacklist():
+    """Читает черный список из blacklist.txt"""
     if not os.path.exists("blacklist.txt"):
         print("Файл blacklist.txt не найден, пропускаем...")
-        return 0
+        return
     
-    count = 0
     with open("blacklist.txt", "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -94,20 +93,15 @@ def migrate_blacklist():
                 username = parts[2]
                 banned_date = parts[3]
                 banned_by = parts[4] if len(parts) > 4 else "NA"
-                ban_user(user_id, full_name, username, banned_date, banned_by)
-                count += 1
-    
-    print(f"✅ Мигрировано забаненных пользователей: {count}")
-    return count
+                yield user_id, full_name, username, banned_date, banned_by
 
 
-def migrate_achievements():
-    """Мигрирует достижения из achlist.txt"""
+def read_achievements():
+    """Читает достижения из achlist.txt"""
     if not os.path.exists("achlist.txt"):
         print("Файл achlist.txt не найден, пропускаем...")
-        return 0
+        return
     
-    count = 0
     with open("achlist.txt", "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -119,20 +113,15 @@ def migrate_achievements():
                 ach_id = parts[0]
                 ach_name = parts[1]
                 created = parts[2] if len(parts) > 2 else datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                create_achievement(ach_id, ach_name, created)
-                count += 1
-    
-    print(f"✅ Мигрировано достижений: {count}")
-    return count
+                yield ach_id, ach_name, created
 
 
-def migrate_user_achievements():
-    """Мигрирует достижения пользователей из ach-user-list.txt"""
+def read_user_achievements():
+    """Читает достижения пользователей из ach-user-list.txt"""
     if not os.path.exists("ach-user-list.txt"):
         print("Файл ach-user-list.txt не найден, пропускаем...")
-        return 0
+        return
     
-    count = 0
     with open("ach-user-list.txt", "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -147,21 +136,15 @@ def migrate_user_achievements():
                 given_by = parts[4]
                 ach_id = parts[5]
                 # parts[6] - название достижения (не нужно, берется из таблицы achievements)
-                add_user_achievement(user_id, ach_id, given_date, given_by)
-                count += 1
-    
-    print(f"✅ Мигрировано достижений пользователей: {count}")
-    return count
+                yield user_id, ach_id, given_date, given_by
 
 
-def migrate_balances():
-    """Мигрирует балансы из файлов balance_*.txt"""
+def read_balances():
+    """Читает балансы из файлов balance_*.txt"""
     balance_files = glob.glob("balance_*.txt")
     if not balance_files:
         print("Файлы балансов не найдены, пропускаем...")
-        return 0
-    
-    count = 0
+        return
     for balance_file in balance_files:
         try:
             # Извлекаем user_id из имени файла
@@ -172,23 +155,18 @@ def migrate_balances():
                 balance_str = f.read().strip()
                 if balance_str:
                     balance = int(balance_str)
-                    set_user_balance(user_id, balance)
-                    count += 1
+                    yield user_id, balance
         except (ValueError, FileNotFoundError) as e:
             print(f"⚠️ Ошибка при миграции баланса из {balance_file}: {e}")
             continue
-    
-    print(f"✅ Мигрировано балансов: {count}")
-    return count
 
 
-def migrate_temp_bans():
-    """Мигрирует временные баны из tempban.txt"""
+def read_temp_bans():
+    """Читает временные баны из tempban.txt"""
     if not os.path.exists("tempban.txt"):
         print("Файл tempban.txt не найден, пропускаем...")
-        return 0
+        return
     
-    count = 0
     with open("tempban.txt", "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -202,20 +180,15 @@ def migrate_temp_bans():
                 reason = parts[2]
                 banned_by = int(parts[3])
                 banned_at = parts[4] if len(parts) > 4 else datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                add_temp_ban(user_id, unban_time, reason, banned_by, banned_at)
-                count += 1
-    
-    print(f"✅ Мигрировано временных банов: {count}")
-    return count
+                yield user_id, unban_time, reason, banned_by, banned_at
 
 
-def migrate_user_logs():
-    """Мигрирует логи пользователей из userlogs.txt"""
+def read_user_logs():
+    """Читает логи пользователей из userlogs.txt"""
     if not os.path.exists("userlogs.txt"):
         print("Файл userlogs.txt не найден, пропускаем...")
-        return 0
+        return
     
-    count = 0
     with open("userlogs.txt", "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -229,20 +202,15 @@ def migrate_user_logs():
                 username = parts[2]
                 timestamp = parts[3]
                 action = parts[4]
-                log_user_action(user_id, full_name, username, timestamp, action)
-                count += 1
-    
-    print(f"✅ Мигрировано логов пользователей: {count}")
-    return count
+                yield user_id, full_name, username, timestamp, action
 
 
-def migrate_admin_logs():
-    """Мигрирует логи администраторов из adminlogs.txt"""
+def read_admin_logs():
+    """Читает логи администраторов из adminlogs.txt"""
     if not os.path.exists("adminlogs.txt"):
         print("Файл adminlogs.txt не найден, пропускаем...")
-        return 0
+        return
     
-    count = 0
     with open("adminlogs.txt", "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -256,20 +224,15 @@ def migrate_admin_logs():
                 username = parts[2]
                 timestamp = parts[3]
                 action = parts[4]
-                log_admin_action(user_id, full_name, username, timestamp, action)
-                count += 1
-    
-    print(f"✅ Мигрировано логов администраторов: {count}")
-    return count
+                yield user_id, full_name, username, timestamp, action
 
 
-def migrate_admin_command_logs():
-    """Мигрирует логи команд администраторов из admin-com-logs.txt"""
+def read_admin_command_logs():
+    """Читает логи команд администраторов из admin-com-logs.txt"""
     if not os.path.exists("admin-com-logs.txt"):
         print("Файл admin-com-logs.txt не найден, пропускаем...")
-        return 0
+        return
     
-    count = 0
     with open("admin-com-logs.txt", "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -283,20 +246,15 @@ def migrate_admin_command_logs():
                 username = parts[2]
                 timestamp = parts[3]
                 command = parts[4]
-                log_admin_command(user_id, full_name, username, timestamp, command)
-                count += 1
-    
-    print(f"✅ Мигрировано логов команд администраторов: {count}")
-    return count
+                yield user_id, full_name, username, timestamp, command
 
 
-def migrate_system_logs():
-    """Мигрирует системные логи из systemlogs.txt"""
+def read_system_logs():
+    """Читает системные логи из systemlogs.txt"""
     if not os.path.exists("systemlogs.txt"):
         print("Файл systemlogs.txt не найден, пропускаем...")
-        return 0
+        return
     
-    count = 0
     with open("systemlogs.txt", "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -308,20 +266,15 @@ def migrate_system_logs():
                 initiator = parts[0]
                 timestamp = parts[1]
                 action = parts[2]
-                log_system_event(initiator, timestamp, action)
-                count += 1
-    
-    print(f"✅ Мигрировано системных логов: {count}")
-    return count
+                yield initiator, timestamp, action
 
 
-def migrate_error_logs():
-    """Мигрирует логи ошибок из errorlogs.txt"""
+def read_error_logs():
+    """Читает логи ошибок из errorlogs.txt"""
     if not os.path.exists("errorlogs.txt"):
         print("Файл errorlogs.txt не найден, пропускаем...")
-        return 0
+        return
     
-    count = 0
     with open("errorlogs.txt", "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -334,20 +287,15 @@ def migrate_error_logs():
                 timestamp = parts[1]
                 error_message = parts[2]
                 context = parts[3] if len(parts) > 3 else ""
-                log_error(error_type, timestamp, error_message, context)
-                count += 1
-    
-    print(f"✅ Мигрировано логов ошибок: {count}")
-    return count
+                yield error_type, timestamp, error_message, context
 
 
-def migrate_transfer_logs():
-    """Мигрирует логи переводов из transferlogs.txt"""
+def read_transfer_logs():
+    """Читает логи переводов из transferlogs.txt"""
     if not os.path.exists("transferlogs.txt"):
         print("Файл transferlogs.txt не найден, пропускаем...")
-        return 0
+        return
     
-    count = 0
     with open("transferlogs.txt", "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -378,18 +326,205 @@ def migrate_transfer_logs():
                         # Извлекаем amount
                         amount = int(amount_info.split()[0])
                         
-                        log_transfer(timestamp, from_user_id, to_user_id, amount, from_name, to_name)
-                        count += 1
+                        yield timestamp, from_user_id, to_user_id, amount, from_name, to_name
             except (ValueError, IndexError) as e:
                 print(f"⚠️ Ошибка при парсинге строки лога перевода: {line[:50]}... - {e}")
                 continue
+
+
+# ========== ТАБЛИЦЫ МИГРАЦИИ ==========
+
+# Размер пачки executemany в режиме --bulk
+BULK_BATCH_SIZE = 50000
+
+# Логи, для которых функции database.py сохраняют имена пользователей в user_names
+NAMED_LOG_HELPERS = (log_user_action, log_admin_action, log_admin_command)
+
+# (название, чтение, функция database.py для построчной записи, запрос и преобразование строки для --bulk)
+# Запросы и преобразования повторяют соответствующие функции database.py
+MIGRATIONS = [
+    ("пользователей", read_users, add_user,
+     "INSERT OR IGNORE INTO users (user_id, full_name, username, first_start) VALUES (?, ?, ?, ?)",
+     lambda user_id, full_name, username, first_start: (user_id, full_name, username, to_epoch(first_start))),
+    ("администраторов", read_admins, add_admin,
+     "INSERT OR IGNORE INTO admins (admin_id, full_name, username, added_date) VALUES (?, ?, ?, ?)",
+     lambda admin_id, full_name, username, added_date: (admin_id, full_name, username, to_epoch(added_date))),
+    ("забаненных пользователей", read_blacklist, ban_user,
+     "INSERT OR REPLACE INTO blacklist (user_id, full_name, username, banned_date, banned_by) VALUES (?, ?, ?, ?, ?)",
+     lambda user_id, full_name, username, banned_date, banned_by: (
+         user_id, full_name, username, to_epoch(banned_date), banned_by)),
+    ("достижений", read_achievements, create_achievement,
+     "INSERT OR IGNORE INTO achievements (ach_id, ach_name, created) VALUES (?, ?, ?)",
+     lambda ach_id, ach_name, created: (ach_id, ach_name, to_epoch(created))),
+    ("достижений пользователей", read_user_achievements, add_user_achievement,
+     "INSERT INTO user_achievements (user_id, ach_id, given_date, given_by) VALUES (?, ?, ?, ?)",
+     lambda user_id, ach_id, given_date, given_by: (user_id, ach_id, to_epoch(given_date), given_by)),
+    ("балансов", read_balances, set_user_balance,
+     "INSERT OR REPLACE INTO balances (user_id, balance) VALUES (?, ?)",
+     lambda user_id, balance: (user_id, balance)),
+    ("временных банов", read_temp_bans, add_temp_ban,
+     "INSERT OR REPLACE INTO temp_bans (user_id, unban_time, reason, banned_by, banned_at) VALUES (?, ?, ?, ?, ?)",
+     lambda user_id, unban_time, reason, banned_by, banned_at: (
+         user_id, to_epoch(unban_time), reason, banned_by, to_epoch(banned_at))),
+    ("логов пользователей", read_user_logs, log_user_action,
+     "INSERT INTO user_logs (user_id, timestamp, action) VALUES (?, ?, ?)",
+     lambda user_id, full_name, username, timestamp, action: (user_id, to_epoch(timestamp), action)),
+    ("логов администраторов", read_admin_logs, log_admin_action,
+     "INSERT INTO admin_logs (user_id, timestamp, action) VALUES (?, ?, ?)",
+     lambda user_id, full_name, username, timestamp, action: (user_id, to_epoch(timestamp), action)),
+    ("логов команд администраторов", read_admin_command_logs, log_admin_command,
+     "INSERT INTO admin_command_logs (user_id, timestamp, command) VALUES (?, ?, ?)",
+     lambda user_id, full_name, username, timestamp, command: (user_id, to_epoch(timestamp), command)),
+    ("системных логов", read_system_logs, log_system_event,
+     "INSERT INTO system_logs (initiator, timestamp, action) VALUES (?, ?, ?)",
+     lambda initiator, timestamp, action: (initiator, to_epoch(timestamp), action)),
+    ("логов ошибок", read_error_logs, log_error,
+     "INSERT INTO error_logs (error_type, timestamp, error_message, context) VALUES (?, ?, ?, ?)",
+     lambda error_type, timestamp, error_message, context: (
+         error_type, to_epoch(timestamp), error_message, context or "")),
+    ("логов переводов", read_transfer_logs, log_transfer,
+     "INSERT INTO transfer_logs (timestamp, from_user_id, to_user_id, amount, from_name, to_name) "
+     "VALUES (?, ?, ?, ?, ?, ?)",
+     lambda timestamp, from_user_id, to_user_id, amount, from_name, to_name: (
+         to_epoch(timestamp), from_user_id, to_user_id, amount, from_name, to_name)),
+]
+
+
+# ========== МАССОВАЯ ЗАГРУЗКА ==========
+
+class BulkLoader:
+    """
+    Массовая загрузка через одно соединение
     
-    print(f"✅ Мигрировано логов переводов: {count}")
+    На время загрузки отключаются fsync (synchronous = OFF) и журнал на диске
+    (journal_mode = MEMORY): при сбое базу нужно удалить и запустить миграцию
+    заново. Индексы, FTS и их триггеры удаляются до загрузки и строятся
+    init_database() после нее - один проход по таблице вместо обновления
+    B-дерева на каждую строку.
+    """
+
+    def __init__(self, batch_size: int = BULK_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.conn = get_db_connection()
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.execute("PRAGMA journal_mode = MEMORY")
+        # Последнее встреченное имя пользователя: {user_id: (full_name, username)}
+        self.seen_names = {}
+        # Самая поздняя по first_seen запись user_names: {user_id: (first_seen, (full_name, username))}
+        self.latest_names = None
+
+    def drop_indexes(self):
+        """Удаляет вторичные индексы, FTS-таблицы и триггеры (их восстанавливает init_database)"""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+        for row in cursor.fetchall():
+            cursor.execute(f"DROP TRIGGER IF EXISTS {row['name']}")
+        for table in FTS_TABLES:
+            cursor.execute(f"DROP TABLE IF EXISTS {table}_fts")
+        # Индексы первичных ключей и UNIQUE (sql IS NULL) удалить нельзя
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")
+        for row in cursor.fetchall():
+            cursor.execute(f"DROP INDEX IF EXISTS {row['name']}")
+        self.conn.commit()
+
+    def _load_latest_names(self):
+        """Загружает самое позднее имя каждого пользователя из user_names"""
+        self.latest_names = {}
+        cursor = self.conn.execute("SELECT user_id, full_name, username, first_seen FROM user_names ORDER BY first_seen, id")
+        for row in cursor:
+            self.latest_names[row["user_id"]] = (row["first_seen"], (row["full_name"], row["username"]))
+
+    def _remember_name(self, user_id: int, full_name: str, username: str, timestamp: int):
+        """
+        То же решение, что и в _remember_user_name, без запроса к базе
+        
+        Returns:
+            tuple: строка для user_names или None, если имя не изменилось
+        """
+        name = (full_name, username if username and username != "NA" else None)
+        if self.seen_names.get(user_id) == name:
+            return None
+        self.seen_names[user_id] = name
+        latest = self.latest_names.get(user_id)
+        if latest is not None and latest[1] == name:
+            return None
+        if latest is None or timestamp >= latest[0]:
+            self.latest_names[user_id] = (timestamp, name)
+        return user_id, name[0], name[1], timestamp
+
+    def load(self, sql: str, convert, rows, named: bool = False) -> int:
+        """
+        Записывает строки пачками executemany в одной транзакции
+        
+        Для логов с именами (named) новые имена и username, как и в
+        _remember_user_name, добавляются в user_names.
+        
+        Returns:
+            int: количество записанных строк
+        """
+        if named and self.latest_names is None:
+            self._load_latest_names()
+        
+        count = 0
+        batch = []
+        names = []
+        for args in rows:
+            batch.append(convert(*args))
+            if named:
+                # batch[-1] = (user_id, timestamp в epoch, действие)
+                name_row = self._remember_name(args[0], args[1], args[2], batch[-1][1])
+                if name_row:
+                    names.append(name_row)
+            if len(batch) >= self.batch_size:
+                count += self._write(sql, batch, names)
+                batch = []
+                names = []
+        count += self._write(sql, batch, names)
+        self.conn.commit()
+        return count
+
+    def _write(self, sql: str, batch, names) -> int:
+        cursor = self.conn.cursor()
+        cursor.executemany(sql, batch)
+        if names:
+            cursor.executemany("""
+                INSERT INTO user_names (user_id, full_name, username, first_seen)
+                VALUES (?, ?, ?, ?)
+            """, names)
+        return len(batch)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def migrate_table(label: str, read, write) -> int:
+    """Мигрирует одну таблицу и выводит скорость записи"""
+    started = time.perf_counter()
+    count = write(read())
+    elapsed = time.perf_counter() - started
+    rate = f" ({count / elapsed:.0f} строк/с)" if count and elapsed > 0 else ""
+    print(f"✅ Мигрировано {label}: {count}{rate}")
+    return count
+
+
+def write_rows(helper, rows) -> int:
+    """Построчная запись функцией database.py"""
+    count = 0
+    for args in rows:
+        helper(*args)
+        count += 1
     return count
 
 
 def main():
     """Главная функция миграции"""
+    parser = argparse.ArgumentParser(description="Миграция данных из .txt файлов в SQLite")
+    parser.add_argument("--bulk", action="store_true",
+                        help="массовая загрузка: одно соединение, executemany, индексы после загрузки")
+    parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE, help="размер пачки для --bulk")
+    args = parser.parse_args()
+    
     print("=" * 50)
     print("Начало миграции данных из .txt файлов в SQLite")
     print("=" * 50)
@@ -400,22 +535,31 @@ def main():
     print("✅ База данных инициализирована")
     
     # Мигрируем данные
-    print("\n📥 Начало миграции данных...\n")
+    print("\n📥 Начало миграции данных" + (" (массовая загрузка)" if args.bulk else "") + "...\n")
+    
+    loader = None
+    if args.bulk:
+        loader = BulkLoader(args.batch_size)
+        loader.drop_indexes()
     
     total = 0
-    total += migrate_users()
-    total += migrate_admins()
-    total += migrate_blacklist()
-    total += migrate_achievements()
-    total += migrate_user_achievements()
-    total += migrate_balances()
-    total += migrate_temp_bans()
-    total += migrate_user_logs()
-    total += migrate_admin_logs()
-    total += migrate_admin_command_logs()
-    total += migrate_system_logs()
-    total += migrate_error_logs()
-    total += migrate_transfer_logs()
+    try:
+        for label, read, helper, sql, convert in MIGRATIONS:
+            if loader:
+                named = helper in NAMED_LOG_HELPERS
+                write = lambda rows: loader.load(sql, convert, rows, named)
+            else:
+                write = lambda rows: write_rows(helper, rows)
+            total += migrate_table(label, read, write)
+    finally:
+        if loader:
+            loader.close()
+    
+    if loader:
+        print("\n🔧 Построение индексов и FTS...")
+        started = time.perf_counter()
+        init_database()
+        print(f"✅ Индексы построены за {time.perf_counter() - started:.1f} с")
     
     print("\n" + "=" * 50)
     print(f"✅ Миграция завершена! Всего записей мигрировано: {total}")
@@ -0,0 +1,333 @@
+"""
+Диагностика производительности бота: задержка цикла событий, поиск блокирующих
+вызовов, снимки памяти и профилирование процессора
+"""
+import asyncio
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter as StackCounter, deque
+from typing import Dict, List, Optional, Tuple
+
+from metrics import REGISTRY, Histogram, Counter
+
+
+LOOP_LAG = REGISTRY.register(Histogram(
+    "bot_event_loop_lag_seconds",
+    "Задержка запуска задач в цикле событий",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+))
+LOOP_STALLS = REGISTRY.register(Counter(
+    "bot_event_loop_stalls_total",
+    "Блокировки цикла событий дольше порога"
+))
+
+
+class LoopMonitor:
+    """
+    Монитор задержки цикла событий
+
+    Задача в цикле событий спит interval секунд и замеряет, насколько позже
+    она проснулась: это и есть задержка, с которой цикл запускает готовые задачи.
+    Отдельный поток-сторож следит за отметками задачи: если цикл не отвечает
+    дольше threshold секунд, он снимает стек потока цикла, то есть показывает,
+    какой синхронный вызов его держит. Стек записывается в лог уже после того,
+    как цикл освободится.
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25, sample_size: int = 3000):
+        self.interval = interval
+        self.threshold = threshold
+        self.samples = deque(maxlen=sample_size)
+        self.max_lag = 0.0
+        self.stall_count = 0
+        # Последние блокировки: {"time", "duration", "stack"}
+        self.stalls = deque(maxlen=20)
+        self.last_beat = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        # Стек, снятый сторожем во время текущей блокировки
+        self.pending_stack: Optional[str] = None
+
+    async def run(self, on_stall=None):
+        """
+        Основной цикл монитора (запускается задачей)
+
+        on_stall(duration, stack) вызывается в цикле событий после каждой блокировки
+        """
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_beat = now
+            lag = max(0.0, now - started - self.interval)
+
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG.observe(lag)
+
+            if lag >= self.threshold:
+                self.stall_count += 1
+                LOOP_STALLS.inc()
+                stack = self.pending_stack or "Стек не снят: блокировка короче интервала проверки сторожа"
+                self.pending_stack = None
+                self.stalls.append({"time": int(time.time()), "duration": lag, "stack": stack})
+                if on_stall:
+                    on_stall(lag, stack)
+
+    def _watchdog(self):
+        """Поток-сторож: снимает стек цикла событий, если тот не отвечает дольше порога"""
+        check_interval = max(self.threshold / 2, 0.01)
+        while True:
+            time.sleep(check_interval)
+            if self.pending_stack is not None:
+                continue
+            if time.monotonic() - self.last_beat < self.threshold + self.interval:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                self.pending_stack = "".join(traceback.format_stack(frame))
+
+    def percentile(self, percent: float) -> float:
+        values = sorted(self.samples)
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+    def stats(self) -> Dict:
+        """
+        Сводка задержки
+
+        Returns:
+            dict: {"p50", "p99", "max", "stalls", "last_stall"} (время в секундах)
+        """
+        return {
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max_lag,
+            "stalls": self.stall_count,
+            "last_stall": self.stalls[-1] if self.stalls else None
+        }
+
+
+def stack_location(stack: str) -> str:
+    """Последняя строка 'File ..., line ..., in ...' стека - место, где цикл был заблокирован"""
+    lines: List[str] = [line.strip() for line in stack.splitlines() if line.strip().startswith("File ")]
+    return lines[-1] if lines else stack.strip()[:200]
+
+
+# ========== ПАМЯТЬ ==========
+
+class MemoryProfiler:
+    """
+    Снимки распределения памяти через tracemalloc
+
+    Трассировка включается на лету и замедляет выделение памяти, поэтому по
+    умолчанию выключена. При включении снимается базовый снимок, и каждое
+    сравнение показывает, в каких строках кода память выросла с этого момента.
+    """
+
+    def __init__(self):
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self.baseline_time: Optional[int] = None
+
+    @property
+    def enabled(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 1):
+        """Включает трассировку (frames - глубина сохраняемого стека) и снимает базовый снимок"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.take_baseline()
+
+    def stop(self):
+        tracemalloc.stop()
+        self.baseline = None
+        self.baseline_time = None
+
+    def take_snapshot(self) -> tracemalloc.Snapshot:
+        # Выделения самого tracemalloc и импорта в отчете не нужны
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>")
+        ))
+
+    def take_baseline(self):
+        self.baseline = self.take_snapshot()
+        self.baseline_time = int(time.time())
+
+    def top(self, limit: int = 10, group_by: str = "lineno") -> List[Dict]:
+        """
+        Места с наибольшим объемом памяти сейчас
+
+        Returns:
+            list: [{"location": str, "size": int, "count": int}, ...]
+        """
+        stats = self.take_snapshot().statistics(group_by)
+        return [
+            {"location": self._location(stat.traceback), "size": stat.size, "count": stat.count}
+            for stat in stats[:limit]
+        ]
+
+    def diff(self, limit: int = 10, group_by: str = "lineno") -> List[Dict]:
+        """
+        Места с наибольшим ростом памяти с базового снимка
+
+        Returns:
+            list: [{"location": str, "size": int, "size_diff": int, "count_diff": int}, ...]
+        """
+        if self.baseline is None:
+            self.take_baseline()
+        stats = self.take_snapshot().compare_to(self.baseline, group_by)
+        return [
+            {
+                "location": self._location(stat.traceback),
+                "size": stat.size,
+                "size_diff": stat.size_diff,
+                "count_diff": stat.count_diff
+            }
+            for stat in stats[:limit]
+        ]
+
+    def _location(self, trace) -> str:
+        frame = trace[0]
+        return f"{frame.filename}:{frame.lineno}"
+
+    def traced_memory(self) -> Tuple[int, int]:
+        """Текущий и пиковый объем памяти, отслеживаемой tracemalloc, в байтах"""
+        return tracemalloc.get_traced_memory()
+
+
+def get_rss() -> Optional[int]:
+    """Резидентная память процесса в байтах (None, если узнать ее нельзя)"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # На macOS ru_maxrss в байтах, на Linux в килобайтах; это пик, а не текущее значение
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# ========== ПРОЦЕССОР ==========
+
+class CPUProfiler:
+    """
+    Профилирование процессора на заданное время
+
+    sample() - сэмплер: поток каждые interval секунд снимает стек потока цикла
+    событий. Накладные расходы малы и не зависят от числа вызовов, поэтому его
+    можно запускать под реальной нагрузкой. Результат - collapsed stacks
+    (строка "корень;...;функция количество"), которые открывают flamegraph.pl
+    и speedscope.
+
+    profile() - cProfile в потоке цикла событий: точное число вызовов и время
+    каждой функции, но каждый вызов замедляется. Результат - файл pstats.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.running = False
+
+    async def sample(self, duration: float, path: str, top: int = 5) -> Dict:
+        """
+        Снимает стеки цикла событий duration секунд и записывает их в path
+
+        Returns:
+            dict: {"samples": int, "idle": доля простоя цикла, "top": [(функция, доля), ...]}
+        """
+        self.running = True
+        try:
+            stacks = await asyncio.to_thread(self._sample, threading.get_ident(), duration)
+        finally:
+            self.running = False
+
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        total = sum(stacks.values())
+        # Собственное время: самый глубокий кадр стека
+        leaves = StackCounter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        idle = sum(count for leaf, count in leaves.items() if "(selectors.py:" in leaf)
+        return {
+            "samples": total,
+            "idle": idle / total if total else 0.0,
+            "top": [
+                (leaf, count / total)
+                for leaf, count in leaves.most_common()
+                if "(selectors.py:" not in leaf
+            ][:top]
+        }
+
+    def _sample(self, thread_id: int, duration: float) -> StackCounter:
+        stacks = StackCounter()
+        finish = time.monotonic() + duration
+        while time.monotonic() < finish:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stacks[self._collapse(frame)] += 1
+            del frame
+            time.sleep(self.interval)
+        return stacks
+
+    def _collapse(self, frame) -> str:
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            name = getattr(code, "co_qualname", code.co_name)
+            labels.append(f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(labels))
+
+    async def profile(self, duration: float, path: str, top: int = 5) -> Dict:
+        """
+        Профилирует поток цикла событий через cProfile и записывает pstats в path
+
+        Returns:
+            dict: {"calls": int, "total": секунды, "top": [(функция, собственное время, общее время), ...]}
+        """
+        profiler = cProfile.Profile()
+        self.running = True
+        try:
+            profiler.enable()
+            try:
+                await asyncio.sleep(duration)
+            finally:
+                profiler.disable()
+        finally:
+            self.running = False
+
+        profiler.dump_stats(path)
+        stats = pstats.Stats(profiler)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+        return {
+            "calls": stats.total_calls,
+            "total": stats.total_tt,
+            "top": [
+                (name if filename == "~" else f"{name} ({os.path.basename(filename)}:{line})",
+                 own_time, cumulative_time)
+                for (filename, line, name), (_, _, own_time, cumulative_time, _) in rows
+                # Ожидание событий в selectors - простой цикла, а не работа
+                if name not in ("<method 'poll' of 'select.epoll' objects>",
+                                "<method 'control' of 'select.kqueue' objects>",
+                                "<built-in method select.select>")
+            ][:top]
+        }
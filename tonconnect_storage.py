@@ -1,51 +1,79 @@
 """
-Хранилище для TON Connect на основе файла
+Хранилище для TON Connect на основе SQLite
 """
 import json
 import os
-from asyncio import Lock
-from typing import Dict, Optional
-
-import aiofiles
+from typing import Optional
 
 from tonutils.tonconnect import IStorage
 
+from database import get_db_connection
 
-class FileStorage(IStorage):
-    """Реализация хранилища для TON Connect на основе файла"""
-
-    def __init__(self, file_path: str):
-        self.file_path = file_path
-        self.lock = Lock()
-
-        if not os.path.exists(self.file_path):
-            with open(self.file_path, "w") as f:
-                json.dump({}, f)  # type: ignore
 
-    async def _read_data(self) -> Dict[str, str]:
-        async with self.lock:
-            async with aiofiles.open(self.file_path, "r") as f:
-                content = await f.read()
-                if content:
-                    return json.loads(content)
-                return {}
+class DatabaseStorage(IStorage):
+    """
+    Реализация хранилища для TON Connect на основе SQLite
 
-    async def _write_data(self, data: Dict[str, str]) -> None:
-        async with self.lock:
-            async with aiofiles.open(self.file_path, "w") as f:
-                await f.write(json.dumps(data, indent=4))
+    Каждая операция - отдельный запрос к таблице tonconnect_storage, поэтому
+    несколько процессов-обработчиков пишут в хранилище, не затирая записи
+    друг друга (в отличие от общего JSON файла, который перезаписывался целиком).
+    """
 
     async def set_item(self, key: str, value: str) -> None:
-        data = await self._read_data()
-        data[key] = value
-        await self._write_data(data)
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO tonconnect_storage (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        """, (key, value))
+        conn.commit()
+        conn.close()
 
     async def get_item(self, key: str, default_value: Optional[str] = None) -> Optional[str]:
-        data = await self._read_data()
-        return data.get(key, default_value)
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT value FROM tonconnect_storage WHERE key = ?", (key,))
+        row = cursor.fetchone()
+        conn.close()
+        return row["value"] if row else default_value
 
     async def remove_item(self, key: str) -> None:
-        data = await self._read_data()
-        if key in data:
-            del data[key]
-            await self._write_data(data)
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM tonconnect_storage WHERE key = ?", (key,))
+        conn.commit()
+        conn.close()
+
+
+def import_file_storage(file_path: str) -> int:
+    """
+    Переносит подключения из JSON файла прежнего FileStorage в базу
+
+    Записи, уже сохраненные в базе, не перезаписываются. После переноса
+    непустой файл переименовывается в file_path + ".imported", чтобы
+    отключенные позже кошельки не вернулись при следующем запуске.
+
+    Returns:
+        int: количество перенесенных записей
+    """
+    if not os.path.exists(file_path):
+        return 0
+
+    with open(file_path, "r", encoding="utf-8") as f:
+        content = f.read()
+    data = json.loads(content) if content.strip() else {}
+    if not data:
+        return 0
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany(
+        "INSERT OR IGNORE INTO tonconnect_storage (key, value) VALUES (?, ?)",
+        list(data.items())
+    )
+    imported = cursor.rowcount
+    conn.commit()
+    conn.close()
+
+    os.replace(file_path, file_path + ".imported")
+    return imported